@@ -1,8 +1,26 @@
-from .app import app
-from .commands.elisp import ElispVisitor, visit_app
+from . import profile
+
+profile.install_from_environment()
 
 __all__ = [
     "ElispVisitor",
     "app",
     "visit_app",
 ]
+
+
+def __getattr__(name: str):
+    # typer is only imported once the app is needed, the daemon client in
+    # rpoisel.client gets by without it
+    if name == "app":
+        with profile.span("import rpoisel.cli"):
+            from .cli import app as value
+        profile.begin("build cli")
+    elif name in ("ElispVisitor", "visit_app"):
+        from .commands import elisp
+
+        value = getattr(elisp, name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
@@ -0,0 +1,89 @@
+from enum import Enum
+from pathlib import Path
+from typing import Optional
+
+import typer
+
+from . import profile, trace
+from .util.cli import LazyCommand, LazyGroup
+
+COMMANDS: dict[str, LazyCommand] = {
+    "screen": LazyCommand(
+        "rpoisel.commands.screen",
+        "Load a screen layout and rearrange clients.",
+        in_process_args=("watch",),
+    ),
+    "power": LazyCommand("rpoisel.commands.power", "Switch a power relay on or off."),
+    "sleep": LazyCommand(
+        "rpoisel.commands.sleep", "Sync disks and suspend.", daemon=False
+    ),
+    "browser": LazyCommand(
+        "rpoisel.commands.browser", "Set the default browser.", daemon=False
+    ),
+    "vm": LazyCommand(
+        "rpoisel.commands.vm",
+        "Manage QEMU virtual machines.",
+        in_process_args=("watch", "create", "start", "restore"),
+    ),
+    "print": LazyCommand("rpoisel.commands.print", "Print a PDF remotely."),
+    "modules": LazyCommand(
+        "rpoisel.commands.modules", "Sign kernel modules.", daemon=False
+    ),
+    "elisp": LazyCommand(
+        "rpoisel.commands.elisp", "Generate Emacs commands running rpoisel."
+    ),
+    "completion": LazyCommand(
+        "rpoisel.commands.completion", "Print a static shell completion script."
+    ),
+    "daemon": LazyCommand(
+        "rpoisel.commands.daemon",
+        "Serve invocations from a warm process.",
+        daemon=False,
+    ),
+}
+
+
+class TraceFormat(str, Enum):
+    jsonl = "jsonl"
+    chrome = "chrome"
+
+
+class RpoiselGroup(LazyGroup):
+    lazy_commands = COMMANDS
+
+
+app = typer.Typer(
+    cls=RpoiselGroup,
+    name="rpoisel",
+    help="Rainer Poisel personal CLI",
+    no_args_is_help=True,
+)
+
+
+@app.callback()
+def main(
+    ctx: typer.Context,
+    profile_startup: bool = typer.Option(
+        False,
+        profile.FLAG,
+        help=f"Report import and startup times on exit (see ${profile.ENV_VAR}).",
+    ),
+    trace_path: Optional[Path] = typer.Option(
+        None,
+        trace.FLAG,
+        help="Write spans of child processes, relay requests and QMP commands.",
+    ),
+    trace_format: TraceFormat = typer.Option(
+        TraceFormat.jsonl, "--trace-format", help="JSON Lines or Chrome trace events."
+    ),
+) -> None:
+    if profile_startup:
+        profile.install()
+    profile.end("dispatch")
+    profile.begin("command")
+    ctx.call_on_close(lambda: profile.end("command"))
+    if trace_path is not None:
+        trace.install(str(trace_path), trace_format.value)
+        # closed in reverse order, the span ends before the trace is written
+        ctx.call_on_close(trace.uninstall)
+        ctx.with_resource(trace.span(f"rpoisel {ctx.invoked_subcommand}"))
@@ -0,0 +1,197 @@
+"""Entry point forwarding invocations to a running ``rpoisel daemon``.
+
+This runs for every invocation, so it avoids anything beyond cheap standard
+library modules (no typer, and not even json or pathlib). When no daemon is
+listening, or the daemon declines the command, the CLI runs in-process.
+
+Frames on the socket are a channel byte and a 32-bit payload length followed
+by the payload. The client sends a ``REQUEST`` and waits for ``ACCEPT`` or
+``FALLBACK``; after ``ACCEPT`` it sends ``CONFIRM`` together with its standard
+file descriptors, which processes spawned for the command write to. It then
+forwards stdin until an empty ``STDIN`` frame and copies ``STDOUT``/``STDERR``
+until ``EXIT`` carries the exit code. Both sides only talk to processes of the same user, the
+request carries the environment.
+"""
+
+import os
+import socket
+import struct
+import sys
+import threading
+
+from . import profile
+
+SOCKET_ENV_VAR = "RPOISEL_DAEMON_SOCKET"
+DISABLE_ENV_VAR = "RPOISEL_NO_DAEMON"
+
+REQUEST = 0
+ACCEPT = 1
+FALLBACK = 2
+STDIN = 3
+STDOUT = 4
+STDERR = 5
+EXIT = 6
+CONFIRM = 7
+
+# starting in-process takes about as long, no use waiting for a busy daemon
+CONNECT_TIMEOUT = 0.5
+
+_HEADER = struct.Struct("!BI")
+_PEERCRED = struct.Struct("3i")
+_CHUNK_SIZE = 64 * 1024
+
+
+def socket_path() -> str | None:
+    if path := os.environ.get(SOCKET_ENV_VAR):
+        return path
+    # another user could take a predictable path in a shared directory
+    if runtime_dir := os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(runtime_dir, f"rpoisel-{os.getuid()}.sock")
+    return None
+
+
+def peer_uid(sock: socket.socket) -> int:
+    _, uid, _ = _PEERCRED.unpack(
+        sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _PEERCRED.size)
+    )
+    return uid
+
+
+def encode_request(argv: list[str], stdin_isatty: bool) -> bytes:
+    # NUL cannot occur in arguments or the environment, so it separates fields
+    fields = [
+        os.getcwd(),
+        "1" if stdin_isatty else "0",
+        str(len(argv)),
+        *argv,
+        *(f"{key}={value}" for key, value in os.environ.items()),
+    ]
+    return "\0".join(fields).encode("utf-8", "surrogateescape")
+
+
+def decode_request(payload: bytes) -> dict:
+    cwd, stdin_isatty, argc, *rest = payload.decode("utf-8", "surrogateescape").split(
+        "\0"
+    )
+    argv, env = rest[: int(argc)], rest[int(argc) :]
+    return {
+        "cwd": cwd,
+        "stdin_isatty": stdin_isatty == "1",
+        "argv": argv,
+        "env": dict(x.split("=", 1) for x in env),
+    }
+
+
+def send_frame(sock: socket.socket, channel: int, payload: bytes = b"") -> None:
+    sock.sendall(_HEADER.pack(channel, len(payload)) + payload)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes | None:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock: socket.socket) -> tuple[int, bytes] | None:
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    channel, size = _HEADER.unpack(header)
+    payload = _recv_exactly(sock, size)
+    if payload is None:
+        return None
+    return channel, payload
+
+
+def _standard_fds() -> list[int]:
+    fds = []
+    for fd in range(3):
+        try:
+            os.fstat(fd)
+        except OSError:
+            # a closed descriptor can't be passed on
+            fd = os.open(os.devnull, os.O_RDWR)
+        fds.append(fd)
+    return fds
+
+
+def send_confirm(sock: socket.socket) -> None:
+    """Confirm a request, passing stdin, stdout and stderr along."""
+    socket.send_fds(sock, [_HEADER.pack(CONFIRM, 0)], _standard_fds())
+
+
+def recv_confirm(sock: socket.socket) -> list[int] | None:
+    """Return the standard fds of the client, or None if it gave up."""
+    data, fds, _flags, _address = socket.recv_fds(sock, _HEADER.size, 3)
+    if data != _HEADER.pack(CONFIRM, 0) or len(fds) != 3:
+        for fd in fds:
+            os.close(fd)
+        return None
+    return fds
+
+
+def _forward_stdin(sock: socket.socket) -> None:
+    try:
+        if sys.stdin is not None and not sys.stdin.isatty():
+            while chunk := os.read(sys.stdin.fileno(), _CHUNK_SIZE):
+                send_frame(sock, STDIN, chunk)
+        send_frame(sock, STDIN)
+    except OSError:
+        # the daemon finished without consuming all of stdin
+        pass
+
+
+def run_remote(argv: list[str], path: str | None = None) -> int | None:
+    """Run argv in the daemon, returning None if it has to run in-process."""
+    path = path or socket_path()
+    if path is None:
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(path)
+            if peer_uid(sock) != os.getuid():
+                print(
+                    f"Warning: ignoring {path}, another user listens on it.",
+                    file=sys.stderr,
+                )
+                return None
+            stdin_isatty = sys.stdin is None or sys.stdin.isatty()
+            send_frame(sock, REQUEST, encode_request(argv, stdin_isatty))
+            frame = recv_frame(sock)
+            if frame is None or frame[0] != ACCEPT:
+                return None
+            # the daemon waits for this, so a client that gave up on it
+            # never has its command run twice
+            send_confirm(sock)
+        except OSError:
+            # no daemon, a busy or a vanished one
+            return None
+        sock.settimeout(None)
+
+        threading.Thread(target=_forward_stdin, args=(sock,), daemon=True).start()
+        while frame := recv_frame(sock):
+            channel, payload = frame
+            if channel == EXIT:
+                return int(payload)
+            stream = sys.stdout if channel == STDOUT else sys.stderr
+            stream.buffer.write(payload)
+            stream.flush()
+    print("Error: connection to rpoisel daemon lost.", file=sys.stderr)
+    return 1
+
+
+def main() -> None:
+    if not profile.active() and not os.environ.get(DISABLE_ENV_VAR):
+        code = run_remote(sys.argv[1:])
+        if code is not None:
+            sys.exit(code)
+
+    from . import app
+
+    app(prog_name="rpoisel")
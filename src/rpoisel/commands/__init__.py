@@ -1,5 +1,4 @@
-from . import browser, elisp, modules, power, screen, sleep, vm
-
+# command modules are imported on demand, see rpoisel.cli.COMMANDS
 __all__ = [
     "browser",
     "elisp",
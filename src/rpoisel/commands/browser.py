@@ -3,7 +3,7 @@ from dataclasses import dataclass
 import rapidfuzz
 import typer
 
-from ..util.process import run_shell_check
+from ..util.process import run
 
 
 @dataclass
@@ -20,11 +20,20 @@ KNOWN_BROWSERS: dict[str, BrowserNames] = {
 
 
 def _set_default_browser(browser_names: BrowserNames) -> None:
-    run_shell_check(
-        f"xdg-settings set default-web-browser {browser_names.name}.desktop"
-        f"  && sudo update-alternatives --set x-www-browser /usr/bin/{browser_names.alt_name}"
-        f"  && sudo update-alternatives --set gnome-www-browser /usr/bin/{browser_names.alt_name}"
-    )
+    run(["xdg-settings", "set", "default-web-browser", f"{browser_names.name}.desktop"])
+    for alternative in ["x-www-browser", "gnome-www-browser"]:
+        run(
+            [
+                "sudo",
+                "update-alternatives",
+                "--set",
+                alternative,
+                f"/usr/bin/{browser_names.alt_name}",
+            ],
+            # sudo may ask for a password
+            timeout=None,
+            interactive=True,
+        )
 
 
 def register(app: typer.Typer) -> None:
@@ -0,0 +1,431 @@
+"""Static shell completion scripts.
+
+Completion through click starts Python and imports every command on each
+keypress. The scripts generated here complete command names and their unique
+prefixes, choices and option names in the shell itself; VM names are listed
+from the QMP socket directory by the shell. Scripts are cached per fingerprint
+of the installed sources and only generated again once these change.
+"""
+
+import shlex
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from typing import override
+
+import click
+import typer
+
+from ..util.cli import (
+    CommandIndex,
+    GlobCompletion,
+    source_fingerprint,
+    static_completions,
+)
+from ..util.xdg import xdg_path
+from .elisp import Visitor, visit_app
+
+PROG = "rpoisel"
+
+
+class Shell(str, Enum):
+    bash = "bash"
+    zsh = "zsh"
+    fish = "fish"
+
+
+@dataclass
+class Values:
+    """What a positional argument or the value of an option completes to."""
+
+    words: list[str] = field(default_factory=list)
+    files: bool = False
+    globs: list[GlobCompletion] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.words or self.files or self.globs)
+
+
+@dataclass
+class OptionSpec:
+    names: list[str]
+    help: str
+    # None for flags
+    values: Values | None
+
+
+@dataclass
+class CommandSpec:
+    name: str
+    help: str
+    options: list[OptionSpec] = field(default_factory=list)
+    arguments: list[Values] = field(default_factory=list)
+    # the last argument takes any number of values
+    variadic: bool = False
+
+    def value_options(self) -> list[tuple[str, Values]]:
+        return [
+            (name, x.values)
+            for x in self.options
+            if x.values is not None
+            for name in x.names
+        ]
+
+    def option_names(self) -> list[str]:
+        return [name for x in self.options for name in x.names]
+
+
+def _values(ctx: click.Context, param: click.Parameter) -> Values:
+    # typer hides paths from click's completion
+    if isinstance(param.type, click.Path):
+        return Values(files=True)
+    # globs are listed by the shell, anything else is known by now
+    words, globs = static_completions(ctx, param)
+    return Values(words, globs=globs)
+
+
+def command_spec(command: click.Command, name: str | None = None) -> CommandSpec:
+    name = name or command.name or PROG
+    ctx = click.Context(command, info_name=name, resilient_parsing=True)
+    spec = CommandSpec(name, command.get_short_help_str())
+    for param in command.get_params(ctx):
+        if isinstance(param, click.Option):
+            if param.hidden:
+                continue
+            flag = param.is_flag or param.count
+            spec.options.append(
+                OptionSpec(
+                    [*param.opts, *param.secondary_opts],
+                    param.help or "",
+                    None if flag else _values(ctx, param),
+                )
+            )
+        elif isinstance(param, click.Argument):
+            spec.arguments.append(_values(ctx, param))
+            spec.variadic = param.nargs == -1
+    return spec
+
+
+class CompletionVisitor(Visitor):
+    def __init__(self) -> None:
+        self.commands: list[CommandSpec] = []
+
+    @override
+    def command(self, command: click.Command, path: tuple[str, ...]) -> None:
+        self.commands.append(command_spec(command, " ".join(path)))
+
+
+@dataclass
+class CompletionTree:
+    root: CommandSpec
+    commands: list[CommandSpec]
+
+    @classmethod
+    def from_app(cls, app: click.Command) -> "CompletionTree":
+        visitor = CompletionVisitor()
+        visit_app(app, visitor)
+        return cls(command_spec(app, PROG), visitor.commands)
+
+    def aliases(self) -> dict[str, list[str]]:
+        """Map each command name to the prefixes resolving to it, itself included."""
+        index = CommandIndex(x.name for x in self.commands)
+        return {
+            x.name: [
+                *(
+                    x.name[:i]
+                    for i in range(1, len(x.name))
+                    if index.complete(x.name[:i]) == [x.name]
+                ),
+                x.name,
+            ]
+            for x in self.commands
+        }
+
+
+# --- bash and zsh ---
+
+
+def _bash_words(words: list[str]) -> str:
+    return shlex.quote(" ".join(words))
+
+
+def _bash_reply(values: Values) -> str:
+    words = _bash_words(values.words) if values.words else ""
+    for glob in values.globs:
+        listing = shlex.join(["_rpoisel_glob", str(glob.directory), glob.prefix])
+        words += f'" $({listing})"'
+    args = ["-f"] if values.files else []
+    if words:
+        args += ["-W", words]
+    return f'COMPREPLY=($(compgen {" ".join(args)} -- "$cur"))'
+
+
+def _bash_case(patterns: list[str], body: str) -> str:
+    return f"            {'|'.join(patterns)}) {body} ;;"
+
+
+def _bash(tree: CompletionTree, fingerprint: str) -> str:
+    specs = [tree.root, *tree.commands]
+    value_options = [
+        (f"{x.name if x is not tree.root else ''}:{name}", values)
+        for x in specs
+        for name, values in x.value_options()
+    ]
+    aliases = "\n".join(
+        f"                    {'|'.join(prefixes)}) command={name} ;;"
+        for name, prefixes in tree.aliases().items()
+    )
+    option_values = "\n".join(
+        _bash_case([shlex.quote(key)], _bash_reply(values))
+        for key, values in value_options
+        if values
+    )
+    option_names = "\n".join(
+        _bash_case(
+            [shlex.quote(x.name if x is not tree.root else "")],
+            _bash_reply(Values(x.option_names())),
+        )
+        for x in specs
+    )
+    cases = []
+    for x in tree.commands:
+        for i, values in enumerate(x.arguments):
+            last = x.variadic and i == len(x.arguments) - 1
+            position = "*" if last else str(i)
+            if not values:
+                continue
+            cases.append(
+                _bash_case([f"{shlex.quote(x.name)}:{position}"], _bash_reply(values))
+            )
+    arguments = "\n".join(cases)
+    skipped = "|".join(shlex.quote(key) for key, _ in value_options) or "''"
+    commands = _bash_reply(Values([x.name for x in tree.commands]))
+    return f"""\
+# rpoisel completion, fingerprint {fingerprint}
+# generated by `rpoisel completion`, generated again when rpoisel changes
+
+_rpoisel_glob() {{
+    local x
+    for x in "$1/$2"*; do
+        [[ -e $x ]] && printf '%s\\n' "${{x#"$1/$2"}}"
+    done
+}}
+
+_rpoisel() {{
+    local cur=${{COMP_WORDS[COMP_CWORD]}}
+    local command= position=0 option= word i
+    # find the command, the argument position and an option awaiting its value
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        word=${{COMP_WORDS[i]}}
+        case $command:$word in
+            {skipped}) option=$command:$word; ((++i < COMP_CWORD)) && option= ;;
+            *:-*) ;;
+            :*)
+                case $word in
+{aliases}
+                    *) command=$word ;;
+                esac
+                ;;
+            *) ((++position)) ;;
+        esac
+    done
+
+    if [[ -n $option ]]; then
+        case $option in
+{option_values}
+        esac
+    elif [[ $cur == -* ]]; then
+        case $command in
+{option_names}
+        esac
+    elif [[ -z $command ]]; then
+        {commands}
+    else
+        case $command:$position in
+{arguments}
+        esac
+    fi
+}}
+
+complete -o filenames -F _rpoisel {PROG}
+"""
+
+
+def _zsh(tree: CompletionTree, fingerprint: str) -> str:
+    # zsh runs the bash functions in sh emulation, which takes sourcing the
+    # script; an autoloaded #compdef file has to be a zsh completion function
+    return (
+        "# source it from ~/.zshrc after compinit\n"
+        "autoload -U +X bashcompinit && bashcompinit\n"
+    ) + _bash(tree, fingerprint)
+
+
+# --- fish ---
+
+
+def _fish_quote(value: str) -> str:
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def _fish_values(values: Values, option: bool) -> list[str]:
+    args = []
+    if option:
+        args.append("-r" if values.files else "-x")
+    if values.files:
+        args.append("-F")
+    # fish splits and expands the candidates
+    words = list(values.words)
+    for glob in values.globs:
+        listing = " ".join(_fish_quote(x) for x in [str(glob.directory), glob.prefix])
+        words.append(f"(__rpoisel_glob {listing})")
+    if words:
+        args += ["-a", _fish_quote(" ".join(words))]
+    return args
+
+
+def _fish_option_flags(name: str) -> list[str]:
+    if name.startswith("--"):
+        return ["-l", _fish_quote(name[2:])]
+    if len(name) == 2:
+        return ["-s", _fish_quote(name[1:])]
+    return ["-o", _fish_quote(name[1:])]
+
+
+def _fish(tree: CompletionTree, fingerprint: str) -> str:
+    specs = [tree.root, *tree.commands]
+    value_options = " ".join(
+        _fish_quote(f"{x.name if x is not tree.root else ''}:{name}")
+        for x in specs
+        for name, _ in x.value_options()
+    )
+    aliases = "\n".join(
+        f"                case {' '.join(prefixes)}\n"
+        f"                    set __rpoisel_command {name}"
+        for name, prefixes in tree.aliases().items()
+    )
+    lines = []
+    for x in tree.commands:
+        lines.append(
+            " ".join(
+                [
+                    f"complete -c {PROG} -n {_fish_quote('__rpoisel_is "" 0')}",
+                    f"-a {_fish_quote(x.name)} -d {_fish_quote(x.help)}",
+                ]
+            )
+        )
+    for x in specs:
+        command = x.name if x is not tree.root else '""'
+        condition = _fish_quote(f"__rpoisel_is {command}")
+        for option in x.options:
+            for name in option.names:
+                args = _fish_option_flags(name)
+                if option.values is not None:
+                    args += _fish_values(option.values, option=True)
+                if option.help:
+                    args += ["-d", _fish_quote(option.help)]
+                lines.append(f"complete -c {PROG} -n {condition} {' '.join(args)}")
+        for i, values in enumerate(x.arguments):
+            last = x.variadic and i == len(x.arguments) - 1
+            position = f"{i}+" if last else str(i)
+            if not values:
+                continue
+            condition = _fish_quote(f"__rpoisel_is {command} {position}")
+            args = _fish_values(values, option=False)
+            lines.append(f"complete -c {PROG} -n {condition} {' '.join(args)}")
+    completions = "\n".join(lines)
+    return f"""\
+# rpoisel completion, fingerprint {fingerprint}
+# generated by `rpoisel completion`, generated again when rpoisel changes
+
+function __rpoisel_glob
+    for x in $argv[1]/$argv[2]*
+        string replace -- $argv[1]/$argv[2] '' $x
+    end
+end
+
+function __rpoisel_state
+    # find the command, the argument position and an option awaiting its value
+    set -g __rpoisel_command ''
+    set -g __rpoisel_position 0
+    set -g __rpoisel_option ''
+    for word in (commandline -opc)[2..-1]
+        if test -n "$__rpoisel_option"
+            set __rpoisel_option ''
+            continue
+        end
+        if contains -- "$__rpoisel_command:$word" {value_options or "''"}
+            set __rpoisel_option "$__rpoisel_command:$word"
+        else if string match -q -- '-*' $word
+            continue
+        else if test -z "$__rpoisel_command"
+            switch $word
+{aliases}
+                case '*'
+                    set __rpoisel_command $word
+            end
+        else
+            set __rpoisel_position (math $__rpoisel_position + 1)
+        end
+    end
+end
+
+function __rpoisel_is
+    # completing for command, at an argument position such as 1, or 1+ for 1 and later
+    __rpoisel_state
+    test "$__rpoisel_command" = "$argv[1]"; or return 1
+    set -q argv[2]; or return 0
+    test -z "$__rpoisel_option"; or return 1
+    if string match -q -- '*+' $argv[2]
+        test $__rpoisel_position -ge (string trim -r -c + -- $argv[2])
+    else
+        test $__rpoisel_position -eq $argv[2]
+    end
+end
+
+complete -c {PROG} -f
+{completions}
+"""
+
+
+_GENERATORS = {Shell.bash: _bash, Shell.zsh: _zsh, Shell.fish: _fish}
+
+
+def generate(app: click.Command, shell: Shell, fingerprint: str) -> str:
+    return _GENERATORS[shell](CompletionTree.from_app(app), fingerprint)
+
+
+def _cache_dir() -> Path:
+    return xdg_path("cache", "rpoisel", "completion")
+
+
+def completion_script(app: click.Command, shell: Shell) -> str:
+    """Return the cached script, generated first if rpoisel changed since."""
+    current = source_fingerprint()
+    path = _cache_dir() / f"{current}.{shell.value}"
+    try:
+        return path.read_text()
+    except OSError:
+        pass
+    script = generate(app, shell, current)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    for stale in path.parent.glob(f"*.{shell.value}"):
+        stale.unlink(missing_ok=True)
+    temporary = path.with_name(f"{path.name}.tmp")
+    temporary.write_text(script)
+    temporary.replace(path)
+    return script
+
+
+def register(app: typer.Typer) -> None:
+    @app.command()
+    def completion(
+        ctx: typer.Context,
+        shell: Shell = typer.Argument(..., help="Shell to complete rpoisel in"),
+    ) -> None:
+        """Print a static shell completion script.
+
+        Install it, e.g. as ~/.local/share/bash-completion/completions/rpoisel
+        or ~/.config/fish/completions/rpoisel.fish. The zsh script is sourced
+        from ~/.zshrc after compinit, e.g. with source <(rpoisel completion zsh).
+        """
+        print(completion_script(ctx.find_root().command, shell), end="")
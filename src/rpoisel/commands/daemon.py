@@ -0,0 +1,236 @@
+import io
+import os
+import signal
+import socket
+import socketserver
+import sys
+import traceback
+from pathlib import Path
+from typing import Optional
+
+import click
+import typer
+
+from ..client import (
+    ACCEPT,
+    EXIT,
+    FALLBACK,
+    REQUEST,
+    STDERR,
+    STDIN,
+    STDOUT,
+    decode_request,
+    peer_uid,
+    recv_confirm,
+    recv_frame,
+    send_frame,
+    socket_path,
+)
+from ..util.cli import LazyGroup
+
+# clients send their request right after connecting, don't let a stalled one
+# hold up those behind it
+REQUEST_TIMEOUT = 1.0
+
+
+class _InputChannel(io.RawIOBase):
+    def __init__(self, conn: socket.socket, isatty: bool) -> None:
+        self._conn = conn
+        self._isatty = isatty
+        self._pending = b""
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def isatty(self) -> bool:
+        return self._isatty
+
+    def readinto(self, buffer) -> int:
+        while not self._pending and not self._eof:
+            frame = recv_frame(self._conn)
+            if frame is None or frame[0] != STDIN or not frame[1]:
+                self._eof = True
+            else:
+                self._pending = frame[1]
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+class _OutputChannel(io.RawIOBase):
+    def __init__(self, conn: socket.socket, channel: int) -> None:
+        self._conn = conn
+        self._channel = channel
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        send_frame(self._conn, self._channel, bytes(data))
+        return len(data)
+
+
+def _runs_in_daemon(cli: click.Command, argv: list[str]) -> bool:
+    # root options such as --profile-startup only make sense in-process
+    if not argv or argv[0].startswith("-") or not isinstance(cli, LazyGroup):
+        return False
+    try:
+        command = cli.get_command(click.Context(cli), argv[0])
+    except click.UsageError:
+        # let the regular invocation report the error
+        return True
+    entry = cli.lazy_commands.get(command.name or "") if command else None
+    if entry is None:
+        return True
+    return entry.daemon and not set(entry.in_process_args).intersection(argv[1:])
+
+
+def _invoke(cli: click.Command, argv: list[str]) -> int:
+    try:
+        cli.main(args=argv, prog_name="rpoisel", standalone_mode=True)
+    except SystemExit as exc:
+        if exc.code is None or isinstance(exc.code, int):
+            return exc.code or 0
+        print(exc.code, file=sys.stderr)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        assert isinstance(self.server, DaemonServer)
+        conn = self.request
+        # the request carries the environment of the client
+        if peer_uid(conn) != os.getuid():
+            return
+        conn.settimeout(REQUEST_TIMEOUT)
+        try:
+            frame = recv_frame(conn)
+            if frame is None or frame[0] != REQUEST:
+                return
+            request = decode_request(frame[1])
+            if not _runs_in_daemon(self.server.cli, request["argv"]):
+                send_frame(conn, FALLBACK)
+                return
+            send_frame(conn, ACCEPT)
+            # the client may have given up waiting and runs the command itself
+            fds = recv_confirm(conn)
+        except OSError:
+            return
+        if fds is None:
+            return
+        conn.settimeout(None)
+
+        stdin = io.TextIOWrapper(
+            io.BufferedReader(_InputChannel(conn, request["stdin_isatty"])),
+            encoding="utf-8",
+        )
+        stdout, stderr = (
+            io.TextIOWrapper(
+                io.BufferedWriter(_OutputChannel(conn, channel)),
+                encoding="utf-8",
+                line_buffering=True,
+            )
+            for channel in (STDOUT, STDERR)
+        )
+        saved_streams = sys.stdin, sys.stdout, sys.stderr
+        saved_env = dict(os.environ)
+        saved_cwd = os.getcwd()
+        # spawned processes write to the terminal of the client, not ours
+        saved_fds = [os.dup(fd) for fd in range(3)]
+        try:
+            for fd, client_fd in enumerate(fds):
+                os.dup2(client_fd, fd)
+            os.chdir(request["cwd"])
+            os.environ.clear()
+            os.environ.update(request["env"])
+            sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+            code = _invoke(self.server.cli, request["argv"])
+            stdout.flush()
+            stderr.flush()
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = saved_streams
+            os.environ.clear()
+            os.environ.update(saved_env)
+            os.chdir(saved_cwd)
+            for fd, saved_fd in enumerate(saved_fds):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+            for client_fd in fds:
+                os.close(client_fd)
+        send_frame(conn, EXIT, str(code).encode())
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    """Serves invocations one at a time with all command modules loaded."""
+
+    def __init__(self, path: Path, cli: click.Command) -> None:
+        self.cli = cli
+        if isinstance(cli, LazyGroup):
+            ctx = click.Context(cli)
+            for name in cli.list_commands(ctx):
+                cli.get_command(ctx, name)
+        super().__init__(str(path), _Handler)
+
+    def server_bind(self) -> None:
+        # only the owner may connect, not even until a chmod after binding
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+
+def _remove_stale_socket(path: Path) -> None:
+    if not path.exists():
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(str(path))
+        except ConnectionRefusedError:
+            path.unlink()
+            return
+    typer.secho(
+        f"Error: rpoisel daemon already listening on {path}.",
+        fg=typer.colors.RED,
+        err=True,
+    )
+    raise typer.Exit(code=1)
+
+
+def register(app: typer.Typer) -> None:
+    @app.command(name="daemon")
+    def daemon_command(
+        ctx: typer.Context,
+        path: Optional[Path] = typer.Option(
+            None,
+            "--socket",
+            help="Unix socket to listen on (default: per-user runtime dir)",
+        ),
+    ) -> None:
+        if path is None:
+            default = socket_path()
+            if default is None:
+                typer.secho(
+                    "Error: XDG_RUNTIME_DIR is not set, pass --socket.",
+                    fg=typer.colors.RED,
+                    err=True,
+                )
+                raise typer.Exit(code=1)
+            path = Path(default)
+        _remove_stale_socket(path)
+        cli = ctx.find_root().command
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        with DaemonServer(path, cli) as server:
+            print(f"rpoisel daemon listening on {path}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                path.unlink(missing_ok=True)
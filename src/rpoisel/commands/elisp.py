@@ -1,62 +1,333 @@
+import hashlib
+import re
 from abc import ABC, abstractmethod
-from typing import Union, override
+from pathlib import Path
+from typing import Optional, Union, override
 
 import click
 import typer
-import typer.main
+
+from ..util.cli import source_fingerprint, static_completions
+from ..util.xdg import xdg_path
+
+PROG = "rpoisel"
+
+# runs each command asynchronously, its output streams into a buffer of its own
+ELISP_PRELUDE = f"""\
+(require 'subr-x)
+
+(defvar rpoisel-program "{PROG}"
+  "Program run by the rpoisel commands.")
+
+(defun rpoisel--values (value)
+  "Return VALUE, a string, number or list of them, as non-empty strings."
+  (delete "" (mapcar (lambda (x) (format "%s" x))
+                     (if (listp value) value (list value)))))
+
+(defun rpoisel--glob (directory prefix)
+  "Return the names of the files in DIRECTORY starting with PREFIX, without it."
+  (mapcar (lambda (x) (substring x (length prefix)))
+          (ignore-errors
+            (directory-files directory nil
+                             (concat "\\\\`" (regexp-quote prefix) ".")))))
+
+(defun rpoisel--read-file (prompt)
+  "Read a file name with PROMPT, nil for an empty answer."
+  (let ((file (read-file-name prompt nil "")))
+    (unless (string-empty-p file)
+      (expand-file-name file))))
+
+(defun rpoisel--read-number (prompt)
+  "Read a number with PROMPT, nil for an empty answer."
+  (let ((number (string-trim (read-string prompt))))
+    (unless (string-empty-p number)
+      (string-to-number number))))
+
+(defun rpoisel--read-args (prompt)
+  "Read arguments quoted like in a shell with PROMPT."
+  (split-string-and-unquote (read-string prompt)))
+
+(defun rpoisel--filter (process output)
+  "Append OUTPUT of PROCESS to its buffer, following it where point is at the end."
+  (when (buffer-live-p (process-buffer process))
+    (with-current-buffer (process-buffer process)
+      (let ((inhibit-read-only t)
+            (follow (= (point) (process-mark process))))
+        (save-excursion
+          (goto-char (process-mark process))
+          (insert output)
+          (set-marker (process-mark process) (point)))
+        (when follow
+          (goto-char (process-mark process)))))))
+
+(defun rpoisel--sentinel (process event)
+  "Report the end of PROCESS with EVENT."
+  (unless (process-live-p process)
+    (message "%s: %s" (process-name process) (string-trim event))))
+
+(defun rpoisel--run (args)
+  "Run rpoisel with ARGS without blocking, showing its output in a buffer."
+  (let* ((name (string-join (cons "rpoisel" args) " "))
+         (buffer (get-buffer-create (format "*%s*" name))))
+    (when (get-buffer-process buffer)
+      (user-error "%s is still running" name))
+    (with-current-buffer buffer
+      (let ((inhibit-read-only t))
+        (erase-buffer))
+      (special-mode))
+    (display-buffer buffer)
+    (let ((process (make-process :name name
+                                 :buffer buffer
+                                 :command (cons rpoisel-program args)
+                                 :connection-type 'pipe
+                                 :noquery t
+                                 :filter #'rpoisel--filter
+                                 :sentinel #'rpoisel--sentinel)))
+      ;; nothing is typed into the process, commands reading stdin end
+      (process-send-eof process)
+      process)))
+"""
 
 
 class Visitor(ABC):
     @abstractmethod
-    def command(self, command: click.Command) -> None: ...
+    def command(self, command: click.Command, path: tuple[str, ...]) -> None:
+        """Visit a leaf command, path holds the names from the root group."""
 
 
-def visit_group(group: click.Group, visitor: Visitor, parent_name: str = "") -> None:
-    for name, command in group.commands.items():
+def visit_group(
+    group: click.Group,
+    visitor: Visitor,
+    parent_path: tuple[str, ...] = (),
+    parent: click.Context | None = None,
+) -> None:
+    # go through list_commands/get_command so lazily loaded commands are included
+    ctx = click.Context(group, info_name=group.name, parent=parent)
+    for name in group.list_commands(ctx):
+        command = group.get_command(ctx, name)
         if isinstance(command, click.Group):
-            visit_group(command, visitor, parent_name + name + "-")
-        else:
-            visitor.command(command)
+            visit_group(command, visitor, (*parent_path, name), ctx)
+        elif command is not None:
+            visitor.command(command, (*parent_path, name))
 
 
 def visit_app(app: Union[click.Group, click.Command], visitor: Visitor) -> None:
     if isinstance(app, click.Group):
         visit_group(app, visitor)
     else:
-        visitor.command(app)
+        visitor.command(app, ())
+
+
+def _string(value: str) -> str:
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _symbol(name: str) -> str:
+    return re.sub(r"[^a-z0-9-]", "-", name.lower().replace("_", "-"))
+
+
+def _choices(param: click.Parameter) -> list[str]:
+    if not isinstance(param.type, click.Choice):
+        return []
+    return [str(getattr(x, "value", x)) for x in param.type.choices]
+
+
+def _collection(ctx: click.Context, param: click.Parameter) -> str | None:
+    """Return the form listing the completions of param, None without any."""
+    words, globs = static_completions(ctx, param)
+    forms = [f"'({' '.join(_string(x) for x in words)})"] if words else []
+    forms += [
+        f"(rpoisel--glob {_string(str(x.directory))} {_string(x.prefix)})"
+        for x in globs
+    ]
+    if len(forms) > 1:
+        return f"(append {' '.join(forms)})"
+    return forms[0] if forms else None
+
+
+def _reader(ctx: click.Context, param: click.Parameter) -> str:
+    """Return the form reading a value for param in the minibuffer."""
+    label = (param.name or "value").replace("_", " ").capitalize()
+    collection = _collection(ctx, param)
+    if param.nargs == -1 or getattr(param, "multiple", False):
+        return (
+            f"(completing-read-multiple {_string(label + ': ')} {collection or 'nil'})"
+        )
+    if isinstance(param, click.Option) and param.is_flag:
+        return f"(y-or-n-p {_string(label + '? ')})"
+    if collection:
+        # only choices are enforced, other completions are suggestions
+        require = " nil t" if _choices(param) else ""
+        return f"(completing-read {_string(label + ': ')} {collection}{require})"
+    # the readers return nil for an empty answer, which leaves out the option
+    if isinstance(param.type, click.Path):
+        return f"(rpoisel--read-file {_string(label + ': ')})"
+    if isinstance(param.type, (click.types.IntParamType, click.types.FloatParamType)):
+        return f"(rpoisel--read-number {_string(label + ': ')})"
+    return f"(read-string {_string(label + ': ')})"
+
+
+def _argv(param: click.Parameter, symbol: str) -> str:
+    """Return the form turning the value of symbol into command line arguments."""
+    if isinstance(param, click.Argument):
+        return f"(rpoisel--values {symbol})"
+    assert isinstance(param, click.Option), "parameters are arguments or options"
+    if param.is_flag:
+        return f"(when {symbol} '({_string(param.opts[0])}))"
+    return (
+        f"(when-let* ((value (rpoisel--values {symbol})))"
+        f" (cons {_string(param.opts[0])} value))"
+    )
 
 
 class ElispVisitor(Visitor):
-    def __init__(self) -> None:
+    """Emacs commands running rpoisel asynchronously.
+
+    Arguments are read in the minibuffer, options only with a prefix argument.
+    """
+
+    def __init__(self, exclude: tuple[tuple[str, ...], ...] = ()) -> None:
+        self._exclude = exclude
         self._code: list[str] = []
 
     @override
-    def command(self, command: click.Command) -> None:
-        if command.name == "elisp":  # TODO determine command name from invoking command
+    def command(self, command: click.Command, path: tuple[str, ...]) -> None:
+        if path in self._exclude:
             return
-        self._code.append(f"(defun {command.name}-command ()")
-
-        param_desc = "\n".join(
-            [f"{param.name}, {param.type}" for param in command.params]
+        ctx = click.Context(
+            command, info_name=path[-1] if path else PROG, **command.context_settings
         )
+        help_option = command.get_help_option(ctx)
+        params = [
+            x
+            for x in command.get_params(ctx)
+            if x is not help_option and x.name and not getattr(x, "hidden", False)
+        ]
+        required = [x for x in params if isinstance(x, click.Argument) and x.required]
+        optional = [x for x in params if x not in required]
+        symbols = {x: _symbol(x.name or "") for x in params}
+        # commands taking further arguments, e.g. the files of `print`, get
+        # them as a list
+        extra = ["args"] if ctx.allow_extra_args else []
 
-        self._code.append(f"""  "Run the {command.name} command.
+        signature = [*(symbols[x] for x in required), *extra]
+        if optional:
+            signature += ["&optional", *(symbols[x] for x in optional)]
+        docs = []
+        for x in params:
+            text = getattr(x, "help", None) or x.metavar or ""
+            line = f"{symbols[x].upper()}: {text}"
+            if choices := _choices(x):
+                line += f" ({'|'.join(choices)})"
+            docs.append(line.rstrip())
+        docs += [f"{x.upper()}: further arguments, split like a shell" for x in extra]
+        doc = command.help or f"Run {' '.join((PROG, *path))}."
+        if docs:
+            doc += "\n\n" + "\n".join(docs)
+        readers = [
+            *(_reader(ctx, x) for x in required),
+            *('(rpoisel--read-args "Arguments: ")' for _ in extra),
+            *(
+                f"(and current-prefix-arg {_reader(ctx, x)})"
+                if isinstance(x, click.Option)
+                else _reader(ctx, x)
+                for x in optional
+            ),
+        ]
+        argv = [
+            f"'({' '.join(_string(x) for x in path)})",
+            *(_argv(x, symbols[x]) for x in params),
+            *extra,
+        ]
 
-Parameters:
-{param_desc}"
-""")
-        self._code.append("  (interactive)")
-        self._code.append(f'  (shell-command "{command.name}"))')
+        name = "-".join([PROG, *(_symbol(x) for x in path)])
+        self._code.append(f"(defun {name} ({' '.join(signature)})")
+        self._code.append(f"  {_string(doc.strip())}")
+        if readers:
+            self._code.append("  (interactive")
+            self._code.append("   (list " + "\n         ".join(readers) + "))")
+        else:
+            self._code.append("  (interactive)")
+        self._code.append("  (rpoisel--run")
+        self._code.append("   (append " + "\n           ".join(argv) + ")))")
         self._code.append("")
 
     def spit(self) -> str:
-        return "\n".join(self._code).strip()
+        return "\n".join([ELISP_PRELUDE, *self._code]).strip()
+
+
+def _header(content_hash: str) -> str:
+    return (
+        f";;; {PROG}.el --- Emacs commands for {PROG}  -*- lexical-binding: t -*-\n"
+        f";; generated by `{PROG} elisp`, content {content_hash}\n"
+    )
+
+
+def _recorded_hash(path: Path) -> str | None:
+    try:
+        with path.open() as output:
+            output.readline()
+            line = output.readline()
+    except (OSError, UnicodeDecodeError):
+        return None
+    return line.rsplit(" ", 1)[-1].strip() or None
+
+
+def _sources_path(path: Path) -> Path:
+    key = hashlib.sha256(str(path.resolve()).encode()).hexdigest()[:16]
+    return xdg_path("cache", "rpoisel", "elisp", key)
+
+
+def write_elisp(root: click.Command, path: Path, exclude=()) -> bool:
+    """Generate the commands into path unless they are current, return if written.
+
+    Sources unchanged since the last run skip generating, unchanged commands
+    skip writing, so Emacs can call this on every start.
+    """
+    fingerprint = source_fingerprint()
+    sources = _sources_path(path)
+    try:
+        if path.exists() and sources.read_text() == fingerprint:
+            return False
+    except OSError:
+        pass
+    visitor = ElispVisitor(exclude)
+    visit_app(root, visitor)
+    code = visitor.spit() + "\n"
+    content_hash = hashlib.sha256(code.encode()).hexdigest()[:16]
+    written = _recorded_hash(path) != content_hash
+    if written:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = path.with_name(f"{path.name}.tmp")
+        temporary.write_text(_header(content_hash) + "\n" + code)
+        temporary.replace(path)
+    sources.parent.mkdir(parents=True, exist_ok=True)
+    sources.write_text(fingerprint)
+    return written
 
 
 def register(app: typer.Typer) -> None:
     @app.command()
-    def elisp() -> None:
-        visitor = ElispVisitor()
-        cli = typer.main.get_command(app)
-        visit_app(cli, visitor)
+    def elisp(
+        ctx: typer.Context,
+        output: Optional[Path] = typer.Option(
+            None,
+            "--output",
+            "-o",
+            help="File to write, only when the commands changed",
+        ),
+    ) -> None:
+        """Generate Emacs Lisp commands running rpoisel asynchronously.
+
+        E.g. in init.el: (call-process "rpoisel" nil nil nil "elisp" "-o" FILE)
+        followed by (load FILE).
+        """
+        # the commands run from Emacs, not this one generating them
+        exclude = (tuple(ctx.command_path.split()[1:]),)
+        root = ctx.find_root().command
+        if output is not None:
+            write_elisp(root, output, exclude)
+            return
+        visitor = ElispVisitor(exclude)
+        visit_app(root, visitor)
         print(visitor.spit())
@@ -1,12 +1,21 @@
 import getpass
+import lzma
 import os
 import platform
+import struct
 import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
+from typing import Any, Callable
 
 import typer
 
+MODULES_BASE = Path("/lib/modules")
 MOK_PRIVATE_KEY = Path("/var/lib/shim-signed/mok/MOK.priv")
 MOK_CERTIFICATE = Path("/var/lib/shim-signed/mok/MOK.der")
 
@@ -15,9 +24,213 @@ class ModulesCommand(str, Enum):
     sign = "sign"
 
 
-def _sign_modules(modules_dir: Path, pattern: str, sign_file: Path) -> None:
-    passphrase = getpass.getpass("Passphrase for the private key: ")
-    env = {**os.environ, "KBUILD_SIGN_PIN": passphrase}
+# appended to signed modules, preceded by struct module_signature
+SIGNATURE_MAGIC = b"~Module signature appended~\n"
+# algo, hash, id_type, signer_len, key_id_len, 3 bytes padding, sig_len
+_MODULE_SIGNATURE = struct.Struct(">BBBBB3xI")
+_CHUNK_SIZE = 1024 * 1024
+# PKCS#7 signatures are a few hundred bytes, this leaves plenty of room
+_TAIL_SIZE = 64 * 1024
+# same as `xz --check=crc32 --lzma2=dict=512KiB`
+_XZ_OPTIONS: dict[str, Any] = {
+    "format": lzma.FORMAT_XZ,
+    "check": lzma.CHECK_CRC32,
+    "filters": [{"id": lzma.FILTER_LZMA2, "preset": 6, "dict_size": 512 * 1024}],
+}
+
+
+@dataclass
+class _Inspection:
+    size: int
+    duration: float
+    signature_size: int = 0
+    # the PKCS#7 blob of an appended signature, if it could be read
+    signature: bytes = b""
+
+    @property
+    def unsigned_size(self) -> int:
+        if not self.signature_size:
+            return self.size
+        return (
+            self.size
+            - len(SIGNATURE_MAGIC)
+            - _MODULE_SIGNATURE.size
+            - self.signature_size
+        )
+
+    def signed_by(self, signer: bytes) -> bool:
+        return signer in self.signature
+
+
+@dataclass
+class _SignResult:
+    module: Path
+    output: str = ""
+    durations: dict[str, float] = field(default_factory=dict)
+    error: str | None = None
+
+
+def _der_header(data: bytes, offset: int) -> tuple[int, int, int]:
+    """Return tag, start and end of the content of the DER element at offset."""
+    tag, length = data[offset], data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        count = length & 0x7F
+        length = int.from_bytes(data[offset : offset + count])
+        offset += count
+    if offset + length > len(data):
+        raise ValueError("truncated DER element")
+    return tag, offset, offset + length
+
+
+def _der_sequence(content: bytes) -> bytes:
+    if len(content) < 0x80:
+        return bytes([0x30, len(content)]) + content
+    length = len(content).to_bytes((len(content).bit_length() + 7) // 8)
+    return bytes([0x30, 0x80 | len(length)]) + length + content
+
+
+def _issuer_and_serial(certificate: bytes) -> bytes:
+    """Return the DER IssuerAndSerialNumber naming the certificate's key.
+
+    PKCS#7 module signatures identify their signer this way, so a module was
+    signed with the certificate's key if its signature contains these bytes.
+    """
+    _, offset, _ = _der_header(certificate, 0)  # Certificate
+    _, offset, _ = _der_header(certificate, offset)  # TBSCertificate
+    tag, _, end = _der_header(certificate, offset)
+    if tag == 0xA0:  # explicit version
+        offset = end
+    _, _, serial_end = _der_header(certificate, offset)
+    _, _, algorithm_end = _der_header(certificate, serial_end)
+    _, _, issuer_end = _der_header(certificate, algorithm_end)
+    return _der_sequence(
+        certificate[algorithm_end:issuer_end] + certificate[offset:serial_end]
+    )
+
+
+def _mok_signer() -> bytes | None:
+    try:
+        return _issuer_and_serial(MOK_CERTIFICATE.read_bytes())
+    except (OSError, ValueError, IndexError) as exc:
+        typer.secho(
+            f"Warning: cannot read {MOK_CERTIFICATE} ({exc}), signing all modules.",
+            fg=typer.colors.YELLOW,
+            err=True,
+        )
+        return None
+
+
+def _inspect_module(module_xz: Path) -> _Inspection | None:
+    start = time.perf_counter()
+    size = 0
+    tail = b""
+    try:
+        with lzma.open(module_xz) as module:
+            while chunk := module.read(_CHUNK_SIZE):
+                size += len(chunk)
+                tail = (tail + chunk)[-_TAIL_SIZE:]
+    except (OSError, lzma.LZMAError):
+        # signing will run into the same problem and report it
+        return None
+    inspection = _Inspection(size, time.perf_counter() - start)
+    if not tail.endswith(SIGNATURE_MAGIC):
+        return inspection
+    info_end = len(tail) - len(SIGNATURE_MAGIC)
+    signature_end = info_end - _MODULE_SIGNATURE.size
+    if signature_end < 0:
+        return inspection
+    *_, signature_size = _MODULE_SIGNATURE.unpack(tail[signature_end:info_end])
+    # the trailer is part of the file, a forged size must not truncate the module
+    if signature_size > size - len(tail) + signature_end:
+        return inspection
+    inspection.signature_size = signature_size
+    if inspection.signature_size <= signature_end:
+        inspection.signature = tail[
+            signature_end - inspection.signature_size : signature_end
+        ]
+    return inspection
+
+
+def _decompress(module_xz: Path, module_ko: Path, size: int) -> None:
+    with lzma.open(module_xz) as source, module_ko.open("wb") as target:
+        while size > 0 and (chunk := source.read(min(_CHUNK_SIZE, size))):
+            target.write(chunk)
+            size -= len(chunk)
+
+
+def _compress(module_ko: Path, module_xz: Path) -> None:
+    with (
+        module_ko.open("rb") as source,
+        lzma.open(module_xz, "wb", **_XZ_OPTIONS) as target,
+    ):
+        while chunk := source.read(_CHUNK_SIZE):
+            target.write(chunk)
+
+
+def _sign_module(
+    module_xz: Path,
+    inspection: _Inspection | None,
+    sign_file: Path,
+    env: dict[str, str],
+    workdir: Path,
+) -> _SignResult:
+    # work on private copies, only the final install needs root
+    work_ko = Path(tempfile.mkdtemp(dir=workdir)) / module_xz.stem
+    work_xz = work_ko.with_name(work_ko.name + ".xz")
+    # an existing signature is stripped so it is replaced instead of stacked
+    size = inspection.unsigned_size if inspection else sys.maxsize
+    stages: list[tuple[str, Callable[[], subprocess.CompletedProcess | None]]] = [
+        ("decompress", lambda: _decompress(module_xz, work_ko, size)),
+        (
+            "sign",
+            lambda: subprocess.run(
+                [
+                    "sudo",
+                    "--preserve-env=KBUILD_SIGN_PIN",
+                    str(sign_file),
+                    "sha256",
+                    str(MOK_PRIVATE_KEY),
+                    str(MOK_CERTIFICATE),
+                    str(work_ko),
+                ],
+                capture_output=True,
+                text=True,
+                env=env,
+            ),
+        ),
+        ("compress", lambda: _compress(work_ko, work_xz)),
+        (
+            "install",
+            lambda: subprocess.run(
+                ["sudo", "install", "-m", "0644", str(work_xz), str(module_xz)],
+                capture_output=True,
+                text=True,
+            ),
+        ),
+    ]
+    result = _SignResult(module_xz)
+    for stage, run in stages:
+        start = time.perf_counter()
+        try:
+            completed = run()
+        except (OSError, lzma.LZMAError) as exc:
+            result.error = f"{stage} failed ({exc})"
+            break
+        finally:
+            result.durations[stage] = time.perf_counter() - start
+        if completed is None:
+            continue
+        result.output += completed.stdout + completed.stderr
+        if completed.returncode != 0:
+            result.error = f"{stage} failed (returncode={completed.returncode})"
+            break
+    return result
+
+
+def _sign_modules(
+    modules_dir: Path, pattern: str, sign_file: Path, jobs: int, force: bool
+) -> None:
     matched = sorted(modules_dir.rglob(pattern))
     if not matched:
         typer.secho(
@@ -26,34 +239,61 @@ def _sign_modules(modules_dir: Path, pattern: str, sign_file: Path) -> None:
             err=True,
         )
         raise typer.Exit(code=1)
-    for module_xz in matched:
-        print(f"Signing {module_xz}")
-        module_ko = module_xz.with_suffix("")  # strip .xz
-        subprocess.run(["sudo", "xz", "-d", str(module_xz)], check=True)
-        subprocess.run(
-            [
-                "sudo",
-                "--preserve-env=KBUILD_SIGN_PIN",
-                str(sign_file),
-                "sha256",
-                str(MOK_PRIVATE_KEY),
-                str(MOK_CERTIFICATE),
-                str(module_ko),
-            ],
-            check=True,
-            env=env,
-        )
-        subprocess.run(
-            [
-                "sudo",
-                "xz",
-                "-f",
-                "--check=crc32",
-                "--lzma2=dict=512KiB",
-                str(module_ko),
-            ],
-            check=True,
-        )
+
+    start = time.perf_counter()
+    signer = None if force else _mok_signer()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        inspections = list(pool.map(_inspect_module, matched))
+    stage_totals = {"inspect": sum(x.duration for x in inspections if x)}
+    pending: list[tuple[Path, _Inspection | None]] = []
+    for module_xz, inspection in zip(matched, inspections):
+        if signer and inspection and inspection.signed_by(signer):
+            print(f"Skipping {module_xz} (already signed with {MOK_CERTIFICATE.name})")
+        else:
+            pending.append((module_xz, inspection))
+
+    failed: list[_SignResult] = []
+    if pending:
+        passphrase = getpass.getpass("Passphrase for the private key: ")
+        env = {**os.environ, "KBUILD_SIGN_PIN": passphrase}
+        # ask for the sudo password once instead of from every worker
+        try:
+            subprocess.run(["sudo", "-v"], check=True)
+        except subprocess.CalledProcessError:
+            typer.secho(
+                "Error: sudo authentication failed.", fg=typer.colors.RED, err=True
+            )
+            raise typer.Exit(code=1)
+        with (
+            tempfile.TemporaryDirectory(prefix="rpoisel-modules-") as workdir,
+            ThreadPoolExecutor(max_workers=jobs) as pool,
+        ):
+            # map() yields in submission order, so output stays grouped per module
+            for result in pool.map(
+                lambda x: _sign_module(*x, sign_file, env, Path(workdir)), pending
+            ):
+                print(f"Signing {result.module}")
+                if result.output:
+                    print(result.output, end="")
+                for stage, duration in result.durations.items():
+                    stage_totals[stage] = stage_totals.get(stage, 0.0) + duration
+                if result.error:
+                    failed.append(result)
+
+    stages = ", ".join(f"{k} {v:.2f}s" for k, v in stage_totals.items())
+    print(
+        f"Signed {len(pending) - len(failed)}/{len(matched)} modules, "
+        f"skipped {len(matched) - len(pending)}, "
+        f"in {time.perf_counter() - start:.2f}s with {jobs} jobs ({stages})"
+    )
+    if failed:
+        for result in failed:
+            typer.secho(
+                f"Error: {result.module}: {result.error}",
+                fg=typer.colors.RED,
+                err=True,
+            )
+        raise typer.Exit(code=1)
 
 
 def register(app: typer.Typer) -> None:
@@ -64,11 +304,21 @@ def register(app: typer.Typer) -> None:
             default="v4l2loopback*.ko.xz",
             help="Glob pattern to match module files (e.g. 'v4l2loopback*.ko.xz')",
         ),
+        jobs: int = typer.Option(
+            os.cpu_count() or 1,
+            "--jobs",
+            "-j",
+            min=1,
+            help="Number of modules to process in parallel",
+        ),
+        force: bool = typer.Option(
+            False, help="Re-sign modules already signed with the MOK key"
+        ),
     ) -> None:
         version = platform.release()
-        modules_dir = Path(f"/lib/modules/{version}")
+        modules_dir = MODULES_BASE / version
         kbuild_dir = Path(f"/usr/src/linux-headers-{version}")
         sign_file = kbuild_dir / "scripts" / "sign-file"
 
         if command == ModulesCommand.sign:
-            _sign_modules(modules_dir, pattern, sign_file)
+            _sign_modules(modules_dir, pattern, sign_file, jobs, force)
@@ -1,13 +1,27 @@
+import fcntl
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
 from enum import Enum
-from ipaddress import IPv4Address
+from functools import cache
+from pathlib import Path
+from typing import Generator
 
 import httpx
 import typer
 
+from .. import trace
+from ..util.xdg import xdg_path
+
 
 class PowerEndpoint(str, Enum):
     mic = "mic"
     other = "other"
+    # groups
+    all = "all"
 
 
 class PowerState(str, Enum):
@@ -15,12 +29,186 @@ class PowerState(str, Enum):
     off = "off"
 
 
+IP_MAPPING: dict[PowerEndpoint, str] = {
+    PowerEndpoint.mic: "192.168.87.67",
+    PowerEndpoint.other: "192.168.87.18",
+}
+GROUPS: dict[PowerEndpoint, list[PowerEndpoint]] = {
+    PowerEndpoint.all: [PowerEndpoint.mic, PowerEndpoint.other],
+}
+
+# the relays answer within milliseconds when they are reachable at all
+CONNECT_TIMEOUT = 1.0
+READ_TIMEOUT = 2.0
+RETRIES = 2
+# the relays can also be switched by hand or from their web UI, so a known
+# state is only trusted for a short while
+STATE_CACHE_TTL = 30.0
+
+
+@dataclass
+class _RelayResult:
+    endpoint: PowerEndpoint
+    duration: float
+    ison: bool | None = None
+    error: str | None = None
+
+
+@cache
+def _http_client() -> httpx.Client:
+    # kept for the lifetime of the process so `rpoisel daemon` reuses connections
+    return httpx.Client(
+        limits=httpx.Limits(max_keepalive_connections=len(IP_MAPPING)),
+        transport=httpx.HTTPTransport(retries=RETRIES),
+    )
+
+
+def _state_cache_path() -> Path:
+    return xdg_path("cache", "rpoisel", "power-state.json")
+
+
+@contextmanager
+def _locked_state_cache() -> Generator[dict[str, dict]]:
+    """Yield the cached relay states, written back when the block exits."""
+    path = _state_cache_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a+") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        file.seek(0)
+        try:
+            states = json.loads(file.read() or "{}")
+        except ValueError:
+            states = {}
+        yield states
+        file.seek(0)
+        file.truncate()
+        json.dump(states, file)
+
+
+def _is_cached(entry: dict | None, state: PowerState, now: float) -> bool:
+    return (
+        entry is not None
+        and entry["ison"] == (state == PowerState.on)
+        and now - entry["checked"] < STATE_CACHE_TTL
+    )
+
+
+def _resolve(endpoints: list[PowerEndpoint]) -> list[PowerEndpoint]:
+    resolved: list[PowerEndpoint] = []
+    for endpoint in endpoints:
+        for member in GROUPS.get(endpoint, [endpoint]):
+            if member not in resolved:
+                resolved.append(member)
+    return resolved
+
+
+def _request(
+    client: httpx.Client, endpoint: PowerEndpoint, state: PowerState | None
+) -> _RelayResult:
+    """Switch the relay of endpoint to state, or only query it without state."""
+    start = time.perf_counter()
+    timeout = httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+    url = f"http://{IP_MAPPING[endpoint]}/relay/0"
+    params = {"turn": state.value} if state else {}
+    # the transport retries failed connects, anything else is reported right away
+    try:
+        with trace.span(f"GET {endpoint.value}", url=url, params=params) as span:
+            response = client.get(url, params=params, timeout=timeout)
+            span.set(status=response.status_code)
+            response.raise_for_status()
+            ison = bool(response.json()["ison"])
+    except (httpx.HTTPError, ValueError, KeyError) as exc:
+        error = f"{type(exc).__name__}: {exc}"
+        return _RelayResult(endpoint, time.perf_counter() - start, error=error)
+    return _RelayResult(endpoint, time.perf_counter() - start, ison)
+
+
+def _request_all(
+    endpoints: list[PowerEndpoint], state: PowerState | None
+) -> list[_RelayResult]:
+    if not endpoints:
+        return []
+    # created up front, the workers would race to create one each
+    client = _http_client()
+    with ThreadPoolExecutor(max_workers=len(endpoints)) as pool:
+        results = list(pool.map(lambda x: _request(client, x, state), endpoints))
+    now = time.time()
+    with _locked_state_cache() as states:
+        for result in results:
+            if result.error:
+                states.pop(result.endpoint.value, None)
+            else:
+                states[result.endpoint.value] = {"ison": result.ison, "checked": now}
+    return results
+
+
+def _report(results: list[_RelayResult]) -> None:
+    for result in results:
+        if result.error:
+            print(f"{result.endpoint.value}: {result.error}", file=sys.stderr)
+        else:
+            print(
+                f"{result.endpoint.value}: {'on' if result.ison else 'off'} "
+                f"({result.duration * 1000:.0f} ms)"
+            )
+    if any(x.error for x in results):
+        raise typer.Exit(code=1)
+
+
+def _parse_endpoints(names: list[str]) -> list[PowerEndpoint]:
+    try:
+        return _resolve([PowerEndpoint(x) for x in names])
+    except ValueError as exc:
+        choices = ", ".join(x.value for x in PowerEndpoint)
+        typer.secho(
+            f"Error: {exc}, choose from {choices}.", fg=typer.colors.RED, err=True
+        )
+        raise typer.Exit(code=1)
+
+
+def _complete_args(incomplete: str) -> list[str]:
+    words = [
+        "status",
+        *(x.value for x in PowerEndpoint),
+        *(x.value for x in PowerState),
+    ]
+    return [x for x in words if x.startswith(incomplete)]
+
+
 def register(app: typer.Typer) -> None:
     @app.command()
-    def power(endpoint: PowerEndpoint, state: PowerState) -> None:
-        IP_MAPPING: dict[PowerEndpoint, IPv4Address] = {
-            PowerEndpoint.mic: IPv4Address("192.168.87.67"),
-            PowerEndpoint.other: IPv4Address("192.168.87.18"),
-        }
-        ip = IP_MAPPING[endpoint]
-        httpx.get(f"http://{ip}/relay/0?turn={state.value}")
+    def power(
+        args: list[str] = typer.Argument(
+            ...,
+            metavar="ENDPOINT... on|off | status [ENDPOINT...]",
+            autocompletion=_complete_args,
+        ),
+        force: bool = typer.Option(
+            False, "--force", help="Switch even if the relay is known to be in state"
+        ),
+    ) -> None:
+        """Switch relays or query their state, all endpoints at once."""
+        if args[0] == "status":
+            _report(_request_all(_parse_endpoints(args[1:] or ["all"]), None))
+            return
+
+        if len(args) < 2 or args[-1] not in [x.value for x in PowerState]:
+            typer.secho(
+                "Error: expected endpoints followed by 'on' or 'off'.",
+                fg=typer.colors.RED,
+                err=True,
+            )
+            raise typer.Exit(code=1)
+        state = PowerState(args[-1])
+        endpoints = _parse_endpoints(args[:-1])
+
+        now = time.time()
+        with _locked_state_cache() as states:
+            cached = [
+                x
+                for x in endpoints
+                if not force and _is_cached(states.get(x.value), state, now)
+            ]
+        for endpoint in cached:
+            print(f"{endpoint.value}: {state.value} (cached)")
+        _report(_request_all([x for x in endpoints if x not in cached], state))
@@ -1,63 +1,396 @@
+import fcntl
+import hashlib
+import json
+import os
 import shlex
 import subprocess
 import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
 from pathlib import Path
+from typing import BinaryIO, Callable, Generator, TextIO
 from uuid import uuid4
 
 import typer
 
-from ..util.process import run_shell_check
+from ..util.process import run
+from ..util.xdg import xdg_path
 
 REMOTE_HOST = "user@acme-vm"
-REMOTE_TMP_DIR = "/tmp"
 REMOTE_PRINTER = "Samsung_M2020_Series"
+# documents are kept by content hash, relative paths are below the remote home
+REMOTE_CACHE_DIR = ".cache/rpoisel/print"
+# least recently printed documents are evicted beyond this size
+REMOTE_CACHE_SIZE = 512 * 1024 * 1024
+# job ids of detached submissions, picked up by `print status`
+REMOTE_JOBS_DIR = ".cache/rpoisel/print-jobs"
+# how long the shared SSH connection stays open after its last use
+SSH_CONTROL_PERSIST = "10m"
+SSH_CONTROL_PERSIST_ENV_VAR = "RPOISEL_SSH_CONTROL_PERSIST"
+
+# print options are given as for lpr, these are their lp spellings
+_LPR_OPTIONS = {
+    "-P": "-d",
+    "-#": "-n",
+    "-C": "-t",
+    "-J": "-t",
+    "-T": "-t",
+    "-o": "-o",
+    "-U": "-U",
+    "-H": "-h",
+}
+_LPR_FLAGS = {
+    "-E": ["-E"],
+    "-h": ["-o", "job-sheets=none"],
+    "-l": ["-o", "raw"],
+    "-p": ["-o", "prettyprint"],
+    "-q": ["-H", "hold"],
+}
+
+PDF_MAGIC = b"%PDF-"
+_CHUNK_SIZE = 1024 * 1024
 
 
 def _is_pdf(data: bytes) -> bool:
-    return data.startswith(b"%PDF-")
+    return data.startswith(PDF_MAGIC)
 
 
-def _read_pdf(path: Path) -> bytes:
+def _pdf_error(path: Path) -> str | None:
     if not path.exists() or not path.is_file():
-        typer.secho(
-            f"Error: file not found: {path}",
-            fg=typer.colors.RED,
-            err=True,
-        )
-        raise typer.Exit(code=1)
+        return f"file not found: {path}"
+    with path.open("rb") as pdf:
+        header = pdf.read(len(PDF_MAGIC))
+    if not _is_pdf(header):
+        return f"file is not a valid PDF: {path}"
+    return None
+
+
+@dataclass
+class _Upload:
+    path: Path
+    size: int
+    digest: str = ""
+    cached: bool = False
+    transferred: int = 0
+    duration: float = 0.0
+    error: str | None = None
+
+    @property
+    def remote_path(self) -> str:
+        return f"{REMOTE_CACHE_DIR}/{self.digest}.pdf"
+
+
+@dataclass
+class _Job:
+    files: list[str]
+    # names the remote file a detached submission writes the job id to
+    ticket: str = field(default_factory=lambda: uuid4().hex)
+    submitted: float = field(default_factory=time.time)
+    id: str | None = None
+
+
+def _journal_path() -> Path:
+    return xdg_path("state", "rpoisel", "print-jobs.jsonl")
+
+
+@contextmanager
+def _locked_journal() -> Generator[TextIO]:
+    # scripts print from several processes at once, none may lose a job
+    path = _journal_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a+") as journal:
+        fcntl.flock(journal, fcntl.LOCK_EX)
+        journal.seek(0)
+        yield journal
 
-    data = path.read_bytes()
-    if not _is_pdf(data):
-        typer.secho(
-            f"Error: file is not a valid PDF: {path}",
-            fg=typer.colors.RED,
-            err=True,
-        )
-        raise typer.Exit(code=1)
-    return data
 
+def _journal_add(job: _Job) -> None:
+    with _locked_journal() as journal:
+        journal.write(json.dumps(asdict(job)) + "\n")
 
-def _build_remote_print_cmd(
-    remote_path: str, extra_args: list[str], cleanup: bool
-) -> str:
-    lpr_cmd = " ".join(
-        shlex.quote(part)
-        for part in ["lpr", "-P", REMOTE_PRINTER, *extra_args, remote_path]
+
+def _journal_read() -> list[_Job]:
+    with _locked_journal() as journal:
+        return [_Job(**json.loads(x)) for x in journal if x.strip()]
+
+
+def _journal_update(
+    resolved: dict[str, str], finished: set[str], removed: set[str]
+) -> None:
+    """Record job ids of tickets and drop finished tickets and removed job ids."""
+    with _locked_journal() as journal:
+        jobs = [_Job(**json.loads(x)) for x in journal if x.strip()]
+        journal.seek(0)
+        journal.truncate()
+        for job in jobs:
+            job.id = job.id or resolved.get(job.ticket)
+            if job.ticket not in finished and job.id not in removed:
+                journal.write(json.dumps(asdict(job)) + "\n")
+
+
+def _ssh_cmd(remote_cmd: str) -> list[str]:
+    """Return the ssh invocation running remote_cmd on REMOTE_HOST.
+
+    All invocations share one master connection, so only the first one in
+    SSH_CONTROL_PERSIST pays for the handshake and authentication.
+    """
+    persist = os.environ.get(SSH_CONTROL_PERSIST_ENV_VAR, SSH_CONTROL_PERSIST)
+    return [
+        "ssh",
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        # %C is a hash of the local host, remote host, port and user
+        f"ControlPath={xdg_path('runtime', 'rpoisel-ssh-%C')}",
+        "-o",
+        f"ControlPersist={persist}",
+        REMOTE_HOST,
+        remote_cmd,
+    ]
+
+
+def _ssh(remote_cmd: str) -> str:
+    """Run remote_cmd on REMOTE_HOST and return its output."""
+    # in our process group, so ssh can ask for a passphrase on the terminal
+    return run(
+        _ssh_cmd(remote_cmd),
+        timeout=None,
+        interactive=True,
+        on_stderr=lambda line: print(line, file=sys.stderr),
+    ).stdout
+
+
+def _lp_args(lpr_args: list[str]) -> list[str]:
+    """Translate lpr options to lp, which reports the id of the job it queues.
+
+    Raises ValueError for options without an lp equivalent.
+    """
+    destination = REMOTE_PRINTER
+    lp_args: list[str] = []
+    args = iter(lpr_args)
+    for arg in args:
+        option, value = arg[:2], arg[2:]
+        if option in _LPR_FLAGS and not value:
+            lp_args += _LPR_FLAGS[option]
+            continue
+        if option not in _LPR_OPTIONS:
+            raise ValueError(f"unsupported lpr option: {arg}")
+        value = value or next(args, "")
+        if not value:
+            raise ValueError(f"lpr option {option} needs a value")
+        if option == "-P":
+            destination = value
+        else:
+            lp_args += [_LPR_OPTIONS[option], value]
+    return ["-d", destination, *lp_args]
+
+
+def _build_remote_print_cmd(remote_paths: list[str], lp_args: list[str]) -> str:
+    """Return the remote lp command, printing stdin without remote_paths."""
+    return " ".join(shlex.quote(part) for part in ["lp", *lp_args, *remote_paths])
+
+
+def _build_remote_submit_cmd(remote_paths: list[str], lp_args: list[str]) -> str:
+    """Return a command running lp and printing the id of the new job."""
+    lp_cmd = _build_remote_print_cmd(remote_paths, lp_args)
+    # lp reports "request id is <printer>-<n> (1 file(s))", the assignment
+    # keeps its exit status
+    job_id_cmd = (
+        f"request=$({lp_cmd}) && "
+        "echo \"$request\" | sed -n 's/^request id is \\([^ ]*\\).*/\\1/p'"
+    )
+    if not remote_paths:
+        return job_id_cmd
+    return f"{job_id_cmd} && {_build_remote_evict_cmd()}"
+
+
+def _build_remote_detach_cmd(submit_cmd: str, ticket: str) -> str:
+    """Return a command running submit_cmd in the background.
+
+    The job id goes to a ticket file below REMOTE_JOBS_DIR, renamed into place
+    once complete. Without open file descriptors, ssh returns right away.
+    """
+    jobs_dir = shlex.quote(REMOTE_JOBS_DIR)
+    script = f"({submit_cmd}) > {jobs_dir}/.{ticket} && mv {jobs_dir}/.{ticket} {jobs_dir}/{ticket}"
+    return (
+        f"mkdir -p {jobs_dir} && "
+        f"{{ nohup sh -c {shlex.quote(script)} > /dev/null 2>&1 < /dev/null & }}"
     )
-    if not cleanup:
-        return lpr_cmd
-    return f"set -euo pipefail; trap 'rm -f {shlex.quote(remote_path)}' EXIT; {lpr_cmd}"
 
 
-def _print_from_path(path: Path, extra_args: list[str]) -> None:
-    _read_pdf(path)
-    run_shell_check(f"scp {shlex.quote(str(path))} {REMOTE_HOST}:{REMOTE_TMP_DIR}/")
-    remote_path = f"{REMOTE_TMP_DIR}/{path.name}"
-    remote_cmd = _build_remote_print_cmd(remote_path, extra_args, cleanup=False)
-    run_shell_check(f"ssh {REMOTE_HOST} {shlex.quote(remote_cmd)}")
+def _build_remote_status_cmd(tickets: list[str]) -> str:
+    """Return a command printing job ids of tickets and the printer's jobs.
+
+    Each output line starts with "ticket", "queued" or "completed".
+    """
+    jobs_dir = shlex.quote(REMOTE_JOBS_DIR)
+    printer = shlex.quote(REMOTE_PRINTER)
+    return (
+        f"for ticket in {' '.join(tickets)}; do "
+        f'if [ -f {jobs_dir}/"$ticket" ]; then '
+        f'echo "ticket $ticket $(cat {jobs_dir}/"$ticket")"; '
+        f'rm -f {jobs_dir}/"$ticket"; fi; done; '
+        f"lpstat -W not-completed -o {printer} | sed 's/^/queued /'; "
+        f"lpstat -W completed -o {printer} | sed 's/^/completed /'"
+    )
 
 
-def _print_from_stdin(extra_args: list[str]) -> None:
+def _build_remote_lookup_cmd(digests: list[str]) -> str:
+    """Return a command printing which digests are cached.
+
+    Hits are touched, the modification time orders the cache for eviction.
+    """
+    cache_dir = shlex.quote(REMOTE_CACHE_DIR)
+    return (
+        f"mkdir -p {cache_dir} && cd {cache_dir} && "
+        f"for digest in {' '.join(digests)}; do "
+        'if [ -f "$digest.pdf" ]; then touch "$digest.pdf"; echo "$digest"; fi; '
+        "done"
+    )
+
+
+def _build_remote_evict_cmd() -> str:
+    return (
+        f"cd {shlex.quote(REMOTE_CACHE_DIR)} && total=0 && "
+        "ls -t | while read -r name; do "
+        'total=$((total + $(stat -c %s -- "$name"))); '
+        f'if [ "$total" -gt {REMOTE_CACHE_SIZE} ]; then rm -f -- "$name"; fi; '
+        "done"
+    )
+
+
+def _digest(upload: _Upload) -> _Upload:
+    with upload.path.open("rb") as pdf:
+        upload.digest = hashlib.file_digest(pdf, "sha256").hexdigest()
+    return upload
+
+
+def _upload(upload: _Upload, compress: bool) -> _Upload:
+    start = time.perf_counter()
+    # written under a temporary name, an interrupted upload must not be a hit
+    remote_tmp = f"{REMOTE_CACHE_DIR}/.{uuid4().hex}"
+    decompress = "gzip -dc" if compress else "cat"
+    remote_cmd = (
+        f"{decompress} > {shlex.quote(remote_tmp)} && "
+        f"mv {shlex.quote(remote_tmp)} {shlex.quote(upload.remote_path)}"
+    )
+    # scp would open a connection of its own instead of using the master
+    try:
+        with upload.path.open("rb") as pdf:
+            if not compress:
+                subprocess.run(_ssh_cmd(remote_cmd), stdin=pdf, check=True)
+                upload.transferred = upload.size
+            else:
+                upload.transferred = _send_compressed(pdf, remote_cmd)
+    except (OSError, subprocess.CalledProcessError) as exc:
+        upload.error = f"upload failed ({exc})"
+    upload.duration = time.perf_counter() - start
+    return upload
+
+
+def _send_compressed(pdf: BinaryIO, remote_cmd: str) -> int:
+    compressor = zlib.compressobj(wbits=31)  # gzip format
+    transferred = 0
+    with subprocess.Popen(_ssh_cmd(remote_cmd), stdin=subprocess.PIPE) as process:
+        assert process.stdin is not None
+        while chunk := pdf.read(_CHUNK_SIZE):
+            compressed = compressor.compress(chunk)
+            process.stdin.write(compressed)
+            transferred += len(compressed)
+        compressed = compressor.flush()
+        process.stdin.write(compressed)
+        transferred += len(compressed)
+        process.stdin.close()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return transferred
+
+
+def _throughput(size: int, duration: float) -> str:
+    return (
+        f"{size / 2**20:.1f} MiB in {duration:.2f}s "
+        f"({size / 2**20 / max(duration, 1e-9):.1f} MiB/s)"
+    )
+
+
+def _print_from_paths(
+    paths: list[Path],
+    lp_args: list[str],
+    jobs: int,
+    compress: bool,
+    detach: bool,
+) -> None:
+    errors: list[str] = []
+    uploads: list[_Upload] = []
+    # validate everything before the first upload, bad files are left out
+    for path in paths:
+        if error := _pdf_error(path):
+            errors.append(error)
+            continue
+        uploads.append(_Upload(path, path.stat().st_size))
+
+    if uploads:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(_digest, uploads))
+            # one round trip for all lookups, it also opens the shared connection
+            digests = {x.digest for x in uploads}
+            cached = _ssh(_build_remote_lookup_cmd(sorted(digests))).split()
+            pending: dict[str, _Upload] = {}
+            for upload in uploads:
+                upload.cached = upload.digest in cached
+                if not upload.cached:
+                    # the same document given twice is uploaded once
+                    pending.setdefault(upload.digest, upload)
+            list(pool.map(lambda x: _upload(x, compress), pending.values()))
+        for upload in uploads:
+            if not upload.cached and pending[upload.digest].error:
+                upload.error = pending[upload.digest].error
+        uploaded = [x for x in uploads if not x.error]
+        for upload in uploads:
+            if upload.error:
+                errors.append(f"{upload.path}: {upload.error}")
+            elif upload.cached:
+                print(f"Cached {upload.path}")
+            elif upload is pending[upload.digest]:
+                print(
+                    f"Uploaded {upload.path} "
+                    f"({_throughput(upload.transferred, upload.duration)})"
+                )
+        if uploaded:
+            # one job keeps the documents in the order they were given, with
+            # a title from the file name instead of the digest
+            title = [] if "-t" in lp_args else ["-t", uploaded[0].path.name]
+            submit_cmd = _build_remote_submit_cmd(
+                [x.remote_path for x in uploaded], [*lp_args, *title]
+            )
+            job = _Job([str(x.path) for x in uploaded])
+            if detach:
+                _ssh(_build_remote_detach_cmd(submit_cmd, job.ticket))
+                print("Submitting in the background, see 'rpoisel print status'")
+            else:
+                job.id = _ssh(submit_cmd).strip()
+                print(f"Submitted job {job.id}")
+            _journal_add(job)
+        transferred = sum(x.transferred for x in uploads)
+        print(
+            f"Printed {len(uploaded)}/{len(paths)} files, "
+            f"{sum(x.cached for x in uploads)} cached, sent "
+            f"{_throughput(transferred, time.perf_counter() - start)} "
+            f"with {jobs} jobs"
+        )
+
+    for error in errors:
+        typer.secho(f"Error: {error}", fg=typer.colors.RED, err=True)
+    if errors:
+        raise typer.Exit(code=1)
+
+
+def _print_from_stdin(lp_args: list[str]) -> None:
     if sys.stdin.isatty():
         typer.secho(
             "Error: either provide a PDF path or pipe PDF data via stdin.",
@@ -66,15 +399,16 @@ def _print_from_stdin(extra_args: list[str]) -> None:
         )
         raise typer.Exit(code=1)
 
-    data = sys.stdin.buffer.read()
-    if not data:
+    # only the first chunk is needed to check the header, the rest is streamed
+    chunk = sys.stdin.buffer.read(_CHUNK_SIZE)
+    if not chunk:
         typer.secho(
             "Error: no data received on stdin.",
             fg=typer.colors.RED,
             err=True,
         )
         raise typer.Exit(code=1)
-    if not _is_pdf(data):
+    if not _is_pdf(chunk):
         typer.secho(
             "Error: stdin data is not a valid PDF.",
             fg=typer.colors.RED,
@@ -82,24 +416,100 @@ def _print_from_stdin(extra_args: list[str]) -> None:
         )
         raise typer.Exit(code=1)
 
-    remote_path = f"{REMOTE_TMP_DIR}/rpoisel-print-{uuid4().hex}.pdf"
-    subprocess.run(
-        ["ssh", REMOTE_HOST, f"cat > {shlex.quote(remote_path)}"],
-        input=data,
-        check=True,
+    start = time.perf_counter()
+    transferred = 0
+    remote_cmd = _build_remote_submit_cmd([], lp_args)
+    with subprocess.Popen(
+        _ssh_cmd(remote_cmd), stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    ) as process:
+        assert process.stdin is not None and process.stdout is not None
+        try:
+            while chunk:
+                process.stdin.write(chunk)
+                transferred += len(chunk)
+                chunk = sys.stdin.buffer.read(_CHUNK_SIZE)
+            process.stdin.close()
+        except BrokenPipeError:
+            # lp failed early, its exit status tells why
+            pass
+        # the job id only follows once lp has read all of stdin
+        job_id = process.stdout.read().decode().strip()
+    if process.returncode != 0:
+        typer.secho(
+            f"Error: remote lp failed (returncode={process.returncode}).",
+            fg=typer.colors.RED,
+            err=True,
+        )
+        raise typer.Exit(code=1)
+    print(
+        f"Sent {_throughput(transferred, time.perf_counter() - start)}", file=sys.stderr
     )
-    remote_cmd = _build_remote_print_cmd(remote_path, extra_args, cleanup=True)
-    run_shell_check(f"ssh {REMOTE_HOST} {shlex.quote(remote_cmd)}")
+    print(f"Submitted job {job_id}")
+    _journal_add(_Job(["<stdin>"], id=job_id))
+
+
+def _print_status() -> None:
+    jobs = _journal_read()
+    if not jobs:
+        print("No tracked print jobs.")
+        return
+    tickets = sorted(x.ticket for x in jobs if not x.id)
+    # a single round trip for detached submissions and the printer queue
+    output = _ssh(_build_remote_status_cmd(tickets))
+    resolved: dict[str, str] = {}
+    states: dict[str, str] = {}
+    for line in output.splitlines():
+        kind, *fields = line.split()
+        if kind == "ticket" and len(fields) == 2:
+            resolved[fields[0]] = fields[1]
+        elif fields:
+            states[fields[0]] = kind
+
+    finished: set[str] = set()
+    for job in jobs:
+        job.id = job.id or resolved.get(job.ticket)
+        if job.id:
+            state = states.get(job.id, "unknown")
+        else:
+            state = "submitting"
+        # completed jobs are shown once, then no longer tracked
+        if state in ("completed", "unknown"):
+            finished.add(job.ticket)
+        submitted = datetime.fromtimestamp(job.submitted).strftime("%Y-%m-%d %H:%M:%S")
+        print(f"{job.id or '-':<28} {state:<10} {submitted}  {', '.join(job.files)}")
+    _journal_update(resolved, finished, set())
 
 
-def _parse_args(args: list[str]) -> tuple[Path | None, list[str]]:
-    if not args:
-        return None, []
-    if args[0] == "--":
-        return None, args[1:]
-    if args[0].startswith("-"):
-        return None, args
-    return Path(args[0]), args[1:]
+def _cancel_jobs(job_ids: list[str]) -> None:
+    if not job_ids:
+        typer.secho(
+            "Error: no job ids given, see 'rpoisel print status'.",
+            fg=typer.colors.RED,
+            err=True,
+        )
+        raise typer.Exit(code=1)
+    _ssh(shlex.join(["cancel", *job_ids]))
+    _journal_update({}, set(), set(job_ids))
+    for job_id in job_ids:
+        print(f"Cancelled job {job_id}")
+
+
+def _parse_args(args: list[str]) -> tuple[list[Path], list[str]]:
+    """Split leading PDF paths from the lpr options."""
+    if args[:1] == ["--"]:
+        return [], args[1:]
+    paths: list[Path] = []
+    for index, arg in enumerate(args):
+        if arg.startswith("-"):
+            return paths, args[index:]
+        paths.append(Path(arg))
+    return paths, []
+
+
+_ACTIONS: dict[str, Callable[[list[str]], None]] = {
+    "status": lambda args: _print_status(),
+    "cancel": _cancel_jobs,
+}
 
 
 def register(app: typer.Typer) -> None:
@@ -107,9 +517,37 @@ def register(app: typer.Typer) -> None:
         name="print",
         context_settings={"allow_extra_args": True, "ignore_unknown_options": True},
     )
-    def print_command(ctx: typer.Context) -> None:
-        path, extra_args = _parse_args(ctx.args)
-        if path:
-            _print_from_path(path, extra_args)
+    def print_command(
+        ctx: typer.Context,
+        jobs: int = typer.Option(
+            4, "--jobs", "-j", min=1, help="Number of files to upload in parallel"
+        ),
+        compress: bool = typer.Option(
+            False, help="Compress uploads, for slow links to the print server"
+        ),
+        detach: bool = typer.Option(
+            False, help="Return once the files are uploaded, submit in the background"
+        ),
+    ) -> None:
+        """Print PDF files or stdin with lpr options, or 'status' / 'cancel ID...'."""
+        action = ctx.args[0] if ctx.args else None
+        if action in _ACTIONS and not Path(action).is_file():
+            _ACTIONS[action](ctx.args[1:])
+            return
+        paths, extra_args = _parse_args(ctx.args)
+        try:
+            lp_args = _lp_args(extra_args)
+        except ValueError as exc:
+            typer.secho(f"Error: {exc}.", fg=typer.colors.RED, err=True)
+            raise typer.Exit(code=1)
+        if paths:
+            _print_from_paths(paths, lp_args, jobs, compress, detach)
             return
-        _print_from_stdin(extra_args)
+        if detach:
+            typer.secho(
+                "Error: --detach needs PDF paths, stdin is printed while it is read.",
+                fg=typer.colors.RED,
+                err=True,
+            )
+            raise typer.Exit(code=1)
+        _print_from_stdin(lp_args)
@@ -1,8 +1,20 @@
+import hashlib
+import json
+import re
+import selectors
+import socket
+import subprocess
+import sys
+import time
 from enum import Enum
+from fnmatch import fnmatch
+from pathlib import Path
 
+import click
 import typer
 
-from ..util.process import run_shell_check
+from ..util.process import run
+from ..util.xdg import xdg_path
 
 
 class ScreenVariant(str, Enum):
@@ -12,18 +24,225 @@ class ScreenVariant(str, Enum):
     four = "4"
 
 
+AUTORANDR_PROFILES: dict[ScreenVariant, str] = {
+    ScreenVariant.one: "one",
+    ScreenVariant.two: "two",
+    ScreenVariant.three: "three",
+    ScreenVariant.four: "four",
+}
+
+DRM_CONNECTORS_BASE = Path("/sys/class/drm")
+XRANDR_TIMEOUT = 5.0
+# docking connects several outputs in a burst of hotplug events
+SCREEN_WATCH_DEBOUNCE = 1.0
+
+AWESOME_LAYOUT_SCRIPT = '(require("rc_util")).arrange_clients_from_layout_config()'
+SETXKBMAP_ARGS = ["setxkbmap", "-layout", "us,de", "-option", "grp:caps_toggle"]
+# "1920x1080+1920+0" of a connected output in xrandr
+_XRANDR_GEOMETRY = re.compile(r"(\d+x\d+)\+(\d+)\+(\d+)")
+
+_NETLINK_KOBJECT_UEVENT = 15
+# multicast group of the uevents sent by the kernel, udev resends on group 2
+_KERNEL_UEVENT_GROUP = 1
+_UEVENT_BUFFER_SIZE = 64 * 1024
+
+
+class UeventSource:
+    """Kernel uevents, read from a netlink socket unless another is given."""
+
+    def __init__(self, sock: socket.socket | None = None) -> None:
+        if sock is None:
+            sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, _NETLINK_KOBJECT_UEVENT
+            )
+            sock.bind((0, _KERNEL_UEVENT_GROUP))
+        self.sock = sock
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def receive(self) -> dict[str, str] | None:
+        """Return the next uevent's properties, None when the source is closed."""
+        data = self.sock.recv(_UEVENT_BUFFER_SIZE)
+        if not data:
+            return None
+        # "ACTION@DEVPATH" followed by KEY=VALUE properties, all NUL terminated
+        _, *properties = data.decode(errors="replace").split("\0")
+        return dict(x.split("=", 1) for x in properties if "=" in x)
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+def _state_path() -> Path:
+    return xdg_path("state", "rpoisel", "screen.json")
+
+
+def _autorandr_dir() -> Path:
+    return xdg_path("config", "autorandr")
+
+
+def _connected_edids() -> dict[str, bytes]:
+    edids: dict[str, bytes] = {}
+    for connector in sorted(DRM_CONNECTORS_BASE.glob("card*-*")):
+        try:
+            if (connector / "status").read_text().strip() != "connected":
+                continue
+            edids[connector.name] = (connector / "edid").read_bytes()
+        except OSError:
+            continue
+    return edids
+
+
+def _current_geometry() -> list[str] | None:
+    """Return "OUTPUT MODE XxY" of the active outputs, None without X."""
+    try:
+        # --current reports the configuration without probing the outputs
+        xrandr = run(["xrandr", "--current"], timeout=XRANDR_TIMEOUT)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    geometry = []
+    for line in xrandr.stdout.splitlines():
+        name, _, rest = line.partition(" connected")
+        if rest and (match := _XRANDR_GEOMETRY.search(rest)):
+            mode, x, y = match.groups()
+            geometry.append(f"{name} {mode} {x}x{y}")
+    return geometry
+
+
+def _fingerprint(geometry: list[str] | None) -> str | None:
+    """Hash the EDIDs of the connected outputs and the screen geometry."""
+    if geometry is None:
+        return None
+    digest = hashlib.sha256()
+    for name, edid in _connected_edids().items():
+        digest.update(name.encode() + b"\0" + edid)
+    for line in sorted(geometry):
+        digest.update(line.encode() + b"\n")
+    return digest.hexdigest()
+
+
+def _detect_variant() -> ScreenVariant | None:
+    """Return the variant whose autorandr profile expects the connected monitors.
+
+    Profiles are compared by EDID only, DRM and X name outputs differently.
+    """
+    connected = sorted(x.hex() for x in _connected_edids().values() if x)
+    for variant, profile in AUTORANDR_PROFILES.items():
+        try:
+            setup = (_autorandr_dir() / profile / "setup").read_text()
+        except OSError:
+            continue
+        expected = [
+            x.split()[1].lower() for x in setup.splitlines() if len(x.split()) == 2
+        ]
+        remaining = list(connected)
+        for pattern in expected:
+            match = next((x for x in remaining if fnmatch(x, pattern)), None)
+            if match is None:
+                break
+            remaining.remove(match)
+        else:
+            if not remaining:
+                return variant
+    return None
+
+
+def _read_state() -> dict:
+    try:
+        return json.loads(_state_path().read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_state(variant: ScreenVariant, fingerprint: str | None) -> None:
+    path = _state_path()
+    if fingerprint is None:
+        path.unlink(missing_ok=True)
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_suffix(".tmp")
+    temporary.write_text(
+        json.dumps({"variant": variant.value, "fingerprint": fingerprint})
+    )
+    temporary.replace(path)
+
+
+def _load_layout(variant: ScreenVariant, force: bool) -> None:
+    fingerprint = _fingerprint(_current_geometry())
+    state = _read_state()
+    if (
+        not force
+        and fingerprint is not None
+        and state == {"variant": variant.value, "fingerprint": fingerprint}
+    ):
+        print(f"Layout {variant.value} is already active.", flush=True)
+        return
+
+    run(["autorandr", "--load", AUTORANDR_PROFILES[variant]])
+    run(["awesome-client", AWESOME_LAYOUT_SCRIPT])
+    # run here rather than from the script, awesome would block on it
+    run(SETXKBMAP_ARGS)
+    # rotation and scaling change the geometry X reports from the profile's
+    _write_state(variant, _fingerprint(_current_geometry()))
+
+
+def _load_detected_layout() -> None:
+    variant = _detect_variant()
+    if variant is None:
+        print("No layout matches the connected monitors.", file=sys.stderr, flush=True)
+        return
+    print(f"Loading layout {variant.value}", flush=True)
+    try:
+        _load_layout(variant, force=False)
+    except (OSError, subprocess.SubprocessError) as exc:
+        # keep watching, the next hotplug may well succeed
+        print(f"Error: {exc}", file=sys.stderr, flush=True)
+
+
+def _is_hotplug(uevent: dict[str, str]) -> bool:
+    return uevent.get("SUBSYSTEM") == "drm" and uevent.get("HOTPLUG") == "1"
+
+
+def _watch_screens(source: UeventSource) -> None:
+    """Load the detected layout now and after every burst of hotplug events."""
+    _load_detected_layout()
+    with selectors.DefaultSelector() as selector:
+        selector.register(source, selectors.EVENT_READ)
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not selector.select(timeout):
+                deadline = None
+                _load_detected_layout()
+                continue
+            uevent = source.receive()
+            if uevent is None:
+                return
+            if _is_hotplug(uevent):
+                deadline = time.monotonic() + SCREEN_WATCH_DEBOUNCE
+
+
 def register(app: typer.Typer) -> None:
     @app.command()
-    def screen(variant: ScreenVariant) -> None:
-        if variant == ScreenVariant.one:
-            run_shell_check("autorandr --load one")
-        elif variant == ScreenVariant.two:
-            run_shell_check("autorandr --load two")
-        elif variant == ScreenVariant.three:
-            run_shell_check("autorandr --load three")
-        elif variant == ScreenVariant.four:
-            run_shell_check("autorandr --load four")
-        run_shell_check(
-            "awesome-client '(require(\"rc_util\")).arrange_clients_from_layout_config()'"
-            '  && setxkbmap -layout "us,de" -option "grp:caps_toggle"'
-        )
+    def screen(
+        variant: str = typer.Argument(
+            ...,
+            click_type=click.Choice([*(x.value for x in ScreenVariant), "watch"]),
+            help="Layout to load, or 'watch' to load layouts on hotplug",
+        ),
+        force: bool = typer.Option(
+            False, "--force", help="Load the layout even if it is already active"
+        ),
+    ) -> None:
+        if variant != "watch":
+            _load_layout(ScreenVariant(variant), force)
+            return
+
+        source = UeventSource()
+        try:
+            _watch_screens(source)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            source.close()
@@ -1,10 +1,11 @@
 import typer
 
-from ..util.process import run_shell_check
+from ..util.process import run
 
 
 def register(app: typer.Typer) -> None:
     @app.command()
     def sleep() -> None:
-        run_shell_check("sync")
-        run_shell_check("sudo systemctl suspend --force")
+        run(["sync"])
+        # sudo may ask for a password
+        run(["sudo", "systemctl", "suspend", "--force"], timeout=None, interactive=True)
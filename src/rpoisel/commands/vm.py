@@ -1,14 +1,24 @@
+import asyncio
 import json
+import os
 import re
+import shlex
+import struct
 import sys
+import time
+from dataclasses import dataclass, field, replace
+from datetime import datetime
 from enum import Enum
 from pathlib import Path
-from socket import AF_UNIX, SOCK_STREAM, socket
 from typing import Any, Optional
 
+import click
 import typer
 
-from ..util.process import run_shell_check
+from ..util.cli import GlobCompletion
+from ..util.process import run
+from ..util.qemu import PROFILES, VMSpec
+from ..util.qmp import AsyncQMPClient, QMPClient, QMPError
 
 # --- QEMU constants & helpers ---
 
@@ -16,6 +26,28 @@ QEMU_PID_FILES_BASE = Path("/") / "var" / "run"
 QEMU_IMAGES_FILES_BASE = Path.home() / "images" / "hdimages"
 QEMU_QMP_SOCKETS_BASE = Path("/") / "tmp"
 QEMU_QMP_SOCKET_RE = re.compile(r"qmp-(.*)")
+# a healthy QEMU answers within milliseconds, don't let a wedged one stall `list`
+QEMU_STATUS_TIMEOUT = 1.0
+# how often `watch` looks for VMs that were started or restarted
+QEMU_WATCH_RESCAN_INTERVAL = 1.0
+# longest wait of `watch` between connects to a VM that refuses them
+QEMU_WATCH_RETRY_MAX = 30.0
+# image suffixes `start` looks for, in this order, and the formats they imply
+QEMU_IMAGE_SUFFIXES = (".qcow2", ".vmdk", ".img")
+# where taps of multiqueue profiles show up once created
+NETWORK_INTERFACES_BASE = Path("/") / "sys" / "class" / "net"
+
+_QCOW2_MAGIC = b"QFI\xfb"
+# backing file offset and size in the qcow2 header
+_QCOW2_BACKING = struct.Struct(">QI")
+_VMDK_MAGICS = (b"KDMV", b"# Disk DescriptorFile")
+
+# QEMU streams the guest state through these, zstd compresses on all CPUs
+QEMU_STATE_COMPRESS = ("zstd", "-q", "-f", "-1", "-T0", "-o")
+QEMU_STATE_DECOMPRESS = ("zstd", "-q", "-d", "-c")
+QEMU_STATE_SUFFIX = ".state.zst"
+# how often migrations report progress while no MIGRATION event arrives
+QEMU_MIGRATION_PROGRESS_INTERVAL = 1.0
 
 
 class QEMUError(Exception):
@@ -26,13 +58,109 @@ class QEMUVM:
     def __init__(self, name) -> None:
         self.name = name
         self.qmp_socket = _get_socket_path(name)
+        self.status = "unknown"
         try:
             self.pid = int(_get_pid_file_path(name).read_text().strip())
         except (FileNotFoundError, PermissionError) as exc:
             raise QEMUError(f"Could not instantiate QEMU VM {name}") from exc
 
     def __str__(self) -> str:
-        return f"{self.name} ({self.pid}): {self.qmp_socket.resolve()}"
+        return f"{self.name} ({self.pid}): {self.status} {self.qmp_socket.resolve()}"
+
+    def as_dict(self) -> dict[str, str | int]:
+        return {
+            "name": self.name,
+            "pid": self.pid,
+            "status": self.status,
+            "socket": str(self.qmp_socket),
+        }
+
+
+@dataclass
+class ImageInfo:
+    path: Path
+    format: str
+    backing: Optional[Path] = None
+    overlays: list[Path] = field(default_factory=list)
+
+    @property
+    def read_only(self) -> bool:
+        return not self.path.stat().st_mode & 0o222
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "name": self.path.stem,
+            "path": str(self.path),
+            "format": self.format,
+            "read_only": self.read_only,
+            "overlays": [x.stem for x in self.overlays],
+        }
+
+
+def _image_info(path: Path) -> ImageInfo:
+    """Detect the format from the image header, cheaper than asking qemu-img."""
+    with path.open("rb") as image:
+        header = image.read(64)
+        if header.startswith(_QCOW2_MAGIC):
+            offset, size = _QCOW2_BACKING.unpack_from(header, 8)
+            if not offset:
+                return ImageInfo(path, "qcow2")
+            image.seek(offset)
+            backing = Path(os.fsdecode(image.read(size)))
+            # relative backing files are resolved against the overlay
+            return ImageInfo(path, "qcow2", path.parent / backing)
+    if header.startswith(_VMDK_MAGICS):
+        return ImageInfo(path, "vmdk")
+    return ImageInfo(path, "raw")
+
+
+def _find_image(name: str) -> Optional[Path]:
+    for suffix in QEMU_IMAGE_SUFFIXES:
+        path = QEMU_IMAGES_FILES_BASE / f"{name}{suffix}"
+        if path.exists():
+            return path
+    return None
+
+
+def _clone_image(template: str, name: str) -> Path:
+    """Create a qcow2 overlay for name backed by the template image."""
+    base = _find_image(template)
+    if base is None:
+        raise QEMUError(f"no image for template {template} in {QEMU_IMAGES_FILES_BASE}")
+    info = _image_info(base)
+    # writing to a backing file corrupts every overlay on top of it
+    base.chmod(base.stat().st_mode & ~0o222)
+    overlay = QEMU_IMAGES_FILES_BASE / f"{name}.qcow2"
+    run(
+        [
+            "qemu-img",
+            "create",
+            "-q",
+            "-f",
+            "qcow2",
+            "-b",
+            str(base.resolve()),
+            "-F",
+            info.format,
+            str(overlay),
+        ]
+    )
+    return overlay
+
+
+def _list_templates() -> list[ImageInfo]:
+    """Return the read-only or backing images, each with its overlays."""
+    images: dict[Path, ImageInfo] = {}
+    for path in sorted(QEMU_IMAGES_FILES_BASE.iterdir()):
+        if path.suffix in QEMU_IMAGE_SUFFIXES and path.is_file():
+            try:
+                images[path.resolve()] = _image_info(path)
+            except OSError:
+                continue
+    for image in images.values():
+        if image.backing is not None and image.backing.resolve() in images:
+            images[image.backing.resolve()].overlays.append(image.path)
+    return [x for x in images.values() if x.overlays or x.read_only]
 
 
 def _get_pid_file_path(name: str) -> Path:
@@ -43,58 +171,242 @@ def _get_socket_path(name: str) -> Path:
     return QEMU_QMP_SOCKETS_BASE / f"qmp-{name}"
 
 
+def _get_state_path(name: str) -> Path:
+    return QEMU_IMAGES_FILES_BASE / f"{name}{QEMU_STATE_SUFFIX}"
+
+
+def _get_spec_path(name: str) -> Path:
+    return QEMU_IMAGES_FILES_BASE / f"{name}.json"
+
+
+def _load_spec(name: str, **overrides: Any) -> VMSpec:
+    """Return the stored spec of name with the given settings, storing changes."""
+    path = _get_spec_path(name)
+    try:
+        stored = VMSpec.load(path)
+    except ValueError as exc:
+        typer.secho(
+            f"Error: invalid VM spec {path}: {exc}.", fg=typer.colors.RED, err=True
+        )
+        raise typer.Exit(code=1)
+    spec = replace(
+        stored or VMSpec(name), **{k: v for k, v in overrides.items() if v is not None}
+    )
+    if spec != stored:
+        spec.save(path)
+    return spec
+
+
 def _create_image(name: str, size: str) -> Path:
     image_path = QEMU_IMAGES_FILES_BASE / f"{name}.vmdk"
-    run_shell_check(f"qemu-img create -f vmdk {image_path} {size}")
+    run(["qemu-img", "create", "-q", "-f", "vmdk", str(image_path), size])
     return image_path
 
 
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # QEMU runs as root, so it exists even though we may not signal it
+        return True
+    return True
+
+
+def _find_vm_names() -> list[str]:
+    return sorted(
+        match.group(1)
+        for file in QEMU_QMP_SOCKETS_BASE.glob("qmp-*")
+        if (match := QEMU_QMP_SOCKET_RE.match(file.name)) and file.is_socket()
+    )
+
+
+def _remove_stale_sockets(sockets: list[Path]) -> None:
+    privileged: list[Path] = []
+    for qmp_socket in sockets:
+        try:
+            qmp_socket.unlink(missing_ok=True)
+        except PermissionError:
+            privileged.append(qmp_socket)
+    if privileged:
+        run(["sudo", "rm", "-f", *map(str, privileged)], interactive=True)
+
+
+async def _query_status(vm: QEMUVM) -> None:
+    try:
+        async with AsyncQMPClient(
+            vm.qmp_socket, timeout=QEMU_STATUS_TIMEOUT, reconnect=False
+        ) as client:
+            vm.status = (await client.execute("query-status"))["status"]
+    except TimeoutError:
+        vm.status = "unresponsive"
+    except (OSError, QMPError):
+        vm.status = "unreachable"
+
+
+async def _query_statuses(vms: list[QEMUVM]) -> None:
+    await asyncio.gather(*(_query_status(x) for x in vms if x.status != "dead"))
+
+
 def _list_vms() -> list[QEMUVM]:
     result: list[QEMUVM] = []
-    for file in QEMU_QMP_SOCKETS_BASE.iterdir():
-        if not file.is_socket():
-            continue
-        match = QEMU_QMP_SOCKET_RE.match(file.name)
-        if not match:
-            continue
-        vm_name = match.group(1)
+    stale: list[Path] = []
+    for vm_name in _find_vm_names():
         try:
-            result.append(QEMUVM(vm_name))
+            vm = QEMUVM(vm_name)
         except QEMUError as exc:
             print(f"Error interacting with VM: {exc}", file=sys.stderr)
-            run_shell_check(f"sudo rm {_get_socket_path(vm_name)}")
+            stale.append(_get_socket_path(vm_name))
             continue
+        if not _pid_alive(vm.pid):
+            vm.status = "dead"
+            stale.append(vm.qmp_socket)
+        result.append(vm)
+    _remove_stale_sockets(stale)
+    asyncio.run(_query_statuses(result))
     return result
 
 
+def _format_event(vm_name: str, event: dict[str, Any], json_output: bool) -> str:
+    if json_output:
+        return json.dumps({"vm": vm_name, **event})
+    timestamp = datetime.fromtimestamp(
+        event["timestamp"]["seconds"] + event["timestamp"]["microseconds"] / 1e6
+    )
+    line = f"{timestamp.isoformat(timespec='milliseconds')} {vm_name} {event['event']}"
+    if data := event.get("data"):
+        line += f" {json.dumps(data)}"
+    return line
+
+
+async def _watch_vm(vm_name: str, json_output: bool, inode: int) -> None:
+    """Print the events of vm_name while its socket is the one with inode.
+
+    Failed or timed out connects are retried with backoff, e.g. QEMU may not
+    serve QMP yet or still serve another client.
+    """
+    qmp_socket = _get_socket_path(vm_name)
+    delay = QEMU_WATCH_RESCAN_INTERVAL
+    while True:
+        try:
+            async with AsyncQMPClient(qmp_socket, reconnect=False) as client:
+                events = client.subscribe()
+                print(f"Watching {vm_name}", file=sys.stderr)
+                delay = QEMU_WATCH_RESCAN_INTERVAL
+                while (event := await events.get()) is not None:
+                    print(_format_event(vm_name, event, json_output), flush=True)
+            print(f"Stopped watching {vm_name}", file=sys.stderr)
+        except (OSError, QMPError):
+            pass
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, QEMU_WATCH_RETRY_MAX)
+        try:
+            if qmp_socket.stat().st_ino != inode:
+                return
+        except FileNotFoundError:
+            return
+
+
+async def _watch_vms(names: list[str], json_output: bool) -> None:
+    # the socket inode tells a restarted VM apart from a stale socket, the
+    # watch of the previous one ends by itself
+    watched: dict[str, tuple[int, asyncio.Task]] = {}
+    while True:
+        for vm_name in _find_vm_names():
+            if names and vm_name not in names:
+                continue
+            try:
+                inode = _get_socket_path(vm_name).stat().st_ino
+            except FileNotFoundError:
+                continue
+            if vm_name in watched:
+                watched_inode, watching = watched[vm_name]
+                if watched_inode == inode and not watching.done():
+                    continue
+            task = asyncio.create_task(_watch_vm(vm_name, json_output, inode))
+            watched[vm_name] = (inode, task)
+        await asyncio.sleep(QEMU_WATCH_RESCAN_INTERVAL)
+
+
+async def _migrate(client: AsyncQMPClient, cmd: str, uri: str, label: str) -> float:
+    """Run a migration command until QEMU reports its end, return the duration."""
+    events = client.subscribe({"MIGRATION"})
+    await client.execute(
+        "migrate-set-capabilities",
+        {"capabilities": [{"capability": "events", "state": True}]},
+    )
+    start = time.perf_counter()
+    await client.execute(cmd, {"uri": uri})
+    while True:
+        try:
+            event = await asyncio.wait_for(
+                events.get(), QEMU_MIGRATION_PROGRESS_INTERVAL
+            )
+        except TimeoutError:
+            # the source knows how much RAM is left, the destination does not
+            if ram := (await client.execute("query-migrate")).get("ram"):
+                print(
+                    f"{label}: {ram['transferred'] >> 20} of {ram['total'] >> 20} MiB",
+                    file=sys.stderr,
+                )
+            continue
+        if event is None:
+            raise QEMUError("QEMU went away during the migration")
+        status = event["data"]["status"]
+        if status == "completed":
+            return time.perf_counter() - start
+        if status in ("failed", "cancelled"):
+            info = await client.execute("query-migrate")
+            raise QEMUError(info.get("error-desc", f"migration {status}"))
+
+
+async def _save_vm(name: str, state: Path) -> float:
+    temporary = state.with_name(f"{state.name}.tmp")
+    uri = f"exec:{shlex.join([*QEMU_STATE_COMPRESS, str(temporary)])}"
+    async with AsyncQMPClient(_get_socket_path(name), reconnect=False) as client:
+        # a paused guest is written in one pass, nothing gets dirty meanwhile
+        await client.execute("stop")
+        try:
+            duration = await _migrate(client, "migrate", uri, f"Saving {name}")
+            temporary.replace(state)
+        except BaseException:
+            # whatever went wrong, the guest must not stay paused
+            temporary.unlink(missing_ok=True)
+            await client.execute("cont")
+            raise
+        # the disk must not change until the state is restored
+        try:
+            await client.execute("quit")
+        except ConnectionError:
+            pass
+    return duration
+
+
+async def _restore_vm(name: str, state: Path) -> float:
+    uri = f"exec:{shlex.join([*QEMU_STATE_DECOMPRESS, str(state)])}"
+    async with AsyncQMPClient(_get_socket_path(name), reconnect=False) as client:
+        try:
+            duration = await _migrate(
+                client, "migrate-incoming", uri, f"Restoring {name}"
+            )
+        except QEMUError:
+            # without its state the guest cannot run, don't leave QEMU waiting
+            await client.execute("quit")
+            raise
+        # recent QEMUs keep the guest paused like it was saved
+        await client.execute("cont")
+    return duration
+
+
 # --- QMP client ---
 
 
-class QMPClient:
-    def __init__(self, qmp_socket: Path | str) -> None:
-        self.__socket = socket(AF_UNIX, SOCK_STREAM)
-        self.__socket.connect(
-            str(qmp_socket) if isinstance(qmp_socket, Path) else qmp_socket
-        )
-        self.__sock_file = self.__socket.makefile(mode="r")
-        self.__sock_file.readline()
-        self.send_monitor_cmd("qmp_capabilities")
-
-    def _read_parse_json(self) -> dict[str, Any]:
-        return json.loads(self.__sock_file.readline().rstrip("\r\n"))
-
-    def send_monitor_cmd(
-        self, cmd: str, arguments: dict[str, str] = {}
-    ) -> dict[str, Any]:
-        self.__socket.sendall(
-            (json.dumps({"execute": cmd, "arguments": arguments}) + "\n").encode()
-        )
-        response = self._read_parse_json()
-        while response.get("event"):
-            response = self._read_parse_json()
-        if "error" in response:
-            raise RuntimeError(response["error"])
-        return response["return"]
+def _get_qmp_client(qmp_socket: Path) -> QMPClient | None:
+    # QEMU serves one QMP connection at a time, so it is closed after the
+    # command, kept open e.g. by `rpoisel daemon` it locks out `list`, `watch`
+    # and other tools
+    return QMPClient(qmp_socket) if qmp_socket.exists() else None
 
 
 # --- VM command ---
@@ -108,36 +420,162 @@ class VMCommand(str, Enum):
     stop = "stop"
     cont = "cont"
     powerdown = "powerdown"
+    watch = "watch"
+    clone = "clone"
+    templates = "templates"
+    save = "save"
+    restore = "restore"
+
+
+def _run_qemu(
+    spec: VMSpec,
+    image: ImageInfo,
+    iso: Optional[Path] = None,
+    incoming: Optional[str] = None,
+) -> None:
+    profile = PROFILES[spec.profile]
+    print(
+        f"Profile {spec.profile}: {profile.cpus} vCPUs, {profile.memory} memory, "
+        f"{profile.nic} with {profile.queues} queue(s)"
+    )
+    qmp_socket_path = _get_socket_path(spec.name)
+    pid_file_path = _get_pid_file_path(spec.name)
+    argv = spec.argv(
+        image.path,
+        image.format,
+        qmp_socket_path,
+        pid_file_path,
+        iso=iso,
+        incoming=incoming,
+    )
+    # interactive, so sudo can ask for a password
+    for command in spec.network_setup():
+        # the tap stays around, later starts only attach it to the bridge again
+        if (
+            command[:2] == ["ip", "tuntap"]
+            and (NETWORK_INTERFACES_BASE / spec.tap).exists()
+        ):
+            continue
+        run(["sudo", *command], interactive=True)
+    run(["sudo", *argv], timeout=None, interactive=True)
+    if iso is None:
+        run(
+            [
+                "sudo",
+                "chown",
+                f"{os.getuid()}:{os.getgid()}",
+                str(qmp_socket_path),
+                str(pid_file_path),
+            ],
+            interactive=True,
+        )
+
+
+def _clone(template: str, name: str, force: bool) -> Path:
+    if template == name:
+        typer.secho(
+            "Error: a VM cannot be cloned from itself.", fg=typer.colors.RED, err=True
+        )
+        raise typer.Exit(code=1)
+    existing = _find_image(name)
+    if existing is not None and not force:
+        typer.secho(
+            f"Error: image already exists: {existing}. Use --force to overwrite.",
+            fg=typer.colors.RED,
+            err=True,
+        )
+        raise typer.Exit(code=1)
+    try:
+        return _clone_image(template, name)
+    except QEMUError as exc:
+        typer.secho(f"Error: {exc}.", fg=typer.colors.RED, err=True)
+        raise typer.Exit(code=1)
 
 
 def register(app: typer.Typer) -> None:
     @app.command(name="vm")
     def vm_command(
         command: VMCommand,
-        name: Optional[str] = typer.Argument(default=None),
+        names: Optional[list[str]] = typer.Argument(
+            default=None,
+            help="VM name, 'watch' accepts several, 'clone' a template and a name",
+            autocompletion=GlobCompletion(QEMU_QMP_SOCKETS_BASE, "qmp-"),
+        ),
         iso: Optional[Path] = typer.Option(None, help="Path to installation ISO"),
+        from_template: Optional[str] = typer.Option(
+            None, "--from", help="Template to clone for 'create' instead of an ISO"
+        ),
         size: str = typer.Option("20G", help="Disk image size"),
-        vnc_display: int = typer.Option(0, help="VNC display number (port = 5900 + N)"),
-        bridge: str = typer.Option(
-            "bridge0", help="Network bridge to attach the VM to"
+        profile: Optional[str] = typer.Option(
+            None,
+            help="Performance profile, stored for later starts (default: compat)",
+            click_type=click.Choice(list(PROFILES)),
+        ),
+        vnc_display: Optional[int] = typer.Option(
+            None, help="VNC display number (port = 5900 + N), stored (default: 0)"
+        ),
+        bridge: Optional[str] = typer.Option(
+            None, help="Network bridge to attach the VM to, stored (default: bridge0)"
         ),
         force: bool = typer.Option(False, help="Overwrite existing disk image"),
-        printer: bool = typer.Option(
-            False, help="Pass through USB printer (04e8:3321)"
+        printer: Optional[bool] = typer.Option(
+            None, help="Pass through USB printer (04e8:3321), stored (default: no)"
+        ),
+        json_output: bool = typer.Option(
+            False, "--json", help="Print 'list' and 'watch' output as JSON"
         ),
     ) -> None:
-        usb_args = (
-            """\
-  -device usb-ehci,id=ehci \\
-  -device usb-host,vendorid=0x04e8,productid=0x3321 \\"""
-            if printer
-            else ""
+        settings = dict(
+            profile=profile, bridge=bridge, vnc_display=vnc_display, printer=printer
         )
         if command == VMCommand.list:
-            for vm in _list_vms():
+            vms = _list_vms()
+            if json_output:
+                print(json.dumps([x.as_dict() for x in vms], indent=2))
+                return
+            for vm in vms:
                 print(str(vm))
             return
 
+        if command == VMCommand.watch:
+            try:
+                asyncio.run(_watch_vms(names or [], json_output))
+            except KeyboardInterrupt:
+                pass
+            return
+
+        if command == VMCommand.templates:
+            templates = _list_templates()
+            if json_output:
+                print(json.dumps([x.as_dict() for x in templates], indent=2))
+                return
+            for template in templates:
+                print(f"{template.path.stem} ({template.format})")
+                for overlay in template.overlays:
+                    print(f"  {overlay.stem}")
+            return
+
+        if command == VMCommand.clone:
+            if not names or len(names) != 2:
+                typer.secho(
+                    "Error: 'clone' expects a template and a VM name.",
+                    fg=typer.colors.RED,
+                    err=True,
+                )
+                raise typer.Exit(code=1)
+            template, name = names
+            _clone(template, name, force)
+            print(f"Cloned {template} to {name}")
+            return
+
+        if names and len(names) > 1:
+            typer.secho(
+                f"Error: '{command.value}' accepts a single VM name.",
+                fg=typer.colors.RED,
+                err=True,
+            )
+            raise typer.Exit(code=1)
+        name = names[0] if names else None
         if not name:
             typer.secho(
                 "Error: missing argument 'name'.",
@@ -146,6 +584,16 @@ def register(app: typer.Typer) -> None:
             )
             raise typer.Exit(code=1)
 
+        if command == VMCommand.create and from_template:
+            overlay = _clone(from_template, name, force)
+            spec = _load_spec(name, **settings)
+            print(f"Starting VM '{name}' cloned from {from_template}")
+            print(
+                f"Connect via VNC to :{spec.vnc_display} (port {5900 + spec.vnc_display})"
+            )
+            _run_qemu(spec, _image_info(overlay))
+            return
+
         if command == VMCommand.create:
             if not iso:
                 typer.secho(
@@ -170,68 +618,104 @@ def register(app: typer.Typer) -> None:
                 )
                 raise typer.Exit(code=1)
             _create_image(name, size)
-            qmp_socket_path = _get_socket_path(name)
-            pid_file_path = _get_pid_file_path(name)
-            vnc_port = 5900 + vnc_display
+            spec = _load_spec(name, **settings)
             print(f"Creating VM '{name}' with {size} disk from {iso}")
-            print(f"Connect via VNC to :{vnc_display} (port {vnc_port})")
-            run_shell_check(f"""sudo qemu-system-x86_64 \
-  -accel kvm \
-  -cpu host \
-  -m 4G \
-  -netdev bridge,id=net0,br={bridge} \
-  -device e1000,netdev=net0 \
-  -netdev user,id=net1 \
-  -device e1000,netdev=net1 \
-  -drive file={image_path},format=vmdk,if=virtio \
-  -cdrom {iso} \
-  -boot d \
-  {usb_args}  -name qemu-vm-{name},process=vm-{name} \
-  -display vnc=:{vnc_display} \
-  -qmp unix:{qmp_socket_path},server=on,wait=off \
-  -pidfile {pid_file_path}
-""")
+            print(
+                f"Connect via VNC to :{spec.vnc_display} (port {5900 + spec.vnc_display})"
+            )
+            _run_qemu(spec, ImageInfo(image_path, "vmdk"), iso=iso)
             return
 
         qmp_socket_path = _get_socket_path(name)
-        pid_file_path = _get_pid_file_path(name)
-        qmp_client = QMPClient(qmp_socket_path) if qmp_socket_path.exists() else None
-
-        if command == VMCommand.state:
-            if not qmp_client:
-                print("QMP client not created. VM does not seem to run.")
-                return
-            result = qmp_client.send_monitor_cmd("query-status")
-            print(result["status"])
-        elif command == VMCommand.start:
+        qmp_client = None
+        try:
+            qmp_client = _get_qmp_client(qmp_socket_path)
+            if command == VMCommand.state:
+                if not qmp_client:
+                    print("QMP client not created. VM does not seem to run.")
+                    return
+                result = qmp_client.send_monitor_cmd("query-status")
+                print(result["status"])
+            elif command == VMCommand.start or command == VMCommand.restore:
+                if qmp_client:
+                    print(f"VM {name} is already running.")
+                    return
+                image = _find_image(name)
+                if image is None:
+                    typer.secho(
+                        f"Error: no image for VM {name} in {QEMU_IMAGES_FILES_BASE}.",
+                        fg=typer.colors.RED,
+                        err=True,
+                    )
+                    raise typer.Exit(code=1)
+                state = _get_state_path(name)
+                if command == VMCommand.start:
+                    if state.exists():
+                        # booting changes the disk under the saved state
+                        typer.secho(
+                            f"Error: VM {name} has a saved state, 'restore' it or remove {state}.",
+                            fg=typer.colors.RED,
+                            err=True,
+                        )
+                        raise typer.Exit(code=1)
+                    _run_qemu(_load_spec(name, **settings), _image_info(image))
+                    return
+                if not state.exists():
+                    typer.secho(
+                        f"Error: no saved state for VM {name} in {QEMU_IMAGES_FILES_BASE}.",
+                        fg=typer.colors.RED,
+                        err=True,
+                    )
+                    raise typer.Exit(code=1)
+                # the guest expects the hardware it was saved on
+                spec = _load_spec(name, bridge=bridge, vnc_display=vnc_display)
+                _run_qemu(spec, _image_info(image), incoming="defer")
+                try:
+                    duration = asyncio.run(_restore_vm(name, state))
+                except (OSError, QEMUError, QMPError) as exc:
+                    typer.secho(
+                        f"Error: restoring VM {name} failed: {exc}.",
+                        fg=typer.colors.RED,
+                        err=True,
+                    )
+                    raise typer.Exit(code=1)
+                # the guest writes to its disk again, so the state is stale now
+                state.unlink()
+                print(f"Restored VM {name} in {duration:.1f} s")
+            elif command == VMCommand.save:
+                if not qmp_client:
+                    print("QMP client not created. VM does not seem to run.")
+                    return
+                qmp_client.close()
+                qmp_client = None
+                state = _get_state_path(name)
+                try:
+                    duration = asyncio.run(_save_vm(name, state))
+                except (OSError, QEMUError, QMPError) as exc:
+                    typer.secho(
+                        f"Error: saving VM {name} failed: {exc}.",
+                        fg=typer.colors.RED,
+                        err=True,
+                    )
+                    raise typer.Exit(code=1)
+                print(f"Saved VM {name} to {state} in {duration:.1f} s")
+            elif command == VMCommand.stop or command == VMCommand.cont:
+                if not qmp_client:
+                    print("QMP client not created. VM does not seem to run.")
+                    return
+                qmp_client.send_monitor_cmd(command.value)
+            elif command == VMCommand.powerdown:
+                if not qmp_client:
+                    print("QMP client not created. VM does not seem to run.")
+                    return
+                qmp_client.send_monitor_cmd("system_powerdown")
+        except (QMPError, TimeoutError, ConnectionError) as exc:
+            typer.secho(
+                f"Error: {command.value} of VM {name} failed: {exc}.",
+                fg=typer.colors.RED,
+                err=True,
+            )
+            raise typer.Exit(code=1)
+        finally:
             if qmp_client:
-                print(f"VM {name} is already running.")
-                return
-            run_shell_check(f"""sudo qemu-system-x86_64 \
-  -accel kvm \
-  -cpu host \
-  -m 4G \
-  -netdev bridge,id=net0,br={bridge} \
-  -device e1000,netdev=net0 \
-  -netdev user,id=net1 \
-  -device e1000,netdev=net1 \
-  -drive file={QEMU_IMAGES_FILES_BASE}/{name}.vmdk,format=vmdk,if=virtio \
-  {usb_args}  -name qemu-vm-{name},process=vm-{name} \
-  -daemonize \
-  -serial none \
-  -display vnc=:{vnc_display} \
-  -qmp unix:{qmp_socket_path},server=on,wait=off \
-  -pidfile {pid_file_path}
-""")
-            run_shell_check(f"""sudo chown $(id -u):$(id -g) {qmp_socket_path}""")
-            run_shell_check(f"""sudo chown $(id -u):$(id -g) {pid_file_path}""")
-        elif command == VMCommand.stop or command == VMCommand.cont:
-            if not qmp_client:
-                print("QMP client not created. VM does not seem to run.")
-                return
-            qmp_client.send_monitor_cmd(command.value)
-        elif command == VMCommand.powerdown:
-            if not qmp_client:
-                print("QMP client not created. VM does not seem to run.")
-                return
-            qmp_client.send_monitor_cmd("system_powerdown")
+                qmp_client.close()
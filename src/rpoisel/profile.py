@@ -0,0 +1,222 @@
+"""Startup profiling for the rpoisel CLI.
+
+Profiling is enabled with ``--profile-startup`` or by setting
+``RPOISEL_PROFILE_STARTUP``. A value of ``1`` prints a report to stderr when
+the process exits, any other non-empty value is taken as the path of a JSON
+report. The import hook has to be in place before typer and the command
+modules are loaded, and the daemon client imports this module on every
+invocation, so only ``os``, ``sys`` and ``time`` are imported up front.
+"""
+
+import os
+import sys
+import time
+
+ENV_VAR = "RPOISEL_PROFILE_STARTUP"
+FLAG = "--profile-startup"
+
+_TOP_IMPORTS = 25
+
+
+class ImportRecord:
+    __slots__ = ("module", "self_time", "cumulative")
+
+    def __init__(self, module: str, self_time: float, cumulative: float) -> None:
+        self.module = module
+        self.self_time = self_time
+        self.cumulative = cumulative
+
+
+class Span:
+    __slots__ = ("name", "start", "duration")
+
+    def __init__(self, name: str, start: float, duration: float) -> None:
+        self.name = name
+        self.start = start
+        self.duration = duration
+
+
+class StartupProfile:
+    def __init__(self, output: str | None) -> None:
+        import builtins
+        import threading
+
+        self.output = output
+        self.origin = time.perf_counter()
+        self.imports: list[ImportRecord] = []
+        self.spans: list[Span] = []
+        self._open: dict[str, float] = {}
+        self._local = threading.local()
+        self._builtins = builtins
+        self._original_import = builtins.__import__
+
+    def begin(self, name: str) -> None:
+        self._open[name] = time.perf_counter()
+
+    def end(self, name: str) -> None:
+        start = self._open.pop(name, None)
+        if start is None:
+            return
+        self.spans.append(Span(name, start - self.origin, time.perf_counter() - start))
+
+    def hook_imports(self) -> None:
+        setattr(self._builtins, "__import__", self._import)
+
+    def unhook_imports(self) -> None:
+        setattr(self._builtins, "__import__", self._original_import)
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        module = _absolute_name(name, globals, level)
+        parts = module.split(".")
+        candidates = [".".join(parts[:i]) for i in range(1, len(parts) + 1)] + [
+            f"{module}.{x}" for x in fromlist or () if isinstance(x, str) and x != "*"
+        ]
+        pending = [x for x in candidates if x not in sys.modules]
+        if not pending:
+            return self._original_import(name, globals, locals, fromlist, level)
+
+        stack: list[float] = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += cumulative
+            loaded = [x for x in pending if x in sys.modules]
+            if loaded:
+                label = loaded[0]
+                if len(loaded) > 1:
+                    label += f" (+{len(loaded) - 1})"
+                self.imports.append(
+                    ImportRecord(label, cumulative - children, cumulative)
+                )
+
+    def as_dict(self) -> dict:
+        return {
+            "total": time.perf_counter() - self.origin,
+            "modules": len(sys.modules),
+            "spans": [
+                {"name": x.name, "start": x.start, "duration": x.duration}
+                for x in self.spans
+            ],
+            "imports": [
+                {
+                    "module": x.module,
+                    "self_time": x.self_time,
+                    "cumulative": x.cumulative,
+                }
+                for x in sorted(self.imports, key=lambda x: x.cumulative, reverse=True)
+            ],
+        }
+
+    def format_report(self) -> str:
+        data = self.as_dict()
+        lines = [
+            f"rpoisel startup profile: {data['total'] * 1000:.1f} ms total, "
+            f"{data['modules']} modules loaded",
+            "",
+            f"{'phase':<40} {'start ms':>10} {'ms':>10}",
+        ]
+        for span in sorted(self.spans, key=lambda x: x.duration, reverse=True):
+            lines.append(
+                f"{span.name:<40} {span.start * 1000:>10.1f} {span.duration * 1000:>10.1f}"
+            )
+        lines += ["", f"{'import':<40} {'self ms':>10} {'cumul. ms':>10}"]
+        for record in data["imports"][:_TOP_IMPORTS]:
+            lines.append(
+                f"{record['module'][:40]:<40} {record['self_time'] * 1000:>10.1f} "
+                f"{record['cumulative'] * 1000:>10.1f}"
+            )
+        return "\n".join(lines)
+
+    def write_report(self) -> None:
+        import json
+
+        self.unhook_imports()
+        if self.output is None:
+            print(self.format_report(), file=sys.stderr)
+            return
+        with open(self.output, "w") as output:
+            json.dump(self.as_dict(), output, indent=2)
+            output.write("\n")
+
+
+def _absolute_name(name: str, globals: dict | None, level: int) -> str:
+    # same resolution as importlib; importing importlib.util here would recurse
+    if not level:
+        return name
+    package = (globals or {}).get("__package__") or ""
+    bits = package.rsplit(".", level - 1)
+    if not package or len(bits) < level:
+        return name
+    return f"{bits[0]}.{name}" if name else bits[0]
+
+
+class _Span:
+    __slots__ = ("_profile", "_name")
+
+    def __init__(self, profile: StartupProfile, name: str) -> None:
+        self._profile = profile
+        self._name = name
+
+    def __enter__(self) -> None:
+        self._profile.begin(self._name)
+
+    def __exit__(self, *exc_info) -> None:
+        self._profile.end(self._name)
+
+
+class _NoSpan:
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+_profile: StartupProfile | None = None
+
+
+def active() -> bool:
+    return _profile is not None
+
+
+def install(output: str | None = None) -> None:
+    """Start profiling and report when the process exits."""
+    import atexit
+
+    global _profile
+    if _profile is not None:
+        return
+    _profile = StartupProfile(output)
+    _profile.hook_imports()
+    atexit.register(_profile.write_report)
+
+
+def install_from_environment() -> None:
+    value = os.environ.get(ENV_VAR, "")
+    if value and value != "0":
+        install(None if value == "1" else value)
+    elif FLAG in sys.argv[1:]:
+        install()
+
+
+def begin(name: str) -> None:
+    if _profile is not None:
+        _profile.begin(name)
+
+
+def end(name: str) -> None:
+    if _profile is not None:
+        _profile.end(name)
+
+
+def span(name: str) -> _Span | _NoSpan:
+    if _profile is None:
+        return _NO_SPAN
+    return _Span(_profile, name)
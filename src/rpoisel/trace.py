@@ -0,0 +1,185 @@
+"""Tracing of the slow parts of an rpoisel invocation.
+
+``--trace PATH`` records a span for every child process started through
+``rpoisel.util.process`` or ``subprocess.run``, every relay request and
+every QMP command, and writes them to PATH when the command is done: one
+JSON object per line, or with ``--trace-format chrome`` the trace-event
+format that chrome://tracing and Perfetto load. Spans carry a name, the
+start relative to the beginning of the trace and a duration, both in
+seconds, and attributes such as the argv and exit status.
+
+While tracing is off, ``span`` hands out a shared no-op context manager,
+so instrumented code pays for little more than a function call, and
+``json`` is only imported once there is a trace to write.
+"""
+
+import os
+import threading
+import time
+
+FLAG = "--trace"
+
+
+class Span:
+    __slots__ = ("name", "start", "duration", "thread", "attrs", "_tracer")
+
+    def __init__(self, tracer: "Tracer", name: str, attrs: dict) -> None:
+        self._tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.start = 0.0
+        self.duration = 0.0
+        self.thread = threading.get_ident()
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.duration = time.perf_counter() - self.start
+        if exc is not None and "error" not in self.attrs:
+            self.attrs["error"] = f"{exc_type.__name__}: {exc}"
+        self._tracer.spans.append(self)
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def set(self, **attrs) -> None:
+        pass
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Tracer:
+    def __init__(self, output: str, format: str = "jsonl") -> None:
+        self.output = output
+        self.format = format
+        self.origin = time.perf_counter()
+        self.spans: list[Span] = []
+
+    def span(self, name: str, **attrs) -> Span:
+        return Span(self, name, attrs)
+
+    def add(self, name: str, start: float, duration: float, **attrs) -> None:
+        span = Span(self, name, attrs)
+        span.start = start
+        span.duration = duration
+        self.spans.append(span)
+
+    def as_dicts(self) -> list[dict]:
+        return [
+            {
+                "name": x.name,
+                "start": x.start - self.origin,
+                "duration": x.duration,
+                **x.attrs,
+            }
+            for x in sorted(self.spans, key=lambda x: x.start)
+        ]
+
+    def as_chrome_trace(self) -> dict:
+        pid = os.getpid()
+        return {
+            "traceEvents": [
+                {
+                    "name": x.name,
+                    "ph": "X",
+                    "ts": (x.start - self.origin) * 1e6,
+                    "dur": x.duration * 1e6,
+                    "pid": pid,
+                    "tid": x.thread,
+                    "args": x.attrs,
+                }
+                for x in sorted(self.spans, key=lambda x: x.start)
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def write(self) -> None:
+        import json
+
+        with open(self.output, "w") as output:
+            if self.format == "chrome":
+                json.dump(self.as_chrome_trace(), output, default=str)
+                output.write("\n")
+                return
+            for record in self.as_dicts():
+                output.write(json.dumps(record, default=str) + "\n")
+
+
+def _program(args) -> str:
+    if isinstance(args, (str, bytes, os.PathLike)):
+        args = os.fsdecode(args).split(maxsplit=1) or [""]
+    return os.path.basename(os.fsdecode(args[0]))
+
+
+def _traced_run(*args, **kwargs):
+    import subprocess
+
+    assert _original_run is not None, "subprocess.run is only replaced while tracing"
+    argv = args[0] if args else kwargs.get("args")
+    with span(_program(argv), argv=argv) as child:
+        try:
+            completed = _original_run(*args, **kwargs)
+        except subprocess.CalledProcessError as exc:
+            child.set(status=exc.returncode)
+            raise
+        child.set(status=completed.returncode)
+        return completed
+
+
+_tracer: Tracer | None = None
+_original_run = None
+
+
+def active() -> bool:
+    return _tracer is not None
+
+
+def install(output: str, format: str = "jsonl") -> None:
+    """Start tracing to output, also of subprocess.run until uninstall."""
+    import subprocess
+
+    global _tracer, _original_run
+    if _tracer is not None:
+        return
+    _tracer = Tracer(output, format)
+    _original_run = subprocess.run
+    setattr(subprocess, "run", _traced_run)
+
+
+def uninstall() -> None:
+    """Stop tracing and write the spans."""
+    import subprocess
+
+    global _tracer, _original_run
+    tracer = _tracer
+    if tracer is None:
+        return
+    if subprocess.run is _traced_run:
+        setattr(subprocess, "run", _original_run)
+    _tracer = _original_run = None
+    tracer.write()
+
+
+def span(name: str, **attrs) -> Span | _NoSpan:
+    if _tracer is None:
+        return _NO_SPAN
+    return _tracer.span(name, **attrs)
+
+
+def add(name: str, start: float, duration: float, **attrs) -> None:
+    """Record a span measured elsewhere, start is a time.perf_counter value."""
+    if _tracer is not None:
+        _tracer.add(name, start, duration, **attrs)
@@ -1,7 +1,12 @@
 from .cli import AliasedGroup
-from .process import run_shell_check
+from .process import ProcessResult, run, run_pipeline, run_shell_check
+from .xdg import xdg_path
 
 __all__ = [
     "AliasedGroup",
+    "ProcessResult",
+    "run",
+    "run_pipeline",
     "run_shell_check",
+    "xdg_path",
 ]
@@ -1,20 +1,256 @@
+import bisect
+import hashlib
+import importlib
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import ClassVar
+
+import click
+import typer
+import typer.main
 from typer.core import TyperGroup
 
+from .. import profile
+
+PACKAGE_DIR = Path(__file__).resolve().parent.parent
+
+# set in the context while a group renders its help page
+_LISTING_KEY = "rpoisel.listing"
+# set in the context to collect the completions a static script computes itself
+_COMPLETION_SOURCES_KEY = "rpoisel.completion_sources"
+# minimum rapidfuzz score for a "did you mean" suggestion
+_SUGGESTION_CUTOFF = 60
+_SUGGESTIONS = 3
+
+
+@dataclass(frozen=True)
+class LazyCommand:
+    module: str
+    help: str
+    # whether `rpoisel daemon` may serve the command, not if it runs sudo, which
+    # would ask for the password on the terminal of the daemon
+    daemon: bool = True
+    # arguments that need the client process, because the command keeps running
+    # and would tie up the daemon, or it runs sudo
+    in_process_args: tuple[str, ...] = ()
+
+
+def source_fingerprint(package_dir: Path = PACKAGE_DIR) -> str:
+    """Hash the paths, sizes and modification times of the package sources.
+
+    Files generated from the command tree record it to tell whether they
+    are current without importing the commands.
+    """
+    digest = hashlib.sha256()
+    for path in sorted(package_dir.rglob("*.py")):
+        stat = path.stat()
+        digest.update(
+            f"{path.relative_to(package_dir)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode()
+        )
+    return digest.hexdigest()[:16]
+
+
+@dataclass(frozen=True)
+class GlobCompletion:
+    """Complete names of the files in directory starting with prefix.
+
+    The prefix is not part of the completed names. Static completion scripts
+    list the directory themselves instead of asking rpoisel, see
+    ``static_completions``.
+    """
+
+    directory: Path
+    prefix: str
+
+    def names(self) -> list[str]:
+        try:
+            entries = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(
+            x[len(self.prefix) :]
+            for x in entries
+            if x.startswith(self.prefix) and len(x) > len(self.prefix)
+        )
+
+    def __call__(self, ctx: click.Context, incomplete: str) -> list[str]:
+        sources = ctx.meta.get(_COMPLETION_SOURCES_KEY)
+        if sources is not None:
+            sources.append(self)
+            return []
+        return [x for x in self.names() if x.startswith(incomplete)]
+
+
+def static_completions(
+    ctx: click.Context, param: click.Parameter
+) -> tuple[list[str], list[GlobCompletion]]:
+    """Return the fixed words param completes to and the globs listed on the fly."""
+    globs: list[GlobCompletion] = []
+    ctx.meta[_COMPLETION_SOURCES_KEY] = globs
+    try:
+        items = param.shell_complete(ctx, "")
+    finally:
+        del ctx.meta[_COMPLETION_SOURCES_KEY]
+    return [str(x.value) for x in items if x.type == "plain" and x.value], globs
+
+
+class CommandIndex:
+    """Sorted command names answering prefix queries with bisect."""
+
+    def __init__(self, names) -> None:
+        self.names = sorted(set(names))
+
+    def __contains__(self, name: str) -> bool:
+        i = bisect.bisect_left(self.names, name)
+        return i < len(self.names) and self.names[i] == name
+
+    def complete(self, prefix: str) -> list[str]:
+        """Return the names starting with prefix, in order."""
+        start = bisect.bisect_left(self.names, prefix)
+        # every name with the prefix sorts before prefix + the largest character
+        end = bisect.bisect_left(self.names, prefix + "\U0010ffff", start)
+        return self.names[start:end]
+
+    def suggest(self, name: str) -> list[str]:
+        """Return the names closest to a misspelt name, best match first."""
+        # only needed on errors, keep it out of every other invocation
+        from rapidfuzz import process
+
+        return [
+            match
+            for match, _, _ in process.extract(
+                name,
+                self.names,
+                limit=_SUGGESTIONS,
+                score_cutoff=_SUGGESTION_CUTOFF,
+            )
+        ]
+
 
 class AliasedGroup(TyperGroup):
+    _index: CommandIndex | None = None
+
+    def command_index(self, ctx) -> CommandIndex:
+        # built on first use, commands added later are taken in by add_command
+        if self._index is None:
+            self._index = CommandIndex(self.list_commands(ctx))
+        return self._index
+
+    def add_command(self, cmd, name=None):
+        super().add_command(cmd, name)
+        name = name or cmd.name
+        if self._index is not None and name not in self._index:
+            self._index = None
+
     def get_command(self, ctx, cmd_name):
-        rv = TyperGroup.get_command(self, ctx, cmd_name)
+        rv = self.lookup_command(ctx, cmd_name)
         if rv is not None:
             return rv
-        matches = [x for x in self.list_commands(ctx) if x.startswith(cmd_name)]
-        if not matches:
-            return None
-        elif len(matches) == 1:
-            return TyperGroup.get_command(self, ctx, matches[0])
-        ctx.fail(f"Too many matches: {', '.join(sorted(matches))}")
+        index = self.command_index(ctx)
+        matches = index.complete(cmd_name)
+        if len(matches) == 1:
+            return self.lookup_command(ctx, matches[0])
+        elif matches:
+            ctx.fail(f"Too many matches: {', '.join(matches)}")
+        if not cmd_name.startswith("-") and not ctx.resilient_parsing:
+            suggestions = index.suggest(cmd_name)
+            if suggestions:
+                ctx.fail(
+                    f"No such command {cmd_name!r}. "
+                    f"Did you mean {', '.join(suggestions)}?"
+                )
+        return None
+
+    def lookup_command(self, ctx, cmd_name):
+        return TyperGroup.get_command(self, ctx, cmd_name)
+
+    def command_help(self, ctx, cmd_name) -> str:
+        command = self.lookup_command(ctx, cmd_name)
+        return command.get_short_help_str() if command is not None else ""
+
+    def shell_complete(self, ctx, incomplete):
+        from click.shell_completion import CompletionItem
+
+        # unlike click's, this does not resolve every command to list its help
+        results = [
+            CompletionItem(x, help=self.command_help(ctx, x))
+            for x in self.command_index(ctx).complete(incomplete)
+        ]
+        results.extend(click.Command.shell_complete(self, ctx, incomplete))
+        return results
 
     def resolve_command(self, ctx, args):
         # always return the full command name
         _, cmd, args = super().resolve_command(ctx, args)
         assert cmd, "resolved command must not be None"
         return cmd.name, cmd, args
+
+
+class LazyGroup(AliasedGroup):
+    """Group whose commands are imported only once they are resolved.
+
+    Subclasses provide ``lazy_commands``, mapping each command name to the
+    module that defines it. The module must expose ``register(app)`` which
+    adds a command of that name to the given Typer instance.
+    """
+
+    lazy_commands: dict[str, LazyCommand] = {}
+    # built once from lazy_commands, for every group of this class
+    _shared_index: ClassVar[CommandIndex | None] = None
+
+    @classmethod
+    def shared_index(cls) -> CommandIndex:
+        index = cls.__dict__.get("_shared_index")
+        if index is None:
+            index = cls._shared_index = CommandIndex(cls.lazy_commands)
+        return index
+
+    def command_index(self, ctx) -> CommandIndex:
+        if self.commands.keys() <= self.lazy_commands.keys():
+            return self.shared_index()
+        # commands were added besides the lazy ones
+        return super().command_index(ctx)
+
+    def list_commands(self, ctx):
+        eager = [x for x in super().list_commands(ctx) if x not in self.lazy_commands]
+        return [*self.lazy_commands, *eager]
+
+    def lookup_command(self, ctx, cmd_name):
+        entry = self.lazy_commands.get(cmd_name)
+        if entry is not None and cmd_name not in self.commands:
+            if ctx.meta.get(_LISTING_KEY):
+                # the help page only needs name and help text
+                return click.Command(cmd_name, help=entry.help)
+            self.add_command(self._load_command(cmd_name, entry), cmd_name)
+        return super().lookup_command(ctx, cmd_name)
+
+    def command_help(self, ctx, cmd_name) -> str:
+        entry = self.lazy_commands.get(cmd_name)
+        if entry is not None and cmd_name not in self.commands:
+            return entry.help
+        return super().command_help(ctx, cmd_name)
+
+    def main(self, *args, **kwargs):
+        profile.end("build cli")
+        profile.begin("dispatch")
+        return super().main(*args, **kwargs)
+
+    def format_help(self, ctx, formatter):
+        ctx.meta[_LISTING_KEY] = True
+        try:
+            super().format_help(ctx, formatter)
+        finally:
+            del ctx.meta[_LISTING_KEY]
+
+    @staticmethod
+    def _load_command(name: str, entry: LazyCommand) -> click.Command:
+        with profile.span(f"import {entry.module}"):
+            module = importlib.import_module(entry.module)
+        with profile.span(f"register {name}"):
+            registry = typer.Typer()
+            module.register(registry)
+            command = typer.main.get_group(registry).commands[name]
+        if command.help is None:
+            command.help = entry.help
+        return command
@@ -1,5 +1,44 @@
+import codecs
+import logging
+import os
+import selectors
+import signal
 import subprocess
 import sys
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import IO, Callable
+
+from .. import trace
+
+# long enough for autorandr and friends, short enough to notice a hung child
+DEFAULT_TIMEOUT = 60.0
+# time children get to exit after SIGTERM before they are killed
+KILL_GRACE = 2.0
+_READ_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ProcessResult:
+    args: list[str]
+    returncode: int
+    duration: float
+    stdout: str
+    stderr: str
+
+
+# the most recent children, bounded for the long-running daemon
+history: deque[ProcessResult] = deque(maxlen=256)
+
+
+def _print_problem(exc: subprocess.CalledProcessError) -> None:
+    print(
+        f"Problem (returncode={exc.returncode}): {exc.stdout} {exc.stderr}",
+        file=sys.stderr,
+    )
 
 
 def run_shell_check(args: str | list[str]) -> str:
@@ -14,8 +53,207 @@ def run_shell_check(args: str | list[str]) -> str:
         )
         return completed_process.stdout
     except subprocess.CalledProcessError as exc:
-        print(
-            f"Problem (returncode={exc.returncode}): {exc.stdout} {exc.stderr}",
-            file=sys.stderr,
-        )
+        _print_problem(exc)
         raise
+
+
+def run(
+    args: list[str],
+    *,
+    timeout: float | None = DEFAULT_TIMEOUT,
+    on_stdout: Callable[[str], None] | None = None,
+    on_stderr: Callable[[str], None] | None = None,
+    check: bool = True,
+    interactive: bool = False,
+) -> ProcessResult:
+    """Execute args without a shell, see run_pipeline."""
+    return run_pipeline(
+        [args],
+        timeout=timeout,
+        on_stdout=on_stdout,
+        on_stderr=on_stderr,
+        check=check,
+        interactive=interactive,
+    )[0]
+
+
+def run_pipeline(
+    commands: list[list[str]],
+    *,
+    timeout: float | None = DEFAULT_TIMEOUT,
+    on_stdout: Callable[[str], None] | None = None,
+    on_stderr: Callable[[str], None] | None = None,
+    check: bool = True,
+    interactive: bool = False,
+) -> list[ProcessResult]:
+    """Connect commands like a shell pipeline and return one result per child.
+
+    Output lines are passed to on_stdout / on_stderr as they arrive; the
+    results hold them too, stdout only for the last command. The children
+    are killed once timeout seconds have passed, raising
+    subprocess.TimeoutExpired. With check, a failing child raises
+    subprocess.CalledProcessError like a shell with pipefail would.
+
+    Children get their own process group, so killing it also takes down
+    whatever they started. Interactive children stay in ours instead and
+    inherit stdin, so that sudo can ask for a password on the terminal.
+    """
+    start = time.perf_counter()
+    deadline = None if timeout is None else start + timeout
+    processes: list[subprocess.Popen] = []
+    durations: dict[int, float] = {}
+    stderr_lines: list[list[str]] = []
+    stdout_lines: list[str] = []
+    stdin = None if interactive else subprocess.DEVNULL
+    stdout: IO[bytes] | None = None
+    selector = selectors.DefaultSelector()
+    try:
+        for args in commands:
+            group = None if interactive else processes[0].pid if processes else 0
+            process = subprocess.Popen(
+                args,
+                stdin=stdin,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                process_group=group,
+            )
+            assert process.stdout is not None and process.stderr is not None
+            if stdout is not None:
+                # the next child owns it now, so it gets SIGPIPE when this one exits
+                stdout.close()
+            stdin = stdout = process.stdout
+            processes.append(process)
+            stderr_lines.append([])
+            _register(selector, process.stderr, stderr_lines[-1], on_stderr)
+            # readable once the child has exited, unlike Popen.wait this
+            # does not poll
+            selector.register(os.pidfd_open(process.pid), selectors.EVENT_READ, process)
+        assert stdout is not None, "no commands given"
+        _register(selector, stdout, stdout_lines, on_stdout)
+
+        while selector.get_map():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(processes[0].args, timeout or 0)
+            for key, _ in selector.select(remaining):
+                if isinstance(key.data, subprocess.Popen):
+                    key.data.wait()
+                    durations[key.data.pid] = time.perf_counter() - start
+                    selector.unregister(key.fd)
+                    os.close(key.fd)
+                elif not key.data.read():
+                    selector.unregister(key.fileobj)
+    except BaseException as exc:
+        # also on Ctrl-C, which does not reach a separate process group
+        if processes:
+            _kill(processes, group=not interactive)
+        if isinstance(exc, subprocess.TimeoutExpired):
+            stderr = "".join(x for lines in stderr_lines for x in lines)
+            raise subprocess.TimeoutExpired(
+                exc.cmd, timeout or 0, "".join(stdout_lines), stderr
+            ) from None
+        raise
+    finally:
+        for key in list(selector.get_map().values()):
+            if isinstance(key.data, subprocess.Popen):
+                os.close(key.fd)
+        selector.close()
+        for process in processes:
+            for pipe in [process.stdout, process.stderr]:
+                if pipe is not None:
+                    pipe.close()
+
+    results = [
+        ProcessResult(
+            args=list(args),
+            returncode=process.returncode,
+            duration=durations[process.pid],
+            stdout="".join(stdout_lines) if process is processes[-1] else "",
+            stderr="".join(lines),
+        )
+        for args, process, lines in zip(commands, processes, stderr_lines)
+    ]
+    for result in results:
+        history.append(result)
+        trace.add(
+            os.path.basename(result.args[0]),
+            start,
+            result.duration,
+            argv=result.args,
+            status=result.returncode,
+        )
+        logger.debug(
+            "%s exited with %d after %.1f ms",
+            result.args,
+            result.returncode,
+            result.duration * 1000,
+        )
+    failed = [x for x in results if x.returncode != 0]
+    if check and failed:
+        exc = subprocess.CalledProcessError(
+            failed[-1].returncode,
+            failed[-1].args,
+            results[-1].stdout,
+            failed[-1].stderr,
+        )
+        _print_problem(exc)
+        raise exc
+    return results
+
+
+class _LineReader:
+    def __init__(
+        self, pipe: IO[bytes], lines: list[str], callback: Callable[[str], None] | None
+    ) -> None:
+        self._pipe = pipe
+        self._lines = lines
+        self._callback = callback
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._partial = ""
+
+    def read(self) -> bool:
+        """Pass on the complete lines read, return False at the end of output."""
+        chunk = os.read(self._pipe.fileno(), _READ_SIZE)
+        *lines, self._partial = (
+            self._partial + self._decoder.decode(chunk, final=not chunk)
+        ).split("\n")
+        if not chunk and self._partial:
+            lines.append(self._partial)
+        for line in lines:
+            self._lines.append(line + "\n")
+            if self._callback is not None:
+                self._callback(line)
+        return bool(chunk)
+
+
+def _register(
+    selector: selectors.BaseSelector,
+    pipe: IO[bytes],
+    lines: list[str],
+    callback: Callable[[str], None] | None,
+) -> None:
+    selector.register(pipe, selectors.EVENT_READ, _LineReader(pipe, lines, callback))
+
+
+def _kill(processes: list[subprocess.Popen], group: bool) -> None:
+    def send(sig: signal.Signals) -> None:
+        try:
+            if group:
+                os.killpg(processes[0].pid, sig)
+            else:
+                for process in processes:
+                    process.send_signal(sig)
+        except ProcessLookupError:
+            pass
+
+    send(signal.SIGTERM)
+    deadline = time.perf_counter() + KILL_GRACE
+    try:
+        for process in processes:
+            process.wait(timeout=max(deadline - time.perf_counter(), 0))
+    except subprocess.TimeoutExpired:
+        send(signal.SIGKILL)
+    for process in processes:
+        process.wait()
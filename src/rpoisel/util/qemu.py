@@ -0,0 +1,207 @@
+import json
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+from typing import Optional
+
+QEMU_BINARY = "qemu-system-x86_64"
+# longest network interface name the kernel accepts
+IFNAMSIZ = 15
+HUGEPAGES_PATH = "/dev/hugepages"
+PRINTER_USB_ID = ("0x04e8", "0x3321")
+
+
+@dataclass(frozen=True)
+class Profile:
+    """Virtual hardware of a VM, tuned for a kind of workload."""
+
+    cores: int = 1
+    threads: int = 1
+    memory: str = "4G"
+    # back the guest memory with preallocated huge pages
+    hugepages: bool = False
+    nic: str = "e1000"
+    # virtio-net queue pairs, one per vCPU scales network processing
+    queues: int = 1
+    # a dedicated thread for disk I/O instead of the main loop
+    iothread: bool = False
+    cache: Optional[str] = None
+    aio: Optional[str] = None
+    discard: bool = False
+
+    @property
+    def cpus(self) -> int:
+        return self.cores * self.threads
+
+
+PROFILES: dict[str, Profile] = {
+    # emulated devices any guest has drivers for, what `vm` always started
+    "compat": Profile(),
+    # interactive guests with virtio drivers
+    "desktop": Profile(
+        cores=4,
+        memory="8G",
+        nic="virtio-net-pci",
+        queues=4,
+        iothread=True,
+        cache="none",
+        aio="io_uring",
+        discard=True,
+    ),
+    # throughput for compiling, all the host can spare
+    "build": Profile(
+        cores=8,
+        threads=2,
+        memory="32G",
+        hugepages=True,
+        nic="virtio-net-pci",
+        queues=8,
+        iothread=True,
+        cache="none",
+        aio="io_uring",
+        discard=True,
+    ),
+}
+DEFAULT_PROFILE = "compat"
+
+
+@dataclass(frozen=True)
+class VMSpec:
+    """Settings of a VM, kept next to its image across `create` and `start`."""
+
+    name: str
+    profile: str = DEFAULT_PROFILE
+    bridge: str = "bridge0"
+    vnc_display: int = 0
+    printer: bool = False
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["VMSpec"]:
+        try:
+            data = json.loads(path.read_text())
+        except FileNotFoundError:
+            return None
+        known = {x.name for x in fields(cls)}
+        spec = cls(**{k: v for k, v in data.items() if k in known})
+        if spec.profile not in PROFILES:
+            raise ValueError(f"unknown profile {spec.profile} in {path}")
+        return spec
+
+    def save(self, path: Path) -> None:
+        temporary = path.with_name(f"{path.name}.tmp")
+        temporary.write_text(json.dumps(asdict(self), indent=2) + "\n")
+        temporary.replace(path)
+
+    @property
+    def tap(self) -> str:
+        return f"tap-{self.name}"[:IFNAMSIZ]
+
+    def network_setup(self) -> list[list[str]]:
+        """Return the commands creating the tap device of multiqueue profiles.
+
+        The bridge backend opens a single queue, and its helper rejects queues=,
+        so multiqueue profiles attach to a tap created beforehand.
+        """
+        if PROFILES[self.profile].queues == 1:
+            return []
+        return [
+            ["ip", "tuntap", "add", "dev", self.tap, "mode", "tap", "multi_queue"],
+            ["ip", "link", "set", self.tap, "master", self.bridge, "up"],
+        ]
+
+    def argv(
+        self,
+        image: Path,
+        image_format: str,
+        qmp_socket: Path,
+        pid_file: Path,
+        iso: Optional[Path] = None,
+        incoming: Optional[str] = None,
+    ) -> list[str]:
+        """Return the QEMU command line, booting from iso if given.
+
+        Installing from iso runs in the foreground until the guest powers off.
+        With incoming, QEMU waits for the guest state instead of booting.
+        """
+        profile = PROFILES[self.profile]
+        argv = [
+            QEMU_BINARY,
+            "-accel",
+            "kvm",
+            "-cpu",
+            "host",
+            "-smp",
+            f"{profile.cpus},sockets=1,cores={profile.cores},threads={profile.threads}",
+            "-m",
+            profile.memory,
+        ]
+        if profile.hugepages:
+            argv += [
+                "-object",
+                f"memory-backend-file,id=mem0,size={profile.memory},"
+                f"mem-path={HUGEPAGES_PATH},prealloc=on,share=on",
+                "-machine",
+                "memory-backend=mem0",
+            ]
+        argv += self._network_args(profile)
+        argv += self._disk_args(profile, image, image_format)
+        if iso is not None:
+            argv += ["-cdrom", str(iso), "-boot", "d"]
+        if self.printer:
+            vendor, product = PRINTER_USB_ID
+            argv += [
+                "-device",
+                "usb-ehci,id=ehci",
+                "-device",
+                f"usb-host,vendorid={vendor},productid={product}",
+            ]
+        if incoming is not None:
+            argv += ["-incoming", incoming]
+        argv += ["-name", f"qemu-vm-{self.name},process=vm-{self.name}"]
+        if iso is None:
+            argv += ["-daemonize", "-serial", "none"]
+        argv += [
+            "-display",
+            f"vnc=:{self.vnc_display}",
+            "-qmp",
+            f"unix:{qmp_socket},server=on,wait=off",
+            "-pidfile",
+            str(pid_file),
+        ]
+        return argv
+
+    def _network_args(self, profile: Profile) -> list[str]:
+        if profile.queues > 1:
+            bridged = (
+                f"tap,id=net0,ifname={self.tap},script=no,downscript=no,"
+                f"vhost=on,queues={profile.queues}"
+            )
+            # one MSI-X vector per queue in each direction, plus config and control
+            nic = f"{profile.nic},netdev=net0,mq=on,vectors={2 * profile.queues + 2}"
+        else:
+            bridged = f"bridge,id=net0,br={self.bridge}"
+            nic = f"{profile.nic},netdev=net0"
+        return [
+            "-netdev",
+            bridged,
+            "-device",
+            nic,
+            "-netdev",
+            "user,id=net1",
+            "-device",
+            f"{profile.nic},netdev=net1",
+        ]
+
+    def _disk_args(self, profile: Profile, image: Path, image_format: str) -> list[str]:
+        drive = f"file={image},format={image_format},if=none,id=disk0"
+        if profile.cache:
+            drive += f",cache={profile.cache}"
+        if profile.aio:
+            drive += f",aio={profile.aio}"
+        if profile.discard:
+            drive += ",discard=unmap,detect-zeroes=unmap"
+        device = "virtio-blk-pci,drive=disk0"
+        args = []
+        if profile.iothread:
+            args += ["-object", "iothread,id=io0"]
+            device += ",iothread=io0"
+        return [*args, "-drive", drive, "-device", device]
@@ -0,0 +1,184 @@
+import asyncio
+import itertools
+import json
+from pathlib import Path
+from typing import Any, Optional
+
+from .. import trace
+
+# QMP replies such as query-qmp-schema easily exceed asyncio's 64 KiB default
+_STREAM_LIMIT = 16 * 1024 * 1024
+
+DEFAULT_TIMEOUT = 5.0
+
+
+class QMPError(RuntimeError):
+    """Error reply from QEMU for a command."""
+
+
+class AsyncQMPClient:
+    """QMP client keeping several commands in flight on one connection.
+
+    Commands are tagged with an ``id`` so replies can be matched regardless of
+    their order. Events are put into the queues returned by ``subscribe()``;
+    ``None`` is put there when the connection is lost. With ``reconnect``,
+    the next command transparently opens a new connection.
+    """
+
+    def __init__(
+        self,
+        qmp_socket: Path | str,
+        timeout: float = DEFAULT_TIMEOUT,
+        reconnect: bool = True,
+    ) -> None:
+        self.qmp_socket = str(qmp_socket)
+        self.timeout = timeout
+        self.reconnect = reconnect
+        self.greeting: dict[str, Any] = {}
+        self._ids = itertools.count()
+        self._pending: dict[int, asyncio.Future] = {}
+        self._subscribers: list[tuple[Optional[set[str]], asyncio.Queue]] = []
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._connect_lock = asyncio.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self._reader_task is not None and not self._reader_task.done()
+
+    async def connect(self) -> None:
+        async with self._connect_lock:
+            if self.connected:
+                return
+            if self._writer is not None:
+                self._writer.close()
+            try:
+                with trace.span("qmp connect", socket=self.qmp_socket):
+                    async with asyncio.timeout(self.timeout):
+                        reader, self._writer = await asyncio.open_unix_connection(
+                            self.qmp_socket, limit=_STREAM_LIMIT
+                        )
+                        self.greeting = json.loads(await reader.readline())
+            except ValueError as exc:
+                if self._writer is not None:
+                    self._writer.close()
+                raise ConnectionError(f"no QMP greeting on {self.qmp_socket}") from exc
+            except TimeoutError:
+                if self._writer is not None:
+                    self._writer.close()
+                raise
+            self._reader_task = asyncio.create_task(self._read_messages(reader))
+            # other commands are rejected until capabilities are negotiated
+            await self._execute("qmp_capabilities", None, None)
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+        self._writer = None
+        self._reader_task = None
+
+    async def __aenter__(self) -> "AsyncQMPClient":
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def subscribe(self, events: Optional[set[str]] = None) -> asyncio.Queue:
+        """Return a queue receiving the given events, or all of them."""
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.append((events, queue))
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers = [x for x in self._subscribers if x[1] is not queue]
+
+    async def execute(
+        self,
+        cmd: str,
+        arguments: Optional[dict[str, Any]] = None,
+        timeout: Optional[float] = None,
+    ) -> Any:
+        if not self.connected:
+            if self._writer is not None and not self.reconnect:
+                raise ConnectionError(f"QMP connection to {self.qmp_socket} lost")
+            await self.connect()
+        return await self._execute(cmd, arguments, timeout)
+
+    async def _execute(
+        self,
+        cmd: str,
+        arguments: Optional[dict[str, Any]],
+        timeout: Optional[float],
+    ) -> Any:
+        assert self._writer is not None, "connected client must have a writer"
+        command_id = next(self._ids)
+        message: dict[str, Any] = {"execute": cmd, "id": command_id}
+        if arguments:
+            message["arguments"] = arguments
+        future = asyncio.get_running_loop().create_future()
+        self._pending[command_id] = future
+        with trace.span(f"qmp {cmd}", socket=self.qmp_socket):
+            try:
+                self._writer.write(json.dumps(message).encode() + b"\n")
+                await self._writer.drain()
+                async with asyncio.timeout(timeout or self.timeout):
+                    response = await future
+            finally:
+                self._pending.pop(command_id, None)
+            if "error" in response:
+                raise QMPError(response["error"])
+            return response["return"]
+
+    async def _read_messages(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                if "event" in message:
+                    for events, queue in self._subscribers:
+                        if events is None or message["event"] in events:
+                            queue.put_nowait(message)
+                    continue
+                future = self._pending.get(message.get("id", -1))
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError(f"QMP connection to {self.qmp_socket} lost")
+                    )
+            for _, queue in self._subscribers:
+                queue.put_nowait(None)
+
+
+class QMPClient:
+    """Blocking wrapper around AsyncQMPClient for one command at a time."""
+
+    def __init__(
+        self, qmp_socket: Path | str, timeout: float = DEFAULT_TIMEOUT
+    ) -> None:
+        self.__runner = asyncio.Runner()
+        self.__client = AsyncQMPClient(qmp_socket, timeout=timeout, reconnect=False)
+        try:
+            self.__runner.run(self.__client.connect())
+        except BaseException:
+            self.__runner.close()
+            raise
+
+    def send_monitor_cmd(
+        self, cmd: str, arguments: Optional[dict[str, Any]] = None
+    ) -> Any:
+        return self.__runner.run(self.__client.execute(cmd, arguments))
+
+    def close(self) -> None:
+        self.__runner.run(self.__client.close())
+        self.__runner.close()
@@ -0,0 +1,23 @@
+import os
+from pathlib import Path
+from typing import Literal
+
+# environment variable and default of each XDG base directory
+_BASE_DIRS = {
+    "cache": ("XDG_CACHE_HOME", "~/.cache"),
+    "config": ("XDG_CONFIG_HOME", "~/.config"),
+    "state": ("XDG_STATE_HOME", "~/.local/state"),
+    "runtime": ("XDG_RUNTIME_DIR", None),
+}
+
+
+def xdg_path(kind: Literal["cache", "config", "state", "runtime"], *parts: str) -> Path:
+    """Return parts below an XDG base directory.
+
+    Without XDG_RUNTIME_DIR, runtime files go to $TMPDIR or /tmp.
+    """
+    env_var, default = _BASE_DIRS[kind]
+    base = os.environ.get(env_var)
+    if not base:
+        base = os.path.expanduser(default) if default else os.environ.get("TMPDIR")
+    return Path(base or "/tmp", *parts)
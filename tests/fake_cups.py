@@ -0,0 +1,73 @@
+"""Stand-ins for the CUPS lp, lpstat and cancel commands.
+
+Usage: python fake_cups.py lp|lpstat|cancel ARGS...
+
+Everything lives in ``$FAKE_PRINTED_DIR``: lp logs its arguments to
+``lp.log`` and copies the printed files there, stdin to ``stdin.pdf``. The
+queue is ``queue``, one "job-id user state" line per job. Jobs stay queued
+until a test completes them or they are cancelled. lp waits
+``$FAKE_LP_DELAY`` seconds before it queues a job.
+"""
+
+import os
+import pwd
+import shutil
+import sys
+import time
+from pathlib import Path
+
+PRINTED_DIR = Path(os.environ["FAKE_PRINTED_DIR"])
+QUEUE = PRINTED_DIR / "queue"
+
+
+def _read_queue() -> list[list[str]]:
+    if not QUEUE.exists():
+        return []
+    return [x.split() for x in QUEUE.read_text().splitlines()]
+
+
+def _write_queue(jobs: list[list[str]]) -> None:
+    QUEUE.write_text("".join(" ".join(x) + "\n" for x in jobs))
+
+
+def lp(args: list[str]) -> int:
+    time.sleep(float(os.environ.get("FAKE_LP_DELAY", "0")))
+    with (PRINTED_DIR / "lp.log").open("a") as log:
+        log.write(" ".join(args) + "\n")
+    files = [Path(x) for x in args if Path(x).is_file()]
+    for file in files:
+        shutil.copy(file, PRINTED_DIR)
+    if not files:
+        (PRINTED_DIR / "stdin.pdf").write_bytes(sys.stdin.buffer.read())
+    printer = args[args.index("-d") + 1]
+    jobs = _read_queue()
+    user = pwd.getpwuid(os.getuid()).pw_name
+    job_id = f"{printer}-{len(jobs) + 1}"
+    _write_queue(jobs + [[job_id, user, "queued"]])
+    print(f"request id is {job_id} ({max(len(files), 1)} file(s))")
+    return 0
+
+
+def lpstat(args: list[str]) -> int:
+    which = args[args.index("-W") + 1]
+    for job_id, user, state in _read_queue():
+        if which == "all" or (which == "completed") == (state != "queued"):
+            print(f"{job_id} {user} 1024 Sat 17 Oct 2026 12:00:00 PM UTC")
+    return 0
+
+
+def cancel(args: list[str]) -> int:
+    jobs = _read_queue()
+    for job_id in args:
+        matching = [x for x in jobs if x[0] == job_id]
+        if not matching:
+            print(f"cancel: Job {job_id} does not exist.", file=sys.stderr)
+            return 1
+        matching[0][2] = "cancelled"
+    _write_queue(jobs)
+    return 0
+
+
+if __name__ == "__main__":
+    commands = {"lp": lp, "lpstat": lpstat, "cancel": cancel}
+    sys.exit(commands[sys.argv[1]](sys.argv[2:]))
@@ -0,0 +1,51 @@
+"""Stand-in for ssh that runs the remote command locally.
+
+Connection setups are appended to ``$FAKE_SSH_LOG``, and remote commands
+to ``$FAKE_SSH_SESSION_LOG`` if set. Like ssh with
+``ControlMaster=auto``, a connection is only set up when no master is
+listening on the ``ControlPath``; the master is a file here. Every session
+waits ``$FAKE_SSH_LATENCY`` seconds, as a round trip to the host would, and
+stdin is forwarded at ``$FAKE_SSH_BANDWIDTH`` bytes per second if set.
+"""
+
+import hashlib
+import os
+import subprocess
+import sys
+import time
+
+
+def main(args: list[str]) -> None:
+    options: dict[str, str] = {}
+    while args[0] == "-o":
+        key, value = args[1].split("=", 1)
+        options[key] = value
+        args = args[2:]
+    host, remote_cmd = args[0], " ".join(args[1:])
+
+    control_path = options.get("ControlPath", "").replace(
+        "%C", hashlib.sha1(host.encode()).hexdigest()
+    )
+    if not control_path or not os.path.exists(control_path):
+        with open(os.environ["FAKE_SSH_LOG"], "a") as log:
+            log.write(f"{host} ControlPersist={options.get('ControlPersist')}\n")
+        if control_path and options.get("ControlMaster") == "auto":
+            open(control_path, "w").close()
+    if session_log := os.environ.get("FAKE_SSH_SESSION_LOG"):
+        with open(session_log, "a") as log:
+            log.write(remote_cmd.replace("\n", " ") + "\n")
+    time.sleep(float(os.environ.get("FAKE_SSH_LATENCY", "0")))
+    bandwidth = float(os.environ.get("FAKE_SSH_BANDWIDTH", "0"))
+    if not bandwidth:
+        os.execvp("bash", ["bash", "-c", remote_cmd])
+    with subprocess.Popen(["bash", "-c", remote_cmd], stdin=subprocess.PIPE) as process:
+        assert process.stdin is not None
+        while chunk := os.read(sys.stdin.fileno(), 64 * 1024):
+            time.sleep(len(chunk) / bandwidth)
+            process.stdin.write(chunk)
+        process.stdin.close()
+    sys.exit(process.returncode)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,210 @@
+"""Fake QEMU monitor speaking QMP on a Unix socket, running in its own thread."""
+
+import asyncio
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+GREETING = {
+    "QMP": {
+        "version": {"qemu": {"major": 9, "minor": 0, "micro": 0}, "package": ""},
+        "capabilities": [],
+    }
+}
+
+
+class FakeQMPServer:
+    """Answer QMP commands after ``latency`` seconds, like a busy QEMU would.
+
+    ``hang`` is never answered, stop/cont/system_powerdown emit the events
+    QEMU emits for them. The first ``refuse`` connections are closed without a
+    greeting. Migrations to and from ``exec:`` URIs run the command
+    and stream ``memory`` through it within ``migration_time`` seconds.
+    Commands in ``failing`` are answered with the error given for them.
+    """
+
+    def __init__(self, path: Path, latency: float = 0.0) -> None:
+        self.path = path
+        self.latency = latency
+        self.status = "running"
+        self.received: list[dict[str, Any]] = []
+        self.connections = 0
+        self.refuse = 0
+        self.memory = b""
+        self.migration_time = 0.0
+        self.migration_error: str | None = None
+        self.failing: dict[str, str] = {}
+        self._migration: dict[str, Any] = {"status": "none"}
+        self._writers: list[asyncio.StreamWriter] = []
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._server: asyncio.Server | None = None
+
+    def __enter__(self) -> "FakeQMPServer":
+        self._thread.start()
+        self._call(self._start())
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._call(self._stop())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    @property
+    def clients(self) -> int:
+        """Return the number of connected clients."""
+        return len(self._writers)
+
+    def emit(self, event: str, data: dict[str, Any] | None = None) -> None:
+        self._loop.call_soon_threadsafe(self._emit, event, data or {})
+
+    def disconnect(self) -> None:
+        """Drop all connections, as if QEMU restarted."""
+        self._call(self._disconnect())
+
+    def _call(self, coroutine) -> Any:
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _start(self) -> None:
+        self._server = await asyncio.start_unix_server(self._serve, str(self.path))
+
+    async def _stop(self) -> None:
+        await self._disconnect()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _disconnect(self) -> None:
+        for writer in self._writers:
+            writer.close()
+        self._writers.clear()
+
+    def _send(self, writer: asyncio.StreamWriter, message: dict[str, Any]) -> None:
+        if not writer.is_closing():
+            writer.write(json.dumps(message).encode() + b"\r\n")
+
+    def _emit(self, event: str, data: dict[str, Any]) -> None:
+        seconds, fraction = divmod(time.time(), 1)
+        message = {
+            "event": event,
+            "data": data,
+            "timestamp": {"seconds": int(seconds), "microseconds": int(fraction * 1e6)},
+        }
+        for writer in self._writers:
+            self._send(writer, message)
+
+    async def _serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.connections += 1
+        if self.refuse > 0:
+            self.refuse -= 1
+            writer.close()
+            return
+        self._writers.append(writer)
+        self._send(writer, GREETING)
+        negotiated = False
+        while line := await reader.readline():
+            message = json.loads(line)
+            self.received.append(message)
+            command = message["execute"]
+            if command == "hang":
+                continue
+            if command == "qmp_capabilities":
+                negotiated = True
+                response = {"return": {}}
+            elif not negotiated:
+                response = _error("CommandNotFound", "Expecting capabilities")
+            else:
+                response = self._execute(command, message.get("arguments", {}))
+            if "id" in message:
+                response["id"] = message["id"]
+            self._loop.call_later(self.latency, self._send, writer, response)
+        if writer in self._writers:
+            self._writers.remove(writer)
+
+    def _execute(self, command: str, arguments: dict[str, Any]) -> dict[str, Any]:
+        if command in self.failing:
+            return _error("GenericError", self.failing[command])
+        if command == "query-status":
+            return {
+                "return": {"status": self.status, "running": self.status == "running"}
+            }
+        if command == "query-version":
+            return {"return": GREETING["QMP"]["version"]}
+        if command == "stop":
+            self.status = "paused"
+            self._loop.call_later(self.latency, self._emit, "STOP", {})
+            return {"return": {}}
+        if command == "cont":
+            self.status = "running"
+            self._loop.call_later(self.latency, self._emit, "RESUME", {})
+            return {"return": {}}
+        if command == "system_powerdown":
+            self._loop.call_later(
+                self.latency, self._emit, "POWERDOWN", {"reason": "host-qmp-quit"}
+            )
+            return {"return": {}}
+        if command == "quit":
+            self._loop.call_later(self.latency, self._emit, "SHUTDOWN", {})
+            self._loop.call_later(
+                self.latency, lambda: asyncio.ensure_future(self._disconnect())
+            )
+            return {"return": {}}
+        if command == "migrate-set-capabilities":
+            return {"return": {}}
+        if command == "query-migrate":
+            return {"return": self._migration}
+        if command in ("migrate", "migrate-incoming"):
+            scheme, _, shell_command = arguments["uri"].partition(":")
+            assert scheme == "exec", "only exec migrations are faked"
+            asyncio.ensure_future(self._migrate(command, shell_command))
+            return {"return": {}}
+        return _error("CommandNotFound", f"The command {command} has not been found")
+
+    def _set_migration(self, status: str, **info: Any) -> None:
+        self._migration = {"status": status, **info}
+        self._emit("MIGRATION", {"status": status})
+
+    async def _migrate(self, command: str, shell_command: str) -> None:
+        self._set_migration("setup")
+        process = await asyncio.create_subprocess_shell(
+            shell_command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        self._set_migration("active")
+        if command == "migrate":
+            chunks = 10
+            size = -(-len(self.memory) // chunks)
+            for i in range(chunks):
+                self._migration["ram"] = {
+                    "transferred": i * size,
+                    "total": len(self.memory),
+                }
+                assert process.stdin is not None
+                process.stdin.write(self.memory[i * size : (i + 1) * size])
+                await process.stdin.drain()
+                await asyncio.sleep(self.migration_time / chunks)
+            process.stdin.close()
+            await process.wait()
+        else:
+            memory, _ = await process.communicate()
+            await asyncio.sleep(self.migration_time)
+        if self.migration_error or process.returncode:
+            error = self.migration_error or f"exec exited with {process.returncode}"
+            self._set_migration("failed", **{"error-desc": error})
+            return
+        if command == "migrate":
+            self.status = "postmigrate"
+        else:
+            self.memory = memory
+            self.status = "paused"
+        self._set_migration("completed")
+
+
+def _error(error_class: str, desc: str) -> dict[str, Any]:
+    return {"error": {"class": error_class, "desc": desc}}
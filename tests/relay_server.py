@@ -0,0 +1,85 @@
+"""A Shelly relay speaking just enough HTTP for the power command.
+
+The server listens on an ephemeral port on localhost; ``address`` is what
+goes into ``IP_MAPPING``. Every request waits ``latency`` seconds, the first
+``drop`` requests are answered by closing the connection, and connections
+are kept alive like the real relays do. Set ``status`` to answer with an
+error, ``body`` to answer with something other than the relay state.
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeRelay:
+    def __init__(self, latency: float = 0.0, drop: int = 0) -> None:
+        self.latency = latency
+        self.drop = drop
+        self.ison = False
+        self.status = 200
+        self.body: bytes | None = None
+        self.requests: list[str] = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever)
+
+    @property
+    def address(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"{host}:{port}"
+
+    def __enter__(self) -> "FakeRelay":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        relay = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self) -> None:
+                super().setup()
+                with relay._lock:
+                    relay.connections += 1
+
+            def do_GET(self) -> None:
+                with relay._lock:
+                    relay.requests.append(self.path)
+                    dropped = relay.drop > 0
+                    relay.drop -= dropped
+                time.sleep(relay.latency)
+                if dropped:
+                    self.close_connection = True
+                    return
+                url = urlparse(self.path)
+                if url.path != "/relay/0":
+                    self.send_error(404)
+                    return
+                if relay.status != 200:
+                    self.send_error(relay.status)
+                    return
+                if turn := parse_qs(url.query).get("turn"):
+                    relay.ison = turn[0] == "on"
+                body = relay.body or json.dumps({"ison": relay.ison}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: object) -> None:
+                pass
+
+        return Handler
@@ -0,0 +1,83 @@
+"""Run one rpoisel invocation in a fresh interpreter with side effects stubbed.
+
+Usage: python startup_driver.py [--stub NAME]... -- ARGS...
+
+Subprocesses and passphrase prompts are always stubbed, and state and cache
+files go to temporary directories. ``--stub httpx`` and ``--stub qmp``
+additionally stub network access and the QMP socket directory; they import
+the command's dependencies up front, which the command would load anyway.
+The last line of stdout is a JSON summary of the run.
+"""
+
+import getpass
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+
+def _fake_run(args, **kwargs) -> subprocess.CompletedProcess:
+    output = "" if kwargs.get("text") else b""
+    return subprocess.CompletedProcess(args, 0, stdout=output, stderr=output)
+
+
+class FakePopen(subprocess.Popen):
+    """Runs true instead of the command, so that pipes and exit codes are real."""
+
+    def __init__(self, args, **kwargs) -> None:
+        super().__init__(["true"], **kwargs)
+        self.args = args
+
+
+def stub_subprocesses() -> None:
+    setattr(subprocess, "run", _fake_run)
+    setattr(subprocess, "Popen", FakePopen)
+
+
+def _stub_httpx() -> None:
+    import httpx
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json={"ison": True}, request=request)
+
+    httpx.HTTPTransport.handle_request = handle_request
+
+
+def _stub_qmp() -> None:
+    from rpoisel.commands import vm
+
+    vm.QEMU_QMP_SOCKETS_BASE = Path(tempfile.mkdtemp(prefix="rpoisel-qmp-"))
+
+
+STUBS = {
+    "httpx": _stub_httpx,
+    "qmp": _stub_qmp,
+}
+
+
+def main(argv: list[str]) -> None:
+    separator = argv.index("--")
+    stubs = [x for x in argv[:separator] if x != "--stub"]
+    args = argv[separator + 1 :]
+
+    # import rpoisel first so the startup profile sees typer being loaded
+    from rpoisel import app
+
+    stub_subprocesses()
+    for name in ["XDG_CACHE_HOME", "XDG_STATE_HOME"]:
+        os.environ[name] = tempfile.mkdtemp(prefix="rpoisel-")
+    setattr(getpass, "getpass", lambda prompt="": "passphrase")
+    for stub in stubs:
+        STUBS[stub]()
+
+    from typer.testing import CliRunner
+
+    result = CliRunner().invoke(app, args)
+    print(result.output)
+    print(json.dumps({"exit_code": result.exit_code, "modules": len(sys.modules)}))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
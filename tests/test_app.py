@@ -0,0 +1,93 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from typer.testing import CliRunner
+
+from rpoisel import app
+
+IMPORTED_MODULES_SCRIPT = """
+import json
+import sys
+
+from startup_driver import stub_subprocesses
+
+stub_subprocesses()
+
+from typer.testing import CliRunner
+
+from rpoisel import app
+
+result = CliRunner().invoke(app, sys.argv[1:])
+print(json.dumps({"exit_code": result.exit_code, "modules": sorted(sys.modules)}))
+"""
+
+
+def _imported_modules(*args: str) -> list[str]:
+    # the tree under test and the stubs of the startup driver come first
+    pythonpath = [str(Path(__file__).parents[1] / "src"), str(Path(__file__).parent)]
+    if os.environ.get("PYTHONPATH"):
+        pythonpath.append(os.environ["PYTHONPATH"])
+    completed = subprocess.run(
+        [sys.executable, "-c", IMPORTED_MODULES_SCRIPT, *args],
+        check=True,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(pythonpath)},
+    )
+    report = json.loads(completed.stdout.splitlines()[-1])
+    assert report["exit_code"] == 0
+    return report["modules"]
+
+
+def test_non_network_command_skips_heavy_imports() -> None:
+    modules = _imported_modules("sleep")
+
+    assert "rpoisel.commands.sleep" in modules
+    assert "httpx" not in modules
+    assert "rapidfuzz" not in modules
+
+
+def test_help_does_not_import_commands() -> None:
+    modules = _imported_modules("--help")
+
+    assert not [x for x in modules if x.startswith("rpoisel.commands.")]
+
+
+def test_client_does_not_import_typer() -> None:
+    completed = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, rpoisel.client; print('typer' in sys.modules)",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+
+    assert completed.stdout.strip() == "False"
+
+
+def test_help_lists_registered_commands() -> None:
+    result = CliRunner().invoke(app, ["--help"])
+
+    assert result.exit_code == 0
+    for name in ["screen", "power", "sleep", "browser", "vm", "print", "modules"]:
+        assert name in result.output
+
+
+def test_unique_prefix_resolves_command() -> None:
+    result = CliRunner().invoke(app, ["scr", "--help"])
+
+    assert result.exit_code == 0
+    assert "rpoisel screen" in result.output
+
+
+def test_ambiguous_prefix_fails() -> None:
+    result = CliRunner().invoke(app, ["s", "1"])
+
+    assert result.exit_code != 0
+    assert "Too many matches: screen, sleep" in result.output
@@ -0,0 +1,154 @@
+import logging
+import sys
+import time
+
+import click
+import typer.main
+from click.shell_completion import ShellComplete
+from typer.testing import CliRunner
+
+from rpoisel import app
+from rpoisel.util.cli import CommandIndex, LazyCommand, LazyGroup
+
+COMMAND_COUNT = 300
+LOOKUPS = 2000
+
+logger = logging.getLogger(__name__)
+
+
+def _names(count: int) -> list[str]:
+    # groups of commands sharing prefixes, like "vm-start" and "vm-stop"
+    return [f"cmd{chr(ord('A') + x % 26)}-{x:04d}" for x in range(count)]
+
+
+class ManyCommandsGroup(LazyGroup):
+    lazy_commands = {
+        name: LazyCommand(f"nonexistent.{name}", f"Help of {name}")
+        for name in _names(COMMAND_COUNT)
+    }
+
+
+def test_complete_returns_names_with_prefix() -> None:
+    index = CommandIndex(["vm", "screen", "sleep", "sl", "power"])
+
+    assert index.complete("s") == ["screen", "sl", "sleep"]
+    assert index.complete("sl") == ["sl", "sleep"]
+    assert index.complete("x") == []
+    assert index.complete("") == ["power", "screen", "sl", "sleep", "vm"]
+    assert "sl" in index
+    assert "s" not in index
+
+
+def test_suggest_ranks_closest_names_first() -> None:
+    index = CommandIndex(["screen", "sleep", "power", "print", "modules"])
+
+    assert index.suggest("pirnt")[0] == "print"
+    assert index.suggest("zzzzzz") == []
+
+
+def test_misspelt_command_suggests_closest() -> None:
+    result = CliRunner().invoke(app, ["sreen", "1"])
+
+    assert result.exit_code != 0
+    assert "No such command 'sreen'. Did you mean screen" in result.output
+
+
+def test_exact_name_wins_over_longer_names() -> None:
+    group = ManyCommandsGroup(name="many")
+    group.add_command(click.Command("run"))
+    group.add_command(click.Command("runner"))
+
+    with click.Context(group) as ctx:
+        assert group.get_command(ctx, "run").name == "run"
+        assert group.get_command(ctx, "runn").name == "runner"
+
+
+def test_groups_share_one_index() -> None:
+    first, second = (typer.main.get_command(app) for _ in range(2))
+    assert isinstance(first, LazyGroup) and isinstance(second, LazyGroup)
+
+    with click.Context(first) as ctx:
+        # loaded commands keep using the index
+        assert first.get_command(ctx, "scr").name == "screen"
+        index = first.command_index(ctx)
+    with click.Context(second) as ctx:
+        assert second.command_index(ctx) is index
+
+
+def test_added_command_is_resolved_by_prefix() -> None:
+    group = ManyCommandsGroup(name="many")
+
+    with click.Context(group) as ctx:
+        assert group.get_command(ctx, "qq") is None
+        group.add_command(click.Command("qqquux"))
+        assert group.get_command(ctx, "qq").name == "qqquux"
+
+
+def test_completion_does_not_import_commands() -> None:
+    group = ManyCommandsGroup(name="many")
+    before = set(sys.modules)
+
+    items = ShellComplete(group, {}, "many", "_MANY_COMPLETE").get_completions(
+        [], "cmdA-000"
+    )
+
+    assert [x.value for x in items] == ["cmdA-0000"]
+    assert items[0].help == "Help of cmdA-0000"
+    assert not group.commands
+    assert set(sys.modules) == before
+
+
+def test_completion_of_top_level_commands() -> None:
+    complete = ShellComplete(
+        typer.main.get_command(app), {}, "rpoisel", "_RPOISEL_COMPLETE"
+    )
+
+    assert [x.value for x in complete.get_completions([], "s")] == ["screen", "sleep"]
+
+
+def _linear_resolve(names: list[str], prefix: str) -> list[str]:
+    return [x for x in names if x.startswith(prefix)]
+
+
+def test_index_benchmark() -> None:
+    names = _names(COMMAND_COUNT)
+    index = CommandIndex(names)
+    prefixes = [x[:6] for x in names] * (LOOKUPS // COMMAND_COUNT)
+
+    start = time.perf_counter()
+    linear = [_linear_resolve(names, x) for x in prefixes]
+    linear_time = time.perf_counter() - start
+    start = time.perf_counter()
+    indexed = [index.complete(x) for x in prefixes]
+    indexed_time = time.perf_counter() - start
+
+    assert [sorted(x) for x in linear] == indexed
+    logger.info(
+        "%d lookups among %d commands: linear %.2f µs, index %.2f µs per lookup",
+        len(prefixes),
+        COMMAND_COUNT,
+        linear_time / len(prefixes) * 1e6,
+        indexed_time / len(prefixes) * 1e6,
+    )
+    assert indexed_time < linear_time / 5
+
+
+def test_group_resolution_benchmark() -> None:
+    group = ManyCommandsGroup(name="many")
+    for name in group.lazy_commands:
+        # resolving must not import the fake modules
+        group.add_command(click.Command(name), name)
+    prefixes = [x[:8] for x in group.lazy_commands]
+
+    with click.Context(group) as ctx:
+        start = time.perf_counter()
+        for prefix in prefixes:
+            assert group.get_command(ctx, prefix) is not None
+        elapsed = time.perf_counter() - start
+
+    logger.info(
+        "prefix resolution among %d commands: %.2f µs per lookup",
+        COMMAND_COUNT,
+        elapsed / len(prefixes) * 1e6,
+    )
+    assert elapsed / len(prefixes) < 50e-6
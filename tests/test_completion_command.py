@@ -0,0 +1,209 @@
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import click
+import pytest
+import typer.main
+from typer.testing import CliRunner
+
+from rpoisel import app
+from rpoisel.commands import completion
+from rpoisel.util.cli import GlobCompletion, source_fingerprint
+
+RUNS = 5
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+@pytest.fixture(scope="module")
+def bash_script() -> str:
+    cli = typer.main.get_command(app)
+    return completion.generate(cli, completion.Shell.bash, "test")
+
+
+def _complete(script: str, *words: str) -> list[str]:
+    completed = subprocess.run(
+        [
+            "bash",
+            "-c",
+            f"""{script}
+COMP_WORDS=({shlex.join(["rpoisel", *words])})
+COMP_CWORD={len(words)}
+_rpoisel
+printf '%s\\n' "${{COMPREPLY[@]}}"
+""",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return completed.stdout.split()
+
+
+@pytest.mark.parametrize(
+    "words, expected",
+    [
+        (["s"], ["screen", "sleep"]),
+        (["--trace-format", ""], ["jsonl", "chrome"]),
+        (["--trace", "trace.json", "vm", "st"], ["start", "state", "stop"]),
+        (["scr", ""], ["1", "2", "3", "4", "watch"]),
+        (["power", "mic", "o"], ["other", "on", "off"]),
+        (["vm", "--j"], ["--json"]),
+        (["vm", "--size", "20G", "c"], ["create", "cont", "clone"]),
+        (["completion", ""], ["bash", "zsh", "fish"]),
+        (["sleep", ""], []),
+    ],
+)
+def test_bash_completes(bash_script: str, words: list[str], expected) -> None:
+    assert _complete(bash_script, *words) == expected
+
+
+def test_bash_completes_vm_names(bash_script: str, tmp_path: Path) -> None:
+    for name in ["qmp-win10", "qmp-debian", "unrelated"]:
+        (tmp_path / name).touch()
+    listing = "_rpoisel_glob /tmp qmp-"
+    assert listing in bash_script
+    script = bash_script.replace(listing, f"_rpoisel_glob {tmp_path} qmp-")
+
+    assert _complete(script, "vm", "start", "") == ["debian", "win10"]
+    assert _complete(script, "vm", "watch", "debian", "w") == ["win10"]
+
+
+def test_glob_completion_lists_names(tmp_path: Path) -> None:
+    for name in ["qmp-win10", "qmp-debian", "qmp-", "unrelated"]:
+        (tmp_path / name).touch()
+    complete = GlobCompletion(tmp_path, "qmp-")
+    ctx = click.Context(click.Command("vm"))
+
+    assert complete(ctx, "") == ["debian", "win10"]
+    assert complete(ctx, "w") == ["win10"]
+    assert GlobCompletion(tmp_path / "missing", "qmp-")(ctx, "") == []
+
+
+def test_fish_script_lists_choices() -> None:
+    cli = typer.main.get_command(app)
+    script = completion.generate(cli, completion.Shell.fish, "test")
+
+    assert "complete -c rpoisel -n '__rpoisel_is screen 0' -a '1 2 3 4 watch'" in script
+    assert "case sc scr scre scree screen" in script
+    assert "-l 'trace-format' -x -a 'jsonl chrome'" in script
+
+
+@pytest.mark.skipif(shutil.which("zsh") is None, reason="needs zsh")
+def test_zsh_script_completes_when_sourced(tmp_path: Path) -> None:
+    cli = typer.main.get_command(app)
+    script = tmp_path / "rpoisel.zsh"
+    script.write_text(completion.generate(cli, completion.Shell.zsh, "test"))
+
+    completed = subprocess.run(
+        [
+            "zsh",
+            "-f",
+            "-c",
+            f"""autoload -U compinit && compinit -u -D
+source {shlex.quote(str(script))}
+print -r -- "$_comps[rpoisel]"
+COMP_WORDS=(rpoisel scr '')
+COMP_CWORD=2
+compgen -F _rpoisel -- ''
+""",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+
+    registration, *words = completed.stdout.splitlines()
+    assert "-F _rpoisel" in registration
+    assert words == ["1", "2", "3", "4", "watch"]
+
+
+def test_script_is_cached(cache_home: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    result = CliRunner().invoke(app, ["completion", "bash"])
+    assert result.exit_code == 0
+    assert source_fingerprint() in result.output
+
+    def fail(*args) -> str:
+        raise AssertionError("script generated again")
+
+    monkeypatch.setattr(completion, "generate", fail)
+    cached = CliRunner().invoke(app, ["completion", "bash"])
+
+    assert cached.exit_code == 0
+    assert cached.output == result.output
+
+
+def test_changed_sources_generate_script_again(
+    cache_home: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    cli = typer.main.get_command(app)
+    monkeypatch.setattr(completion, "source_fingerprint", lambda: "old")
+    completion.completion_script(cli, completion.Shell.bash)
+    monkeypatch.setattr(completion, "source_fingerprint", lambda: "new")
+
+    script = completion.completion_script(cli, completion.Shell.bash)
+
+    assert "fingerprint new" in script
+    assert sorted(
+        x.name for x in (cache_home / "rpoisel" / "completion").iterdir()
+    ) == ["new.bash"]
+
+
+def test_fingerprint_follows_sources(tmp_path: Path) -> None:
+    source = tmp_path / "rpoisel" / "cli.py"
+    source.parent.mkdir()
+    source.write_text("x = 1\n")
+    before = source_fingerprint(tmp_path / "rpoisel")
+
+    source.write_text("x = 12\n")
+
+    assert source_fingerprint(tmp_path / "rpoisel") != before
+
+
+def test_static_completion_benchmark(bash_script: str, tmp_path: Path) -> None:
+    script = tmp_path / "rpoisel.bash"
+    script.write_text(bash_script)
+    static_command = [
+        "bash",
+        "-c",
+        f'source {script}; COMP_WORDS=(rpoisel scr ""); COMP_CWORD=2; _rpoisel',
+    ]
+    dynamic_command = [
+        sys.executable,
+        "-c",
+        "from rpoisel import app; app(prog_name='rpoisel')",
+    ]
+    dynamic_env = {
+        **os.environ,
+        "_RPOISEL_COMPLETE": "complete_bash",
+        "COMP_WORDS": "rpoisel scr ",
+        "COMP_CWORD": "2",
+    }
+
+    def measure(command: list[str], env=None) -> float:
+        timings = []
+        for _ in range(RUNS):
+            start = time.perf_counter()
+            subprocess.run(command, check=True, capture_output=True, env=env)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    static = measure(static_command)
+    dynamic = measure(dynamic_command, dynamic_env)
+
+    logger.info(
+        "completion: static %.1f ms, dynamic %.1f ms", static * 1000, dynamic * 1000
+    )
+    assert static < dynamic / 5
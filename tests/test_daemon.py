@@ -0,0 +1,239 @@
+import logging
+import os
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Mapping
+
+import pytest
+import typer.main
+from typer.testing import CliRunner
+
+from rpoisel import app, client
+from rpoisel.client import REQUEST, encode_request, run_remote, send_frame
+from rpoisel.commands.daemon import DaemonServer, _runs_in_daemon
+from rpoisel.util.process import ProcessResult
+
+CLIENT = "from rpoisel.client import main; main()"
+DRIVER = Path(__file__).with_name("startup_driver.py")
+RUNS = 20
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def shell_commands(monkeypatch, tmp_path: Path) -> list[str]:
+    commands: list[str] = []
+    # the daemon takes the environment of the client, which inherits this
+    monkeypatch.setenv("XDG_STATE_HOME", str(tmp_path))
+
+    def fake_run(args: list[str], **kwargs) -> ProcessResult:
+        commands.append(shlex.join(args))
+        return ProcessResult(args, 0, 0.0, "", "")
+
+    monkeypatch.setattr("rpoisel.commands.screen.run", fake_run)
+    return commands
+
+
+@pytest.fixture
+def daemon_socket(tmp_path: Path, shell_commands) -> Iterator[Path]:
+    path = tmp_path / "rpoisel.sock"
+    server = DaemonServer(path, typer.main.get_command(app))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield path
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def _client(
+    socket: Path, *args: str, input: str | None = None
+) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, "-c", CLIENT, *args],
+        input=input,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "RPOISEL_DAEMON_SOCKET": str(socket)},
+    )
+
+
+def test_daemon_runs_command(daemon_socket: Path, shell_commands) -> None:
+    completed = _client(daemon_socket, "scr", "2")
+
+    assert completed.returncode == 0, completed.stderr
+    assert "autorandr --load two" in shell_commands
+
+
+def test_daemon_forwards_stderr_and_exit_code(daemon_socket: Path) -> None:
+    completed = _client(daemon_socket, "print", "/does/not/exist.pdf")
+
+    assert completed.returncode == 1
+    assert "file not found" in completed.stderr
+
+
+def test_daemon_children_write_to_client_stderr(
+    monkeypatch, daemon_socket: Path
+) -> None:
+    def noisy_run(args: list[str], **kwargs) -> ProcessResult:
+        subprocess.run(["sh", "-c", "echo 'cannot open display' >&2"])
+        return ProcessResult(args, 0, 0.0, "", "")
+
+    monkeypatch.setattr("rpoisel.commands.screen.run", noisy_run)
+
+    completed = _client(daemon_socket, "scr", "2")
+
+    assert completed.returncode == 0, completed.stderr
+    assert "cannot open display" in completed.stderr
+
+
+def test_daemon_forwards_stdin(daemon_socket: Path) -> None:
+    completed = _client(daemon_socket, "print", input="hello")
+
+    assert completed.returncode == 1
+    assert "stdin data is not a valid PDF" in completed.stderr
+
+
+def test_daemon_declines_interactive_commands(
+    daemon_socket: Path, shell_commands
+) -> None:
+    completed = _client(daemon_socket, "modules", "--help")
+
+    assert completed.returncode == 0
+    assert "Sign kernel modules" in completed.stdout
+
+
+def test_daemon_leaves_blocking_commands_to_the_client() -> None:
+    cli = typer.main.get_command(app)
+
+    assert _runs_in_daemon(cli, ["screen", "2"])
+    assert not _runs_in_daemon(cli, ["screen", "watch"])
+    assert not _runs_in_daemon(cli, ["vm", "--json", "watch", "a"])
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["sleep"],
+        ["browser", "firefox"],
+        ["vm", "start", "dev"],
+        ["vm", "create", "dev", "--from", "debian"],
+        ["vm", "restore", "dev"],
+    ],
+)
+def test_sudo_runs_on_the_client_terminal(argv: list[str]) -> None:
+    # sudo asks for the password on the terminal of the process running it
+    assert not _runs_in_daemon(typer.main.get_command(app), argv)
+
+
+def test_client_runs_in_process_without_daemon(tmp_path: Path) -> None:
+    completed = _client(tmp_path / "missing.sock", "screen", "--help")
+
+    assert completed.returncode == 0
+    assert "rpoisel screen" in completed.stdout
+
+
+def test_socket_is_private(daemon_socket: Path) -> None:
+    assert daemon_socket.stat().st_mode & 0o777 == 0o600
+
+
+def test_no_shared_default_socket(monkeypatch, tmp_path: Path) -> None:
+    monkeypatch.delenv("RPOISEL_DAEMON_SOCKET", raising=False)
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+
+    assert client.socket_path() is None
+    assert run_remote(["screen", "2"]) is None
+    result = CliRunner().invoke(app, ["daemon"])
+    assert result.exit_code == 1
+    assert "XDG_RUNTIME_DIR is not set" in result.output
+
+
+def test_client_ignores_daemon_of_other_user(
+    monkeypatch, capsys, daemon_socket: Path, shell_commands
+) -> None:
+    monkeypatch.setattr(client, "peer_uid", lambda sock: os.getuid() + 1)
+
+    assert run_remote(["screen", "2"], str(daemon_socket)) is None
+    assert "another user listens on it" in capsys.readouterr().err
+    assert not shell_commands
+
+
+def test_daemon_ignores_other_users(
+    monkeypatch, daemon_socket: Path, shell_commands
+) -> None:
+    monkeypatch.setattr(
+        "rpoisel.commands.daemon.peer_uid", lambda sock: os.getuid() + 1
+    )
+
+    assert run_remote(["screen", "2"], str(daemon_socket)) is None
+    assert not shell_commands
+
+
+def test_client_falls_back_when_daemon_is_busy(monkeypatch, tmp_path: Path) -> None:
+    monkeypatch.setattr(client, "CONNECT_TIMEOUT", 0.1)
+    path = tmp_path / "busy.sock"
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as busy:
+        # connections wait in the backlog, like behind a long command
+        busy.bind(str(path))
+        busy.listen()
+
+        start = time.perf_counter()
+        assert run_remote(["screen", "2"], str(path)) is None
+        assert time.perf_counter() - start < 1.0
+
+
+def test_daemon_drops_stalled_clients(
+    monkeypatch, daemon_socket: Path, shell_commands
+) -> None:
+    monkeypatch.setattr("rpoisel.commands.daemon.REQUEST_TIMEOUT", 0.1)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stalled:
+        stalled.connect(str(daemon_socket))
+
+        completed = _client(daemon_socket, "scr", "2")
+
+    assert completed.returncode == 0, completed.stderr
+    assert "autorandr --load two" in shell_commands
+
+
+def test_daemon_skips_requests_given_up(daemon_socket: Path, shell_commands) -> None:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as impatient:
+        impatient.connect(str(daemon_socket))
+        send_frame(impatient, REQUEST, encode_request(["screen", "1"], False))
+
+    completed = _client(daemon_socket, "scr", "2")
+
+    assert completed.returncode == 0, completed.stderr
+    assert "autorandr --load two" in shell_commands
+    assert "autorandr --load one" not in shell_commands
+
+
+def _latencies(args: list[str], env: Mapping[str, str]) -> list[float]:
+    result: list[float] = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        subprocess.run(args, check=True, capture_output=True, env=env)
+        result.append((time.perf_counter() - start) * 1000)
+    return result
+
+
+def _summary(latencies: list[float]) -> tuple[float, float]:
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return statistics.median(latencies), percentiles[98]
+
+
+def test_daemon_latency_benchmark(daemon_socket: Path) -> None:
+    env = {**os.environ, "RPOISEL_DAEMON_SOCKET": str(daemon_socket)}
+    daemon = _summary(_latencies([sys.executable, "-c", CLIENT, "screen", "2"], env))
+    cold = _summary(
+        _latencies([sys.executable, str(DRIVER), "--", "screen", "2"], os.environ)
+    )
+
+    logger.info(f"daemon: p50 {daemon[0]:.1f} ms, p99 {daemon[1]:.1f} ms")
+    logger.info(f"cold:   p50 {cold[0]:.1f} ms, p99 {cold[1]:.1f} ms")
+    assert daemon[0] < cold[0]
@@ -1,6 +1,34 @@
+from pathlib import Path
+
+import pytest
+import typer
 import typer.main
+from typer.testing import CliRunner
 
 from rpoisel import ElispVisitor, app, visit_app
+from rpoisel.commands import elisp
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+
+def _balanced(code: str) -> bool:
+    depth = 0
+    in_string = escaped = False
+    for char in code:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == '"':
+            in_string = not in_string
+        elif not in_string and char in "()":
+            depth += 1 if char == "(" else -1
+            if depth < 0:
+                return False
+    return depth == 0 and not in_string
 
 
 def test_elisp_current() -> None:
@@ -8,3 +36,107 @@ def test_elisp_current() -> None:
     cli = typer.main.get_command(app)
     visit_app(cli, visitor)
     assert visitor.spit(), "at least something must be generated (for now)"
+
+
+def test_commands_run_asynchronously_with_arguments() -> None:
+    result = CliRunner().invoke(app, ["elisp"])
+
+    assert result.exit_code == 0
+    assert _balanced(result.output)
+    assert "shell-command" not in result.output
+    assert "(make-process" in result.output
+    assert "(defun rpoisel-screen (variant &optional force)" in result.output
+    assert (
+        '(completing-read "Variant: " \'("1" "2" "3" "4" "watch") nil t)'
+        in result.output
+    )
+    assert '(completing-read-multiple "Names: " (rpoisel--glob "/tmp" "qmp-"))' in (
+        result.output
+    )
+    assert '(when force \'("--force"))' in result.output
+    # empty answers leave options out instead of passing them without a value
+    assert (
+        '(when-let* ((value (rpoisel--values size))) (cons "--size" value))'
+        in result.output
+    )
+    assert '(and current-prefix-arg (rpoisel--read-file "Iso: "))' in result.output
+    assert (
+        '(and current-prefix-arg (rpoisel--read-number "Vnc display: "))'
+        in result.output
+    )
+    assert "(read-number" not in result.output
+    # the generating command is left out
+    assert "rpoisel-elisp" not in result.output
+
+
+def test_nested_commands_keep_their_path() -> None:
+    root = typer.Typer()
+    inner = typer.Typer()
+    root.add_typer(inner, name="outer")
+
+    @inner.command()
+    def leaf(count: int = typer.Option(1)) -> None:
+        pass
+
+    @root.command()
+    def other() -> None:
+        pass
+
+    visitor = ElispVisitor()
+    visit_app(typer.main.get_command(root), visitor)
+    code = visitor.spit()
+
+    assert "(defun rpoisel-outer-leaf (&optional count)" in code
+    assert '(append \'("outer" "leaf")' in code
+    assert '(and current-prefix-arg (rpoisel--read-number "Count: "))' in code
+
+
+def test_further_arguments_are_read() -> None:
+    result = CliRunner().invoke(app, ["elisp"])
+
+    assert result.exit_code == 0
+    assert "(defun rpoisel-print (args &optional jobs compress detach)" in result.output
+    assert '(rpoisel--read-args "Arguments: ")' in result.output
+    # commands reading stdin get its end instead of waiting for input
+    assert "(process-send-eof process)" in result.output
+
+
+def test_output_is_written_only_when_commands_change(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    output = tmp_path / "rpoisel.el"
+    cli = typer.main.get_command(app)
+
+    assert elisp.write_elisp(cli, output)
+    written = output.read_text()
+    mtime = output.stat().st_mtime_ns
+    assert _balanced(written)
+    assert written.startswith(";;; rpoisel.el")
+
+    def fail(*args) -> None:
+        raise AssertionError("commands generated again")
+
+    # unchanged sources skip generating
+    with monkeypatch.context() as patch:
+        patch.setattr(elisp, "visit_app", fail)
+        assert not elisp.write_elisp(cli, output)
+
+    # changed sources generating the same commands leave the file alone
+    monkeypatch.setattr(elisp, "source_fingerprint", lambda: "changed")
+    assert not elisp.write_elisp(cli, output)
+    assert output.stat().st_mtime_ns == mtime
+
+    monkeypatch.setattr(elisp, "source_fingerprint", lambda: "changed again")
+    monkeypatch.setattr(elisp, "PROG", "renamed")
+    assert elisp.write_elisp(cli, output)
+    assert output.read_text() != written
+
+
+def test_output_option_writes_file(tmp_path: Path) -> None:
+    output = tmp_path / "lisp" / "rpoisel.el"
+
+    result = CliRunner().invoke(app, ["elisp", "--output", str(output)])
+
+    assert result.exit_code == 0
+    assert result.output == ""
+    assert "(defun rpoisel-vm " in output.read_text()
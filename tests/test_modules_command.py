@@ -0,0 +1,245 @@
+import lzma
+import shutil
+import struct
+import subprocess
+import time
+from pathlib import Path
+
+import pytest
+from typer.testing import CliRunner
+
+from rpoisel import app
+from rpoisel.commands.modules import SIGNATURE_MAGIC
+
+pytestmark = pytest.mark.skipif(
+    shutil.which("openssl") is None, reason="openssl is required to sign modules"
+)
+
+# the tests replace subprocess.run, openssl still has to run for real
+_run = subprocess.run
+
+
+class Key:
+    def __init__(self, directory: Path, name: str) -> None:
+        self.key = directory / f"{name}.key"
+        self.pem = directory / f"{name}.pem"
+        self.der = directory / f"{name}.der"
+        _run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes"]
+            + ["-keyout", str(self.key), "-out", str(self.pem)]
+            + ["-subj", f"/CN={name}", "-days", "1"],
+            check=True,
+            capture_output=True,
+        )
+        _run(
+            ["openssl", "x509", "-in", str(self.pem), "-outform", "DER"]
+            + ["-out", str(self.der)],
+            check=True,
+        )
+
+    def sign(self, content: bytes) -> bytes:
+        """Return content with an appended signature, like sign-file does."""
+        signature = _run(
+            ["openssl", "cms", "-sign", "-binary", "-noattr", "-nocerts"]
+            + ["-outform", "DER", "-md", "sha256"]
+            + ["-signer", str(self.pem), "-inkey", str(self.key)],
+            input=content,
+            check=True,
+            capture_output=True,
+        ).stdout
+        info = struct.pack(">BBBBB3xI", 0, 0, 2, 0, 0, len(signature))
+        return content + signature + info + SIGNATURE_MAGIC
+
+
+@pytest.fixture(scope="module")
+def keys(tmp_path_factory) -> dict[str, Key]:
+    directory = tmp_path_factory.mktemp("keys")
+    return {name: Key(directory, name) for name in ["mok", "other"]}
+
+
+@pytest.fixture
+def modules_dir(monkeypatch, tmp_path: Path, keys: dict[str, Key]) -> Path:
+    monkeypatch.setattr("rpoisel.commands.modules.MODULES_BASE", tmp_path)
+    monkeypatch.setattr("rpoisel.commands.modules.MOK_CERTIFICATE", keys["mok"].der)
+    monkeypatch.setattr("rpoisel.commands.modules.platform.release", lambda: "6.1.0")
+    directory = tmp_path / "6.1.0" / "updates" / "dkms"
+    directory.mkdir(parents=True)
+    return directory
+
+
+@pytest.fixture
+def prompts(monkeypatch) -> list[str]:
+    prompts: list[str] = []
+    monkeypatch.setattr(
+        "rpoisel.commands.modules.getpass.getpass",
+        lambda prompt: prompts.append(prompt) or "secret",
+    )
+    return prompts
+
+
+def _content(name: str) -> bytes:
+    return f"ELF {name} ".encode() * 1000
+
+
+def _write_module(path: Path, content: bytes) -> Path:
+    path.write_bytes(lzma.compress(content))
+    return path
+
+
+def _fake_run(keys: dict[str, Key], calls: list[list[str]], fail: str = ""):
+    def run(args: list[str], **kwargs) -> subprocess.CompletedProcess:
+        calls.append(args)
+        if "sha256" in args:
+            module_ko = Path(args[-1])
+            if module_ko.name == fail:
+                return subprocess.CompletedProcess(args, 1, stdout="", stderr="")
+            module_ko.write_bytes(keys["mok"].sign(module_ko.read_bytes()))
+        elif args[:2] == ["sudo", "install"]:
+            shutil.copyfile(args[-2], args[-1])
+        return subprocess.CompletedProcess(args, 0, stdout="", stderr="")
+
+    return run
+
+
+def test_sign_modules_in_parallel(
+    monkeypatch, modules_dir: Path, keys: dict[str, Key], prompts: list[str]
+) -> None:
+    modules = [
+        _write_module(modules_dir / f"{name}.ko.xz", _content(name))
+        for name in ["a", "b", "c", "d"]
+    ]
+    calls: list[list[str]] = []
+    monkeypatch.setattr(
+        "rpoisel.commands.modules.subprocess.run", _fake_run(keys, calls)
+    )
+
+    result = CliRunner().invoke(app, ["modules", "sign", "*.ko.xz", "--jobs", "4"])
+
+    assert result.exit_code == 0, result.output
+    assert len(prompts) == 1
+    assert calls[0] == ["sudo", "-v"]
+    signing = [x for x in result.output.splitlines() if x.startswith("Signing")]
+    assert signing == [f"Signing {x}" for x in modules]
+    assert "Signed 4/4 modules, skipped 0" in result.output
+    for module in modules:
+        data = module.read_bytes()
+        # stream flags of the xz header: CRC32 check, as with `xz --check=crc32`
+        assert data[6:8] == b"\x00\x01"
+        assert lzma.decompress(data).endswith(SIGNATURE_MAGIC)
+
+
+def test_sign_modules_skips_modules_signed_with_mok(
+    monkeypatch, modules_dir: Path, keys: dict[str, Key], prompts: list[str]
+) -> None:
+    _write_module(modules_dir / "mok.ko.xz", keys["mok"].sign(_content("mok")))
+    other = _write_module(
+        modules_dir / "other.ko.xz", keys["other"].sign(_content("other"))
+    )
+    unsigned = _write_module(modules_dir / "unsigned.ko.xz", _content("unsigned"))
+    calls: list[list[str]] = []
+    monkeypatch.setattr(
+        "rpoisel.commands.modules.subprocess.run", _fake_run(keys, calls)
+    )
+
+    result = CliRunner().invoke(app, ["modules", "sign", "*.ko.xz"])
+
+    assert result.exit_code == 0, result.output
+    assert f"Skipping {modules_dir / 'mok.ko.xz'}" in result.output
+    signing = [x for x in result.output.splitlines() if x.startswith("Signing")]
+    assert signing == [f"Signing {other}", f"Signing {unsigned}"]
+    # the signature of the other key is replaced instead of stacked
+    resigned = lzma.decompress(other.read_bytes())
+    assert resigned == keys["mok"].sign(_content("other"))
+
+
+def test_sign_modules_noop_rerun(
+    monkeypatch, modules_dir: Path, keys: dict[str, Key], prompts: list[str]
+) -> None:
+    for name in ["a", "b", "c"]:
+        _write_module(modules_dir / f"{name}.ko.xz", keys["mok"].sign(_content(name)))
+    calls: list[list[str]] = []
+    monkeypatch.setattr(
+        "rpoisel.commands.modules.subprocess.run", _fake_run(keys, calls)
+    )
+
+    start = time.perf_counter()
+    result = CliRunner().invoke(app, ["modules", "sign", "*.ko.xz"])
+
+    assert time.perf_counter() - start < 1.0
+    assert result.exit_code == 0, result.output
+    assert not prompts
+    assert not calls
+    assert "Signed 0/3 modules, skipped 3" in result.output
+
+
+def test_sign_modules_force(
+    monkeypatch, modules_dir: Path, keys: dict[str, Key], prompts: list[str]
+) -> None:
+    module = _write_module(modules_dir / "a.ko.xz", keys["mok"].sign(_content("a")))
+    calls: list[list[str]] = []
+    monkeypatch.setattr(
+        "rpoisel.commands.modules.subprocess.run", _fake_run(keys, calls)
+    )
+
+    result = CliRunner().invoke(app, ["modules", "sign", "*.ko.xz", "--force"])
+
+    assert result.exit_code == 0, result.output
+    assert "Signed 1/1 modules, skipped 0" in result.output
+    assert lzma.decompress(module.read_bytes()) == keys["mok"].sign(_content("a"))
+
+
+def test_sign_modules_reports_errors_at_the_end(
+    monkeypatch, modules_dir: Path, keys: dict[str, Key], prompts: list[str]
+) -> None:
+    modules = [
+        _write_module(modules_dir / f"{name}.ko.xz", _content(name))
+        for name in ["a", "b", "c"]
+    ]
+    calls: list[list[str]] = []
+    monkeypatch.setattr(
+        "rpoisel.commands.modules.subprocess.run", _fake_run(keys, calls, fail="b.ko")
+    )
+
+    result = CliRunner().invoke(app, ["modules", "sign", "*.ko.xz"])
+
+    assert result.exit_code == 1
+    assert "Signed 2/3 modules" in result.output
+    assert f"Error: {modules[1]}: sign failed (returncode=1)" in result.output
+
+
+def test_sign_modules_keeps_modules_with_forged_trailer(
+    monkeypatch, modules_dir: Path, keys: dict[str, Key], prompts: list[str]
+) -> None:
+    # a signature length beyond the start of the file
+    info = struct.pack(">BBBBB3xI", 0, 0, 2, 0, 0, 1 << 30)
+    content = _content("forged") + info + SIGNATURE_MAGIC
+    module = _write_module(modules_dir / "forged.ko.xz", content)
+    calls: list[list[str]] = []
+    monkeypatch.setattr(
+        "rpoisel.commands.modules.subprocess.run", _fake_run(keys, calls)
+    )
+
+    result = CliRunner().invoke(app, ["modules", "sign", "*.ko.xz"])
+
+    assert result.exit_code == 0, result.output
+    assert "Signed 1/1 modules, skipped 0" in result.output
+    assert lzma.decompress(module.read_bytes()) == keys["mok"].sign(content)
+
+
+def test_sign_modules_stops_when_sudo_fails(
+    monkeypatch, modules_dir: Path, keys: dict[str, Key], prompts: list[str]
+) -> None:
+    _write_module(modules_dir / "a.ko.xz", _content("a"))
+    calls: list[list[str]] = []
+
+    def run(args: list[str], **kwargs) -> subprocess.CompletedProcess:
+        calls.append(args)
+        raise subprocess.CalledProcessError(1, args)
+
+    monkeypatch.setattr("rpoisel.commands.modules.subprocess.run", run)
+
+    result = CliRunner().invoke(app, ["modules", "sign", "*.ko.xz"])
+
+    assert result.exit_code == 1
+    assert "Error: sudo authentication failed." in result.output
+    assert calls == [["sudo", "-v"]]
@@ -0,0 +1,198 @@
+import logging
+import time
+from typing import Iterator
+
+import pytest
+from relay_server import FakeRelay
+from typer.testing import CliRunner
+
+from rpoisel import app
+from rpoisel.commands.power import PowerEndpoint, _http_client
+
+LATENCY = 0.2
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture(autouse=True)
+def http_client(monkeypatch, caplog, tmp_path) -> Iterator[None]:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    # live logging from the worker threads trips over CliRunner's output capture
+    caplog.set_level(logging.WARNING, logger="httpx")
+    _http_client.cache_clear()
+    yield
+    _http_client().close()
+    _http_client.cache_clear()
+
+
+def _use(monkeypatch, relays: dict[PowerEndpoint, FakeRelay]) -> None:
+    monkeypatch.setattr(
+        "rpoisel.commands.power.IP_MAPPING",
+        {endpoint: relay.address for endpoint, relay in relays.items()},
+    )
+
+
+def test_switch_group(monkeypatch) -> None:
+    with FakeRelay() as mic, FakeRelay() as other:
+        _use(monkeypatch, {PowerEndpoint.mic: mic, PowerEndpoint.other: other})
+        result = CliRunner().invoke(app, ["power", "all", "on"])
+
+    assert result.exit_code == 0, result.output
+    assert [x.split()[:2] for x in result.stdout.splitlines()] == [
+        ["mic:", "on"],
+        ["other:", "on"],
+    ]
+    assert mic.ison and other.ison
+    assert mic.requests == other.requests == ["/relay/0?turn=on"]
+
+
+def test_endpoints_are_switched_once(monkeypatch) -> None:
+    with FakeRelay() as mic, FakeRelay() as other:
+        _use(monkeypatch, {PowerEndpoint.mic: mic, PowerEndpoint.other: other})
+        result = CliRunner().invoke(app, ["power", "mic", "all", "mic", "off"])
+
+    assert result.exit_code == 0, result.output
+    assert mic.requests == other.requests == ["/relay/0?turn=off"]
+
+
+def test_connections_are_kept_alive(monkeypatch) -> None:
+    with FakeRelay() as mic, FakeRelay() as other:
+        _use(monkeypatch, {PowerEndpoint.mic: mic, PowerEndpoint.other: other})
+        runner = CliRunner()
+        for state in ["on", "off", "on"]:
+            assert runner.invoke(app, ["power", "all", state]).exit_code == 0
+
+    assert len(mic.requests) == len(other.requests) == 3
+    assert mic.connections == other.connections == 1
+
+
+@pytest.mark.parametrize(
+    "drop, status, body, error",
+    [
+        (1, 200, None, "RemoteProtocolError"),
+        (0, 503, None, "HTTPStatusError"),
+        (0, 200, b"{}", "KeyError"),
+        (0, 200, b"<html>", "JSONDecodeError"),
+    ],
+)
+def test_failed_requests_are_reported_without_retrying(
+    monkeypatch, drop: int, status: int, body: bytes | None, error: str
+) -> None:
+    with FakeRelay(drop=drop) as mic:
+        mic.status = status
+        mic.body = body
+        _use(monkeypatch, {PowerEndpoint.mic: mic})
+        result = CliRunner().invoke(app, ["power", "mic", "on"])
+
+    assert result.exit_code == 1
+    assert result.stderr.startswith(f"mic: {error}")
+    assert len(mic.requests) == 1
+
+
+def test_unreachable_endpoint_is_reported(monkeypatch) -> None:
+    monkeypatch.setattr("rpoisel.commands.power.READ_TIMEOUT", 0.1)
+    with FakeRelay() as mic, FakeRelay(latency=10) as other:
+        _use(monkeypatch, {PowerEndpoint.mic: mic, PowerEndpoint.other: other})
+        start = time.perf_counter()
+        result = CliRunner().invoke(app, ["power", "all", "on"])
+        duration = time.perf_counter() - start
+
+    assert result.exit_code == 1
+    assert result.stdout.startswith("mic: on ")
+    assert result.stderr.startswith("other: ReadTimeout")
+    assert mic.ison
+    assert duration < 2
+
+
+def test_status_queries_all_relays(monkeypatch) -> None:
+    with FakeRelay() as mic, FakeRelay() as other:
+        mic.ison = True
+        _use(monkeypatch, {PowerEndpoint.mic: mic, PowerEndpoint.other: other})
+        result = CliRunner().invoke(app, ["power", "status"])
+
+    assert result.exit_code == 0, result.output
+    assert [x.split()[:2] for x in result.stdout.splitlines()] == [
+        ["mic:", "on"],
+        ["other:", "off"],
+    ]
+    assert mic.requests == other.requests == ["/relay/0"]
+
+
+def test_known_state_is_not_switched_again(monkeypatch) -> None:
+    with FakeRelay() as mic, FakeRelay() as other:
+        _use(monkeypatch, {PowerEndpoint.mic: mic, PowerEndpoint.other: other})
+        runner = CliRunner()
+        assert runner.invoke(app, ["power", "mic", "on"]).exit_code == 0
+        assert runner.invoke(app, ["power", "status", "other"]).exit_code == 0
+        result = runner.invoke(app, ["power", "all", "on"])
+
+    assert result.exit_code == 0, result.output
+    assert result.stdout.splitlines()[0] == "mic: on (cached)"
+    assert mic.requests == ["/relay/0?turn=on"]
+    assert other.requests == ["/relay/0", "/relay/0?turn=on"]
+
+
+def test_force_and_expired_state_switch_again(monkeypatch) -> None:
+    with FakeRelay() as mic:
+        _use(monkeypatch, {PowerEndpoint.mic: mic})
+        runner = CliRunner()
+        assert runner.invoke(app, ["power", "mic", "on"]).exit_code == 0
+        assert runner.invoke(app, ["power", "mic", "on", "--force"]).exit_code == 0
+        monkeypatch.setattr("rpoisel.commands.power.STATE_CACHE_TTL", 0)
+        assert runner.invoke(app, ["power", "mic", "on"]).exit_code == 0
+
+    assert len(mic.requests) == 3
+
+
+def test_failed_switch_forgets_state(monkeypatch) -> None:
+    with FakeRelay() as mic:
+        _use(monkeypatch, {PowerEndpoint.mic: mic})
+        runner = CliRunner()
+        assert runner.invoke(app, ["power", "mic", "on"]).exit_code == 0
+        mic.drop = 1
+        assert runner.invoke(app, ["power", "mic", "off"]).exit_code == 1
+        # the relay may or may not have switched before the connection dropped
+        assert runner.invoke(app, ["power", "mic", "on"]).exit_code == 0
+
+    assert len(mic.requests) == 3
+
+
+@pytest.mark.parametrize(
+    "args, message",
+    [
+        (["mic"], "expected endpoints followed by 'on' or 'off'"),
+        (["mic", "dim"], "expected endpoints followed by 'on' or 'off'"),
+        (["lamp", "on"], "'lamp' is not a valid PowerEndpoint"),
+    ],
+)
+def test_invalid_arguments(args: list[str], message: str) -> None:
+    result = CliRunner().invoke(app, ["power", *args])
+
+    assert result.exit_code == 1
+    assert message in result.output
+
+
+def test_switching_benchmark(monkeypatch) -> None:
+    with (
+        FakeRelay(latency=LATENCY) as mic,
+        FakeRelay(latency=LATENCY) as other,
+    ):
+        _use(monkeypatch, {PowerEndpoint.mic: mic, PowerEndpoint.other: other})
+        runner = CliRunner()
+
+        start = time.perf_counter()
+        for endpoint in ["mic", "other"]:
+            assert runner.invoke(app, ["power", endpoint, "on"]).exit_code == 0
+        serial_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        assert runner.invoke(app, ["power", "all", "off"]).exit_code == 0
+        concurrent_time = time.perf_counter() - start
+
+    logger.info(
+        "switching 2 relays with %.0f ms latency: serial %.1f ms, concurrent %.1f ms",
+        LATENCY * 1000,
+        serial_time * 1000,
+        concurrent_time * 1000,
+    )
+    assert concurrent_time < serial_time - LATENCY / 2
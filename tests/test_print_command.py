@@ -1,84 +1,290 @@
-import shlex
+import hashlib
+import logging
+import os
+import shutil
 import subprocess
+import sys
+import time
 from pathlib import Path
 from typing import Any
 
+import pytest
 from typer.testing import CliRunner
 
 from rpoisel import app
+from rpoisel.util.process import ProcessResult
 
+FILES = 8
+LATENCY = 0.1
+BANDWIDTH = 4 * 2**20
+LP_DELAY = 1.0
 
-def test_print_from_path(monkeypatch, tmp_path: Path) -> None:
-    commands: list[str] = []
+FAKE_SSH = Path(__file__).with_name("fake_ssh.py")
+FAKE_CUPS = Path(__file__).with_name("fake_cups.py")
+SSH = [
+    "ssh",
+    "-o",
+    "ControlMaster=auto",
+    "-o",
+    "ControlPath=/run/user/1000/rpoisel-ssh-%C",
+    "-o",
+    "ControlPersist=10m",
+    "user@acme-vm",
+]
 
-    def fake_run_shell_check(command: str | list[str]) -> str:
-        assert isinstance(command, str)
-        commands.append(command)
-        return ""
+logger = logging.getLogger(__name__)
 
-    monkeypatch.setattr("rpoisel.commands.print.run_shell_check", fake_run_shell_check)
-    pdf_path = tmp_path / "test.pdf"
-    pdf_path.write_bytes(b"%PDF-1.4\nsample\n")
 
-    runner = CliRunner()
-    result = runner.invoke(app, ["print", str(pdf_path), "-o", "number-up=2"])
+@pytest.fixture(autouse=True)
+def runtime_dir(monkeypatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("XDG_RUNTIME_DIR", "/run/user/1000")
+    monkeypatch.setenv("XDG_STATE_HOME", str(tmp_path / "state"))
+    monkeypatch.delenv("RPOISEL_SSH_CONTROL_PERSIST", raising=False)
+
+
+class FakeRemote:
+    """Fake ssh and CUPS on PATH, with remote directories in a local one."""
+
+    def __init__(self, monkeypatch, directory: Path) -> None:
+        self.bin = directory / "bin"
+        self.cache = directory / "remote-cache"
+        self.printed = directory / "printed"
+        self.ssh_log = directory / "ssh.log"
+        for path in [self.bin, self.printed]:
+            path.mkdir()
+        self._script("ssh", f'#!/bin/sh\nexec {sys.executable} {FAKE_SSH} "$@"\n')
+        for name in ["lp", "lpstat", "cancel"]:
+            self._script(
+                name, f'#!/bin/sh\nexec {sys.executable} {FAKE_CUPS} {name} "$@"\n'
+            )
+        monkeypatch.setenv("PATH", f"{self.bin}:{os.environ['PATH']}")
+        monkeypatch.setenv("XDG_RUNTIME_DIR", str(directory))
+        monkeypatch.setenv("FAKE_SSH_LOG", str(self.ssh_log))
+        monkeypatch.setenv("FAKE_SSH_SESSION_LOG", str(directory / "sessions.log"))
+        monkeypatch.setenv("FAKE_PRINTED_DIR", str(self.printed))
+        monkeypatch.setattr("rpoisel.commands.print.REMOTE_CACHE_DIR", str(self.cache))
+        monkeypatch.setattr(
+            "rpoisel.commands.print.REMOTE_JOBS_DIR", str(directory / "remote-jobs")
+        )
+
+    def _script(self, name: str, content: str) -> None:
+        script = self.bin / name
+        script.write_text(content)
+        script.chmod(0o755)
+
+    @property
+    def connections(self) -> list[str]:
+        if not self.ssh_log.exists():
+            return []
+        return self.ssh_log.read_text().splitlines()
+
+    @property
+    def lp_calls(self) -> list[str]:
+        return (self.printed / "lp.log").read_text().splitlines()
+
+    @property
+    def sessions(self) -> list[str]:
+        return (self.bin.parent / "sessions.log").read_text().splitlines()
+
+    @property
+    def jobs(self) -> dict[str, str]:
+        queue = (self.printed / "queue").read_text().split("\n")
+        return {x.split()[0]: x.split()[2] for x in queue if x}
+
+    def complete(self, job_id: str) -> None:
+        queue = self.printed / "queue"
+        jobs = [x.split() for x in queue.read_text().splitlines()]
+        queue.write_text(
+            "".join(
+                f"{x[0]} {x[1]} {'completed' if x[0] == job_id else x[2]}\n"
+                for x in jobs
+            )
+        )
+
+    @property
+    def cached(self) -> list[str]:
+        if not self.cache.exists():
+            return []
+        return sorted(x.name for x in self.cache.iterdir())
 
-    assert result.exit_code == 0
-    assert commands == [
-        f"scp {shlex.quote(str(pdf_path))} user@acme-vm:/tmp/",
-        "ssh user@acme-vm 'lpr -P Samsung_M2020_Series -o number-up=2 /tmp/test.pdf'",
-    ]
 
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
 
-def test_print_from_stdin(monkeypatch) -> None:
-    shell_commands: list[str] = []
-    ssh_calls: list[dict[str, Any]] = []
+
+@pytest.fixture
+def remote(monkeypatch, tmp_path: Path) -> FakeRemote:
+    return FakeRemote(monkeypatch, tmp_path)
+
+
+def test_print_from_path(monkeypatch, tmp_path: Path) -> None:
+    commands: list[list[str]] = []
+    uploads: list[dict[str, Any]] = []
 
     class FakeUUID:
         hex = "deadbeefcafebabe"
 
-    def fake_run_shell_check(command: str | list[str]) -> str:
-        assert isinstance(command, str)
-        shell_commands.append(command)
-        return ""
+    def fake_run(args: list[str], **kwargs) -> ProcessResult:
+        commands.append(args)
+        return ProcessResult(args, 0, 0.0, "", "")
 
     def fake_subprocess_run(
-        args: list[str], input: bytes, check: bool
+        args: list[str], stdin: Any, check: bool
     ) -> subprocess.CompletedProcess:
-        ssh_calls.append({"args": args, "input": input, "check": check})
+        uploads.append({"args": args, "input": stdin.read(), "check": check})
         return subprocess.CompletedProcess(args=args, returncode=0)
 
-    monkeypatch.setattr("rpoisel.commands.print.run_shell_check", fake_run_shell_check)
+    monkeypatch.setattr("rpoisel.commands.print.run", fake_run)
     monkeypatch.setattr("rpoisel.commands.print.subprocess.run", fake_subprocess_run)
     monkeypatch.setattr("rpoisel.commands.print.uuid4", lambda: FakeUUID())
+    pdf_path = tmp_path / "test.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4\nsample\n")
+    cached = f".cache/rpoisel/print/{_digest(b'%PDF-1.4\nsample\n')}.pdf"
 
     runner = CliRunner()
-    result = runner.invoke(
-        app, ["print", "-o", "number-up=2"], input=b"%PDF-1.4\nsample\n"
-    )
+    result = runner.invoke(app, ["print", str(pdf_path), "-o", "number-up=2"])
 
     assert result.exit_code == 0
-    assert ssh_calls == [
+    assert uploads == [
         {
             "args": [
-                "ssh",
-                "user@acme-vm",
-                "cat > /tmp/rpoisel-print-deadbeefcafebabe.pdf",
+                *SSH,
+                "cat > .cache/rpoisel/print/.deadbeefcafebabe && "
+                f"mv .cache/rpoisel/print/.deadbeefcafebabe {cached}",
             ],
             "input": b"%PDF-1.4\nsample\n",
             "check": True,
         }
     ]
-    assert shell_commands == [
-        "ssh user@acme-vm 'set -euo pipefail; trap '\"'\"'rm -f /tmp/rpoisel-print-deadbeefcafebabe.pdf'\"'\"' EXIT; lpr -P Samsung_M2020_Series -o number-up=2 /tmp/rpoisel-print-deadbeefcafebabe.pdf'"
+    lookup, lp = commands
+    assert lookup[:-1] == lp[:-1] == SSH
+    assert lookup[-1].startswith("mkdir -p .cache/rpoisel/print && ")
+    assert lp[-1].startswith(
+        f"request=$(lp -d Samsung_M2020_Series -o number-up=2 -t test.pdf {cached}) && "
+    )
+
+
+def test_print_from_stdin(remote: FakeRemote) -> None:
+    runner = CliRunner()
+    result = runner.invoke(
+        app, ["print", "-o", "number-up=2"], input=b"%PDF-1.4\nsample\n"
+    )
+
+    assert result.exit_code == 0, result.output
+    assert remote.lp_calls == ["-d Samsung_M2020_Series -o number-up=2"]
+    assert "Submitted job Samsung_M2020_Series-1" in result.output
+    assert (remote.printed / "stdin.pdf").read_bytes() == b"%PDF-1.4\nsample\n"
+    # streamed straight into lp, nothing is stored on the remote host
+    assert not remote.cached
+
+
+def test_print_translates_lpr_options(remote: FakeRemote) -> None:
+    result = CliRunner().invoke(
+        app,
+        ["print", "-P", "Office", "-#2", "-T", "Report", "-h", "-o", "sides=two-sided"],
+        input=b"%PDF-1.4\nsample\n",
+    )
+
+    assert result.exit_code == 0, result.output
+    assert remote.lp_calls == [
+        "-d Office -n 2 -t Report -o job-sheets=none -o sides=two-sided"
     ]
 
 
+@pytest.mark.parametrize(
+    "args, error",
+    [
+        (["-r"], "unsupported lpr option: -r"),
+        (["-o"], "lpr option -o needs a value"),
+    ],
+)
+def test_print_rejects_lpr_options_without_lp_equivalent(
+    remote: FakeRemote, tmp_path: Path, args: list[str], error: str
+) -> None:
+    pdf_path = tmp_path / "test.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4\nsample\n")
+
+    result = CliRunner().invoke(app, ["print", str(pdf_path), *args])
+
+    assert result.exit_code == 1
+    assert f"Error: {error}." in result.output
+    assert not remote.connections
+
+
+def test_print_reports_its_own_job_id(remote: FakeRemote, tmp_path: Path) -> None:
+    pdf_path = tmp_path / "test.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4\nsample\n")
+    # another submission of the same user is queued right after this one
+    (remote.bin / "lp").write_text(
+        f'#!/bin/sh\n{sys.executable} {FAKE_CUPS} lp "$@" && '
+        f"{sys.executable} {FAKE_CUPS} lp -d Samsung_M2020_Series {pdf_path} "
+        "> /dev/null\n"
+    )
+
+    result = CliRunner().invoke(app, ["print", str(pdf_path)])
+
+    assert result.exit_code == 0, result.output
+    assert len(remote.jobs) == 2
+    assert "Submitted job Samsung_M2020_Series-1" in result.output
+
+
+def test_print_from_stdin_reports_throughput(remote: FakeRemote) -> None:
+    data = b"%PDF-1.4\n" + bytes(range(256)) * (5 * 4096)
+
+    result = CliRunner().invoke(app, ["print"], input=data)
+
+    assert result.exit_code == 0, result.output
+    assert (remote.printed / "stdin.pdf").read_bytes() == data
+    assert "Sent 5.0 MiB in " in result.output
+    assert "MiB/s)" in result.output
+
+
+def test_print_from_stdin_reports_lp_failure(remote: FakeRemote) -> None:
+    (remote.bin / "lp").write_text("#!/bin/sh\nexit 3\n")
+
+    result = CliRunner().invoke(app, ["print"], input=b"%PDF-1.4\n" * 100_000)
+
+    assert result.exit_code == 1
+    assert "remote lp failed (returncode=3)" in result.output
+
+
+def test_print_jobs_share_one_ssh_connection(
+    remote: FakeRemote, tmp_path: Path
+) -> None:
+    pdf_path = tmp_path / "test.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4\nfrom path\n")
+    runner = CliRunner()
+
+    first = runner.invoke(app, ["print", str(pdf_path)])
+    second = runner.invoke(app, ["print"], input=b"%PDF-1.4\nfrom stdin\n")
+
+    assert first.exit_code == 0, first.output
+    assert second.exit_code == 0, second.output
+    # lookup, upload and two lp calls over a single connection
+    assert remote.connections == ["user@acme-vm ControlPersist=10m"]
+    assert len(remote.lp_calls) == 2
+    digest = _digest(b"%PDF-1.4\nfrom path\n")
+    assert (remote.printed / f"{digest}.pdf").read_bytes() == b"%PDF-1.4\nfrom path\n"
+
+
+def test_print_ssh_idle_lifetime(
+    monkeypatch, remote: FakeRemote, tmp_path: Path
+) -> None:
+    monkeypatch.setenv("RPOISEL_SSH_CONTROL_PERSIST", "30s")
+    pdf_path = tmp_path / "test.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4\n")
+
+    result = CliRunner().invoke(app, ["print", str(pdf_path)])
+
+    assert result.exit_code == 0, result.output
+    assert remote.connections == ["user@acme-vm ControlPersist=30s"]
+
+
 def test_print_path_rejects_non_pdf(monkeypatch, tmp_path: Path) -> None:
-    def fake_run_shell_check(command: str | list[str]) -> str:
-        raise AssertionError(f"unexpected command: {command}")
+    def fake_run(args: list[str], **kwargs) -> ProcessResult:
+        raise AssertionError(f"unexpected command: {args}")
 
-    monkeypatch.setattr("rpoisel.commands.print.run_shell_check", fake_run_shell_check)
+    monkeypatch.setattr("rpoisel.commands.print.run", fake_run)
     not_pdf_path = tmp_path / "not-pdf.txt"
     not_pdf_path.write_text("hello")
 
@@ -90,13 +296,232 @@ def test_print_path_rejects_non_pdf(monkeypatch, tmp_path: Path) -> None:
 
 
 def test_print_stdin_rejects_empty_input(monkeypatch) -> None:
-    def fake_run_shell_check(command: str | list[str]) -> str:
-        raise AssertionError(f"unexpected command: {command}")
+    def fake_run(args: list[str], **kwargs) -> ProcessResult:
+        raise AssertionError(f"unexpected command: {args}")
 
-    monkeypatch.setattr("rpoisel.commands.print.run_shell_check", fake_run_shell_check)
+    monkeypatch.setattr("rpoisel.commands.print.run", fake_run)
 
     runner = CliRunner()
     result = runner.invoke(app, ["print"], input=b"")
 
     assert result.exit_code == 1
     assert "no data received on stdin" in result.output
+
+
+def test_print_many_files_in_order(remote: FakeRemote, tmp_path: Path) -> None:
+    paths = []
+    for name in ["c", "a", "b", "d"]:
+        paths.append(tmp_path / f"{name}.pdf")
+        paths[-1].write_bytes(f"%PDF-1.4\n{name}\n".encode())
+    not_pdf = tmp_path / "not-pdf.txt"
+    not_pdf.write_text("hello")
+
+    result = CliRunner().invoke(
+        app,
+        ["print", *map(str, paths[:2]), str(not_pdf), *map(str, paths[2:])]
+        + ["--jobs", "3", "-o", "number-up=2"],
+    )
+
+    # the bad file is reported but does not keep the others from printing
+    assert result.exit_code == 1
+    assert f"file is not a valid PDF: {not_pdf}" in result.output
+    assert "Printed 4/5 files" in result.output
+    uploaded = [x for x in result.output.splitlines() if x.startswith("Uploaded")]
+    assert [x.split()[1] for x in uploaded] == list(map(str, paths))
+    remote_paths = " ".join(
+        f"{remote.cache}/{_digest(x.read_bytes())}.pdf" for x in paths
+    )
+    assert remote.lp_calls == [
+        f"-d Samsung_M2020_Series -o number-up=2 -t c.pdf {remote_paths}"
+    ]
+    assert remote.connections == ["user@acme-vm ControlPersist=10m"]
+
+
+def test_print_uploads_concurrently(
+    monkeypatch, remote: FakeRemote, tmp_path: Path
+) -> None:
+    monkeypatch.setenv("FAKE_SSH_LATENCY", str(LATENCY))
+    paths = [tmp_path / f"{i}.pdf" for i in range(FILES)]
+    for path in paths:
+        path.write_bytes(f"%PDF-1.4\n{path.name}\n".encode() + bytes(1024 * 1024))
+    runner = CliRunner()
+
+    durations = {}
+    for jobs in [1, FILES]:
+        shutil.rmtree(remote.cache, ignore_errors=True)
+        start = time.perf_counter()
+        result = runner.invoke(app, ["print", *map(str, paths), "--jobs", str(jobs)])
+        durations[jobs] = time.perf_counter() - start
+        assert result.exit_code == 0, result.output
+
+    logger.info(
+        "printing %d files with %.0f ms SSH latency: %.0f ms with 1 job, "
+        "%.0f ms with %d jobs",
+        FILES,
+        LATENCY * 1000,
+        durations[1] * 1000,
+        durations[FILES] * 1000,
+        FILES,
+    )
+    # the lookup and lp round trips stay, most upload latency overlaps
+    assert durations[1] - durations[FILES] > FILES / 2 * LATENCY
+
+
+def test_print_cache_hit_skips_upload(remote: FakeRemote, tmp_path: Path) -> None:
+    pdf_path = tmp_path / "form.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4\nform\n")
+    copy_path = tmp_path / "copy.pdf"
+    copy_path.write_bytes(b"%PDF-1.4\nform\n")
+    runner = CliRunner()
+
+    first = runner.invoke(app, ["print", str(pdf_path), str(copy_path)])
+    second = runner.invoke(app, ["print", str(copy_path)])
+
+    assert first.exit_code == 0, first.output
+    assert second.exit_code == 0, second.output
+    # the same content is uploaded once, even within one job
+    assert first.output.count("Uploaded") == 1
+    assert "Printed 2/2 files, 0 cached" in first.output
+    assert f"Cached {copy_path}" in second.output
+    assert "Printed 1/1 files, 1 cached" in second.output
+    assert remote.cached == [f"{_digest(b'%PDF-1.4\nform\n')}.pdf"]
+    assert remote.lp_calls[-1].startswith("-d Samsung_M2020_Series -t copy.pdf ")
+
+
+def test_print_cache_evicts_least_recently_printed(
+    monkeypatch, remote: FakeRemote, tmp_path: Path
+) -> None:
+    monkeypatch.setattr("rpoisel.commands.print.REMOTE_CACHE_SIZE", 2500)
+    paths = {}
+    for name in ["a", "b", "c"]:
+        paths[name] = tmp_path / f"{name}.pdf"
+        paths[name].write_bytes(b"%PDF-1.4\n" + name.encode() * 1000)
+    runner = CliRunner()
+
+    for name in ["a", "b", "a", "c"]:
+        result = runner.invoke(app, ["print", str(paths[name])])
+        assert result.exit_code == 0, result.output
+
+    assert remote.cached == sorted(
+        f"{_digest(paths[x].read_bytes())}.pdf" for x in ["a", "c"]
+    )
+
+
+def test_print_compressed_upload(remote: FakeRemote, tmp_path: Path) -> None:
+    data = b"%PDF-1.4\n" + b"0 0 0 rg\n" * 100_000
+    pdf_path = tmp_path / "scan.pdf"
+    pdf_path.write_bytes(data)
+
+    result = CliRunner().invoke(app, ["print", str(pdf_path), "--compress"])
+
+    assert result.exit_code == 0, result.output
+    assert (remote.cache / f"{_digest(data)}.pdf").read_bytes() == data
+    assert "sent 0.0 MiB" in result.output
+
+
+def test_print_cache_benchmark(monkeypatch, remote: FakeRemote, tmp_path: Path) -> None:
+    monkeypatch.setenv("FAKE_SSH_LATENCY", str(LATENCY))
+    monkeypatch.setenv("FAKE_SSH_BANDWIDTH", str(BANDWIDTH))
+    data = b"%PDF-1.4\n" + b"BT /F1 12 Tf 72 712 Td (label) Tj ET\n" * 100_000
+    pdf_path = tmp_path / "label.pdf"
+    pdf_path.write_bytes(data)
+    runner = CliRunner()
+
+    durations = {}
+    for case, args in [
+        ("miss", []),
+        ("hit", []),
+        ("compressed miss", ["--compress"]),
+    ]:
+        if case != "hit":
+            shutil.rmtree(remote.cache, ignore_errors=True)
+        start = time.perf_counter()
+        result = runner.invoke(app, ["print", str(pdf_path), *args])
+        durations[case] = time.perf_counter() - start
+        assert result.exit_code == 0, result.output
+
+    logger.info(
+        "printing %.1f MiB over %.0f MiB/s with %.0f ms latency: %s",
+        len(data) / 2**20,
+        BANDWIDTH / 2**20,
+        LATENCY * 1000,
+        ", ".join(f"{k} {v * 1000:.0f} ms" for k, v in durations.items()),
+    )
+    transfer = len(data) / BANDWIDTH
+    assert durations["miss"] - durations["hit"] > transfer / 2
+    assert durations["miss"] - durations["compressed miss"] > transfer / 2
+
+
+def test_print_status_of_tracked_jobs(remote: FakeRemote, tmp_path: Path) -> None:
+    paths = [tmp_path / "a.pdf", tmp_path / "b.pdf"]
+    for path in paths:
+        path.write_bytes(f"%PDF-1.4\n{path.name}\n".encode())
+    runner = CliRunner()
+
+    for path in paths:
+        result = runner.invoke(app, ["print", str(path)])
+        assert result.exit_code == 0, result.output
+    remote.complete("Samsung_M2020_Series-1")
+    sessions = len(remote.sessions)
+    first = runner.invoke(app, ["print", "status"])
+    second = runner.invoke(app, ["print", "status"])
+
+    assert first.exit_code == 0, first.output
+    assert [x.split()[:2] for x in first.output.splitlines()] == [
+        ["Samsung_M2020_Series-1", "completed"],
+        ["Samsung_M2020_Series-2", "queued"],
+    ]
+    assert first.output.splitlines()[0].endswith(str(paths[0]))
+    # completed jobs are reported once
+    assert [x.split()[:2] for x in second.output.splitlines()] == [
+        ["Samsung_M2020_Series-2", "queued"],
+    ]
+    assert len(remote.sessions) == sessions + 2
+
+
+def test_print_detach(monkeypatch, remote: FakeRemote, tmp_path: Path) -> None:
+    monkeypatch.setenv("FAKE_LP_DELAY", str(LP_DELAY))
+    pdf_path = tmp_path / "a.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4\n")
+    runner = CliRunner()
+
+    start = time.perf_counter()
+    result = runner.invoke(app, ["print", str(pdf_path), "--detach"])
+    duration = time.perf_counter() - start
+    pending = runner.invoke(app, ["print", "status"])
+    ticket = remote.cache.parent / "remote-jobs"
+    for _ in range(100):
+        if any(not x.name.startswith(".") for x in ticket.iterdir()):
+            break
+        time.sleep(0.05)
+    submitted = runner.invoke(app, ["print", "status"])
+
+    assert result.exit_code == 0, result.output
+    assert "Submitting in the background" in result.output
+    # uploaded, but not waiting for lp
+    assert remote.cached
+    assert duration < LP_DELAY
+    assert pending.output.split()[:2] == ["-", "submitting"]
+    assert submitted.output.split()[:2] == ["Samsung_M2020_Series-1", "queued"]
+
+
+def test_print_detach_rejects_stdin(remote: FakeRemote) -> None:
+    result = CliRunner().invoke(app, ["print", "--detach"], input=b"%PDF-1.4\n")
+
+    assert result.exit_code == 1
+    assert "--detach needs PDF paths" in result.output
+
+
+def test_print_cancel(remote: FakeRemote, tmp_path: Path) -> None:
+    pdf_path = tmp_path / "a.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4\n")
+    runner = CliRunner()
+
+    runner.invoke(app, ["print", str(pdf_path)])
+    result = runner.invoke(app, ["print", "cancel", "Samsung_M2020_Series-1"])
+    status = runner.invoke(app, ["print", "status"])
+
+    assert result.exit_code == 0, result.output
+    assert "Cancelled job Samsung_M2020_Series-1" in result.output
+    assert remote.jobs == {"Samsung_M2020_Series-1": "cancelled"}
+    assert status.output == "No tracked print jobs.\n"
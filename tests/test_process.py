@@ -0,0 +1,113 @@
+import logging
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from rpoisel.util import process
+from rpoisel.util.process import run, run_pipeline, run_shell_check
+
+RUNS = 50
+
+logger = logging.getLogger(__name__)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        stat = Path(f"/proc/{pid}/stat").read_text()
+    except FileNotFoundError:
+        return False
+    # orphans are reaped by init, which may not happen in containers
+    return stat.rsplit(")", 1)[1].split()[0] != "Z"
+
+
+def test_run_captures_output_without_shell() -> None:
+    result = run(["printf", "%s\\n", "a b", "$HOME"])
+
+    assert result.stdout == "a b\n$HOME\n"
+    assert result.returncode == 0
+    assert result.args == ["printf", "%s\\n", "a b", "$HOME"]
+    assert process.history[-1] is result
+
+
+def test_lines_are_streamed_as_they_arrive() -> None:
+    arrivals: list[tuple[str, float]] = []
+    start = time.perf_counter()
+
+    result = run(
+        ["sh", "-c", "echo first; echo oops >&2; sleep 0.3; echo second"],
+        on_stdout=lambda x: arrivals.append((x, time.perf_counter() - start)),
+        on_stderr=lambda x: arrivals.append((x, time.perf_counter() - start)),
+    )
+
+    assert sorted(x for x, _ in arrivals) == ["first", "oops", "second"]
+    assert dict(arrivals)["first"] < 0.2 < dict(arrivals)["second"]
+    assert (result.stdout, result.stderr) == ("first\nsecond\n", "oops\n")
+    assert result.duration >= 0.3
+
+
+def test_failure_raises(capsys) -> None:
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        run(["sh", "-c", "echo broken >&2; exit 3"])
+
+    assert exc_info.value.returncode == 3
+    assert "Problem (returncode=3)" in capsys.readouterr().err
+    assert run(["false"], check=False).returncode == 1
+
+
+def test_timeout_kills_process_group(tmp_path) -> None:
+    pid_file = tmp_path / "pid"
+    start = time.perf_counter()
+
+    with pytest.raises(subprocess.TimeoutExpired) as exc_info:
+        run(
+            ["sh", "-c", f"sleep 30 & echo $! > {pid_file}; echo started; wait"],
+            timeout=0.3,
+        )
+
+    assert time.perf_counter() - start < 0.3 + process.KILL_GRACE
+    assert exc_info.value.output == "started\n"
+    # the grandchild was killed along with the shell
+    grandchild = int(pid_file.read_text())
+    time.sleep(0.1)
+    assert not _alive(grandchild)
+
+
+def test_pipeline() -> None:
+    results = run_pipeline([["printf", "b\\na\\nb\\n"], ["sort"], ["uniq", "-c"]])
+
+    assert [x.args[0] for x in results] == ["printf", "sort", "uniq"]
+    assert [x.returncode for x in results] == [0, 0, 0]
+    assert results[-1].stdout.split() == ["1", "a", "2", "b"]
+    assert results[0].stdout == ""
+
+
+def test_pipeline_fails_like_pipefail(capsys) -> None:
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        run_pipeline([["sh", "-c", "exit 2"], ["cat"]])
+
+    assert exc_info.value.cmd == ["sh", "-c", "exit 2"]
+    results = run_pipeline([["sh", "-c", "exit 2"], ["cat"]], check=False)
+    assert [x.returncode for x in results] == [2, 0]
+
+
+def test_direct_exec_benchmark() -> None:
+    def measure(function) -> float:
+        start = time.perf_counter()
+        for _ in range(RUNS):
+            function()
+        return (time.perf_counter() - start) / RUNS
+
+    args = [sys.executable, "-S", "-c", "pass"]
+    shell_time = measure(lambda: run_shell_check(subprocess.list2cmdline(args)))
+    direct_time = measure(lambda: run(args))
+
+    logger.info(
+        "%d runs of a bare interpreter: through bash %.2f ms, direct %.2f ms",
+        RUNS,
+        shell_time * 1000,
+        direct_time * 1000,
+    )
+    assert direct_time < shell_time * 1.5
@@ -0,0 +1,154 @@
+from pathlib import Path
+
+import pytest
+
+from rpoisel.util.qemu import PROFILES, VMSpec
+
+IMAGE = Path("/images/dev.qcow2")
+QMP_SOCKET = Path("/tmp/qmp-dev")
+PID_FILE = Path("/var/run/qemu-dev.pid")
+
+
+def _argv(spec: VMSpec, **kwargs) -> list[str]:
+    return spec.argv(IMAGE, "qcow2", QMP_SOCKET, PID_FILE, **kwargs)
+
+
+def _values(argv: list[str], option: str) -> list[str]:
+    return [argv[i + 1] for i, x in enumerate(argv) if x == option]
+
+
+def test_compat_profile_keeps_emulated_devices() -> None:
+    assert _argv(VMSpec("dev")) == [
+        "qemu-system-x86_64",
+        "-accel",
+        "kvm",
+        "-cpu",
+        "host",
+        "-smp",
+        "1,sockets=1,cores=1,threads=1",
+        "-m",
+        "4G",
+        "-netdev",
+        "bridge,id=net0,br=bridge0",
+        "-device",
+        "e1000,netdev=net0",
+        "-netdev",
+        "user,id=net1",
+        "-device",
+        "e1000,netdev=net1",
+        "-drive",
+        "file=/images/dev.qcow2,format=qcow2,if=none,id=disk0",
+        "-device",
+        "virtio-blk-pci,drive=disk0",
+        "-name",
+        "qemu-vm-dev,process=vm-dev",
+        "-daemonize",
+        "-serial",
+        "none",
+        "-display",
+        "vnc=:0",
+        "-qmp",
+        "unix:/tmp/qmp-dev,server=on,wait=off",
+        "-pidfile",
+        "/var/run/qemu-dev.pid",
+    ]
+
+
+def test_desktop_profile() -> None:
+    argv = _argv(VMSpec("dev", "desktop", bridge="br1"))
+
+    assert _values(argv, "-smp") == ["4,sockets=1,cores=4,threads=1"]
+    assert _values(argv, "-m") == ["8G"]
+    assert "-machine" not in argv
+    assert _values(argv, "-netdev")[0] == (
+        "tap,id=net0,ifname=tap-dev,script=no,downscript=no,vhost=on,queues=4"
+    )
+    assert _values(argv, "-device")[:2] == [
+        "virtio-net-pci,netdev=net0,mq=on,vectors=10",
+        "virtio-net-pci,netdev=net1",
+    ]
+    assert _values(argv, "-object") == ["iothread,id=io0"]
+    assert _values(argv, "-drive") == [
+        "file=/images/dev.qcow2,format=qcow2,if=none,id=disk0,"
+        "cache=none,aio=io_uring,discard=unmap,detect-zeroes=unmap"
+    ]
+    assert "virtio-blk-pci,drive=disk0,iothread=io0" in argv
+
+
+def test_build_profile() -> None:
+    argv = _argv(VMSpec("dev", "build"))
+
+    assert _values(argv, "-smp") == ["16,sockets=1,cores=8,threads=2"]
+    assert _values(argv, "-m") == ["32G"]
+    assert _values(argv, "-object") == [
+        "memory-backend-file,id=mem0,size=32G,mem-path=/dev/hugepages,"
+        "prealloc=on,share=on",
+        "iothread,id=io0",
+    ]
+    assert _values(argv, "-machine") == ["memory-backend=mem0"]
+    assert _values(argv, "-netdev")[0].endswith(",queues=8")
+    assert "virtio-net-pci,netdev=net0,mq=on,vectors=18" in argv
+
+
+@pytest.mark.parametrize("profile", PROFILES)
+def test_every_profile_boots_iso_in_foreground(profile: str) -> None:
+    argv = _argv(VMSpec("dev", profile, vnc_display=2, printer=True), iso=Path("a.iso"))
+
+    assert _values(argv, "-cdrom") == ["a.iso"]
+    assert _values(argv, "-boot") == ["d"]
+    assert "-daemonize" not in argv
+    assert _values(argv, "-display") == ["vnc=:2"]
+    assert "usb-host,vendorid=0x04e8,productid=0x3321" in argv
+    # options and their values alternate after the binary
+    assert all(x.startswith("-") for x in argv[1::2])
+
+
+def test_spec_round_trips(tmp_path: Path) -> None:
+    path = tmp_path / "dev.json"
+    spec = VMSpec("dev", "build", bridge="br1", vnc_display=1, printer=True)
+
+    assert VMSpec.load(path) is None
+    spec.save(path)
+
+    assert VMSpec.load(path) == spec
+    assert [x.name for x in tmp_path.iterdir()] == ["dev.json"]
+
+
+def test_incoming_waits_for_state() -> None:
+    argv = _argv(VMSpec("dev", "desktop"), incoming="defer")
+
+    assert _values(argv, "-incoming") == ["defer"]
+    assert "-daemonize" in argv
+
+
+@pytest.mark.parametrize("profile", PROFILES)
+def test_netdev_options_are_accepted(profile: str) -> None:
+    # net/tap.c refuses these together with helper=
+    invalid_with_helper = {
+        "ifname",
+        "script",
+        "downscript",
+        "vnet_hdr",
+        "queues",
+        "vhostfds",
+    }
+
+    for netdev in _values(_argv(VMSpec("dev", profile)), "-netdev"):
+        backend, *options = netdev.split(",")
+        keys = {x.partition("=")[0] for x in options}
+        if "helper" in keys:
+            assert not keys & invalid_with_helper, netdev
+        if backend == "tap" and "queues" in keys:
+            assert "ifname" in keys, "multiqueue needs a tap created beforehand"
+
+
+def test_multiqueue_tap_is_created_on_the_bridge() -> None:
+    spec = VMSpec("a-rather-long-name", "build", bridge="br1")
+
+    assert spec.tap == "tap-a-rather-lo"
+    assert spec.network_setup() == [
+        ["ip", "tuntap", "add", "dev", "tap-a-rather-lo", "mode", "tap", "multi_queue"],
+        ["ip", "link", "set", "tap-a-rather-lo", "master", "br1", "up"],
+    ]
+    assert f"ifname={spec.tap}," in _values(_argv(spec), "-netdev")[0]
+    assert VMSpec("dev").network_setup() == []
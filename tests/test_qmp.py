@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import time
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from qmp_server import FakeQMPServer
+from typer.testing import CliRunner
+
+from rpoisel import app
+from rpoisel.util.qmp import AsyncQMPClient, QMPClient, QMPError
+
+COMMANDS = 50
+LATENCY = 0.002
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def server(tmp_path: Path) -> Iterator[FakeQMPServer]:
+    with FakeQMPServer(tmp_path / "qmp-test") as server:
+        yield server
+
+
+def test_commands_are_pipelined(server: FakeQMPServer) -> None:
+    async def run() -> tuple:
+        async with AsyncQMPClient(server.path) as client:
+            return await asyncio.gather(
+                client.execute("query-status"), client.execute("query-version")
+            )
+
+    status, version = asyncio.run(run())
+
+    assert status == {"status": "running", "running": True}
+    assert version["qemu"]["major"] == 9
+    ids = [x["id"] for x in server.received]
+    assert len(set(ids)) == len(ids) == 3
+
+
+def test_events_are_routed_to_subscribers(server: FakeQMPServer) -> None:
+    async def run() -> tuple[list, list]:
+        async with AsyncQMPClient(server.path) as client:
+            everything = client.subscribe()
+            resume = client.subscribe({"RESUME"})
+            await client.execute("stop")
+            await client.execute("cont")
+            events = [await everything.get(), await everything.get()]
+            return events, [await resume.get()]
+
+    events, resume = asyncio.run(run())
+
+    assert [x["event"] for x in events] == ["STOP", "RESUME"]
+    assert [x["event"] for x in resume] == ["RESUME"]
+
+
+def test_error_reply_raises(server: FakeQMPServer) -> None:
+    async def run() -> None:
+        async with AsyncQMPClient(server.path) as client:
+            with pytest.raises(QMPError, match="CommandNotFound"):
+                await client.execute("unknown")
+            # the connection is still usable afterwards
+            assert (await client.execute("query-status"))["status"] == "running"
+
+    asyncio.run(run())
+
+
+def test_command_timeout(server: FakeQMPServer) -> None:
+    async def run() -> None:
+        async with AsyncQMPClient(server.path) as client:
+            start = time.perf_counter()
+            with pytest.raises(TimeoutError):
+                await client.execute("hang", timeout=0.1)
+            assert time.perf_counter() - start < 1.0
+            assert (await client.execute("query-status"))["status"] == "running"
+
+    asyncio.run(run())
+
+
+def test_reconnect_after_connection_loss(server: FakeQMPServer) -> None:
+    async def run() -> None:
+        async with AsyncQMPClient(server.path) as client:
+            events = client.subscribe()
+            server.disconnect()
+            # subscribers learn about the lost connection
+            assert await events.get() is None
+            assert (await client.execute("query-status"))["status"] == "running"
+
+    asyncio.run(run())
+
+    assert server.connections == 2
+
+
+def test_pending_commands_fail_on_connection_loss(server: FakeQMPServer) -> None:
+    async def run() -> None:
+        async with AsyncQMPClient(server.path) as client:
+            pending = asyncio.create_task(client.execute("hang"))
+            await asyncio.sleep(0.05)
+            server.disconnect()
+            with pytest.raises(ConnectionError):
+                await pending
+
+    asyncio.run(run())
+
+
+def test_sync_client(server: FakeQMPServer) -> None:
+    client = QMPClient(server.path)
+    try:
+        assert client.send_monitor_cmd("query-status")["status"] == "running"
+        client.send_monitor_cmd("stop")
+        assert client.send_monitor_cmd("query-status")["status"] == "paused"
+    finally:
+        client.close()
+
+
+def test_vm_commands(monkeypatch, server: FakeQMPServer) -> None:
+    monkeypatch.setattr("rpoisel.commands.vm.QEMU_QMP_SOCKETS_BASE", server.path.parent)
+    runner = CliRunner()
+
+    assert runner.invoke(app, ["vm", "stop", "test"]).exit_code == 0
+    result = runner.invoke(app, ["vm", "state", "test"])
+
+    assert result.exit_code == 0, result.output
+    assert result.output == "paused\n"
+    # QEMU serves a single QMP client, so none stays connected
+    deadline = time.perf_counter() + 1.0
+    while server.clients and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    assert server.connections == 2
+    assert server.clients == 0
+
+
+def test_pipelining_benchmark(tmp_path: Path) -> None:
+    async def sequential(client: AsyncQMPClient) -> None:
+        for _ in range(COMMANDS):
+            await client.execute("query-status")
+
+    async def pipelined(client: AsyncQMPClient) -> None:
+        await asyncio.gather(*(client.execute("query-status") for _ in range(COMMANDS)))
+
+    async def measure(run) -> float:
+        async with AsyncQMPClient(server.path) as client:
+            start = time.perf_counter()
+            await run(client)
+            return time.perf_counter() - start
+
+    with FakeQMPServer(tmp_path / "qmp-bench", latency=LATENCY) as server:
+        sequential_time = asyncio.run(measure(sequential))
+        pipelined_time = asyncio.run(measure(pipelined))
+
+    logger.info(
+        "%d commands with %.0f ms latency: sequential %.1f ms (%.0f/s), "
+        "pipelined %.1f ms (%.0f/s)",
+        COMMANDS,
+        LATENCY * 1000,
+        sequential_time * 1000,
+        COMMANDS / sequential_time,
+        pipelined_time * 1000,
+        COMMANDS / pipelined_time,
+    )
+    assert pipelined_time * 5 < sequential_time
@@ -0,0 +1,252 @@
+import socket
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from typer.testing import CliRunner
+
+from rpoisel import app
+from rpoisel.commands.screen import UeventSource, _watch_screens
+from rpoisel.util.process import ProcessResult
+
+DEBOUNCE = 0.2
+# recorded with `udevadm monitor --kernel --property` while docking
+DOCKING_UEVENTS = [
+    b"change@/devices/pci0000:00/0000:00:02.0/drm/card1\0ACTION=change\0"
+    b"DEVPATH=/devices/pci0000:00/0000:00:02.0/drm/card1\0SUBSYSTEM=drm\0"
+    b"HOTPLUG=1\0CONNECTOR=107\0DEVNAME=dri/card1\0DEVTYPE=drm_minor\0"
+    b"SEQNUM=6127\0MAJOR=226\0MINOR=1\0",
+    b"add@/devices/pci0000:00/0000:00:14.0/usb3/3-1\0ACTION=add\0"
+    b"DEVPATH=/devices/pci0000:00/0000:00:14.0/usb3/3-1\0SUBSYSTEM=usb\0"
+    b"DEVTYPE=usb_device\0SEQNUM=6128\0",
+    b"change@/devices/pci0000:00/0000:00:02.0/drm/card1\0ACTION=change\0"
+    b"DEVPATH=/devices/pci0000:00/0000:00:02.0/drm/card1\0SUBSYSTEM=drm\0"
+    b"HOTPLUG=1\0CONNECTOR=115\0DEVNAME=dri/card1\0DEVTYPE=drm_minor\0"
+    b"SEQNUM=6131\0MAJOR=226\0MINOR=1\0",
+]
+
+XRANDR = """\
+Screen 0: minimum 320 x 200, current 3840 x 1080, maximum 16384 x 16384
+eDP-1 connected primary 1920x1080+0+0 (normal left inverted right) 309mm x 174mm
+   1920x1080     60.01*+
+HDMI-1 connected 1920x1080+1920+0 (normal left inverted right) 527mm x 296mm
+   1920x1080     60.00*+
+DP-1 disconnected (normal left inverted right x axis y axis)
+"""
+XRANDR_ONE = XRANDR.replace(
+    "HDMI-1 connected 1920x1080+1920+0", "HDMI-1 connected"
+).replace("60.00*+", "60.00 +")
+# autorandr profiles as `autorandr --save` writes them, with the xrandr output
+# once loaded
+PROFILES = {
+    "one": (
+        [b"laptop"],
+        "output HDMI-1\noff\noutput eDP-1\nmode 1920x1080\npos 0x0\nprimary\n",
+        XRANDR_ONE,
+    ),
+    "two": (
+        [b"laptop", b"monitor"],
+        "output eDP-1\ncrtc 0\nmode 1920x1080\npos 0x0\nprimary\nrate 60.01\n"
+        "output HDMI-1\ncrtc 1\nmode 1920x1080\npos 1920x0\nrate 60.00\n",
+        XRANDR,
+    ),
+    "three": (
+        [b"laptop", b"monitor"],
+        "output eDP-1\ncrtc 0\nmode 1920x1080\npos 0x0\nprimary\nrate 60.01\n"
+        "output HDMI-1\ncrtc 1\nmode 1920x1080\npos 1920x0\nrate 60.00\n"
+        "rotate left\n",
+        XRANDR.replace(
+            "HDMI-1 connected 1920x1080+1920+0 (normal",
+            "HDMI-1 connected 1080x1920+1920+0 left (normal",
+        ),
+    ),
+}
+
+
+class FakeDisplays:
+    def __init__(self, drm: Path) -> None:
+        self.drm = drm
+        self.xrandr = XRANDR
+        self.failing: set[str] = set()
+        self.commands: list[list[str]] = []
+        self.load_times: list[float] = []
+
+    def connect(self, name: str, edid: bytes) -> None:
+        connector = self.drm / f"card1-{name}"
+        connector.mkdir(exist_ok=True)
+        (connector / "status").write_text("connected\n")
+        (connector / "edid").write_bytes(edid)
+
+    def run(self, args: list[str], **kwargs) -> ProcessResult:
+        self.commands.append(args)
+        if args[0] == "autorandr":
+            self.load_times.append(time.monotonic())
+            if args[2] in PROFILES:
+                self.xrandr = PROFILES[args[2]][2]
+        if args[0] in self.failing:
+            raise subprocess.CalledProcessError(1, args)
+        stdout = self.xrandr if args[0] == "xrandr" else ""
+        return ProcessResult(args, 0, 0.0, stdout, "")
+
+    def loads(self) -> list[str]:
+        return [x[2] for x in self.commands if x[0] == "autorandr"]
+
+
+@pytest.fixture
+def displays(monkeypatch, tmp_path: Path) -> FakeDisplays:
+    monkeypatch.setenv("XDG_STATE_HOME", str(tmp_path / "state"))
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "config"))
+    for profile, (edids, config, _) in PROFILES.items():
+        setup = tmp_path / "config" / "autorandr" / profile / "setup"
+        setup.parent.mkdir(parents=True)
+        setup.write_text("".join(f"DP-{i} {x.hex()}\n" for i, x in enumerate(edids)))
+        (setup.parent / "config").write_text(config)
+    (tmp_path / "drm").mkdir()
+    monkeypatch.setattr("rpoisel.commands.screen.DRM_CONNECTORS_BASE", tmp_path / "drm")
+    displays = FakeDisplays(tmp_path / "drm")
+    displays.connect("eDP-1", b"laptop")
+    displays.connect("HDMI-A-1", b"monitor")
+    displays.connect("HDMI-A-2", b"")
+    (tmp_path / "drm" / "card1-HDMI-A-2" / "status").write_text("disconnected\n")
+    # a connector without anything plugged in
+    displays.connect("DP-1", b"")
+    (tmp_path / "drm" / "card1-DP-1" / "status").write_text("disconnected\n")
+    monkeypatch.setattr("rpoisel.commands.screen.run", displays.run)
+    return displays
+
+
+def test_layout_is_loaded(displays: FakeDisplays) -> None:
+    result = CliRunner().invoke(app, ["screen", "2"])
+
+    assert result.exit_code == 0, result.output
+    assert [x[0] for x in displays.commands] == [
+        "xrandr",
+        "autorandr",
+        "awesome-client",
+        "setxkbmap",
+        "xrandr",
+    ]
+    assert displays.loads() == ["two"]
+
+
+def test_keyboard_layout_failure_is_reported(displays: FakeDisplays) -> None:
+    displays.failing.add("setxkbmap")
+    runner = CliRunner()
+
+    result = runner.invoke(app, ["screen", "2"])
+
+    assert result.exit_code == 1
+    assert isinstance(result.exception, subprocess.CalledProcessError)
+    # not taken for active, the next attempt loads the layout again
+    displays.failing.clear()
+    assert runner.invoke(app, ["screen", "2"]).exit_code == 0
+    assert displays.loads() == ["two", "two"]
+
+
+def test_active_layout_is_not_loaded_again(displays: FakeDisplays) -> None:
+    runner = CliRunner()
+    assert runner.invoke(app, ["screen", "2"]).exit_code == 0
+    displays.commands.clear()
+
+    result = runner.invoke(app, ["screen", "2"])
+
+    assert result.exit_code == 0, result.output
+    assert result.output == "Layout 2 is already active.\n"
+    assert displays.commands == [["xrandr", "--current"]]
+
+
+def test_rotated_layout_is_not_loaded_again(displays: FakeDisplays) -> None:
+    runner = CliRunner()
+    assert runner.invoke(app, ["screen", "3"]).exit_code == 0
+
+    result = runner.invoke(app, ["screen", "3"])
+
+    assert result.output == "Layout 3 is already active.\n"
+    assert displays.loads() == ["three"]
+
+
+def test_changes_load_the_layout_again(displays: FakeDisplays) -> None:
+    runner = CliRunner()
+    assert runner.invoke(app, ["screen", "2"]).exit_code == 0
+    assert runner.invoke(app, ["screen", "2", "--force"]).exit_code == 0
+    # another layout
+    assert runner.invoke(app, ["screen", "1"]).exit_code == 0
+    assert runner.invoke(app, ["screen", "1"]).exit_code == 0
+    # another monitor with the same geometry
+    displays.connect("HDMI-A-1", b"projector")
+    assert runner.invoke(app, ["screen", "1"]).exit_code == 0
+    # the geometry was changed by hand
+    displays.xrandr = XRANDR_ONE.replace("1920x1080+0+0", "1280x720+0+0")
+    assert runner.invoke(app, ["screen", "1"]).exit_code == 0
+    # the previous geometry is active again, but not the loaded layout
+    displays.xrandr = XRANDR
+    assert runner.invoke(app, ["screen", "1"]).exit_code == 0
+
+    assert displays.loads() == ["two", "two", "one", "one", "one", "one"]
+
+
+def test_layout_is_loaded_without_x(displays: FakeDisplays) -> None:
+    def run(args: list[str], **kwargs) -> ProcessResult:
+        if args[0] == "xrandr":
+            raise FileNotFoundError(2, "No such file or directory", "xrandr")
+        return displays.run(args)
+
+    runner = CliRunner()
+    for _ in range(2):
+        with pytest.MonkeyPatch.context() as patch:
+            patch.setattr("rpoisel.commands.screen.run", run)
+            assert runner.invoke(app, ["screen", "3"]).exit_code == 0
+
+    assert displays.loads() == ["three", "three"]
+
+
+def _start_watch(monkeypatch) -> tuple[socket.socket, threading.Thread]:
+    monkeypatch.setattr("rpoisel.commands.screen.SCREEN_WATCH_DEBOUNCE", DEBOUNCE)
+    kernel, ours = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    watch = threading.Thread(target=_watch_screens, args=(UeventSource(ours),))
+    watch.start()
+    return kernel, watch
+
+
+def test_watch_loads_layout_after_hotplug_burst(
+    monkeypatch, capsys, displays: FakeDisplays
+) -> None:
+    (displays.drm / "card1-HDMI-A-1" / "status").write_text("disconnected\n")
+    kernel, watch = _start_watch(monkeypatch)
+    try:
+        time.sleep(0.1)
+        assert displays.loads() == ["one"]
+
+        (displays.drm / "card1-HDMI-A-1" / "status").write_text("connected\n")
+        for uevent in DOCKING_UEVENTS:
+            kernel.send(uevent)
+            last_event = time.monotonic()
+            time.sleep(DEBOUNCE / 4)
+        time.sleep(DEBOUNCE * 2)
+        # unrelated devices do not reload the layout
+        kernel.send(DOCKING_UEVENTS[1])
+        time.sleep(DEBOUNCE * 2)
+    finally:
+        kernel.close()
+        watch.join()
+
+    assert displays.loads() == ["one", "two"]
+    assert displays.load_times[1] - last_event >= DEBOUNCE * 0.9
+    assert capsys.readouterr().out.splitlines() == [
+        "Loading layout 1",
+        "Loading layout 2",
+    ]
+
+
+def test_watch_reports_unknown_monitors(
+    monkeypatch, capsys, displays: FakeDisplays
+) -> None:
+    displays.connect("HDMI-A-2", b"projector")
+    kernel, watch = _start_watch(monkeypatch)
+    kernel.close()
+    watch.join()
+
+    assert displays.loads() == []
+    assert "No layout matches the connected monitors." in capsys.readouterr().err
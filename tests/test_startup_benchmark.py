@@ -0,0 +1,129 @@
+"""Cold-start benchmark for every registered command.
+
+Each command runs in a fresh interpreter through ``startup_driver.py``. The
+number of loaded modules is compared with ``startup_baseline.json``; set
+``RPOISEL_UPDATE_BASELINE=1`` to rewrite it. Wall time is recorded in
+multiples of a bare interpreter start on the same machine, and only checked
+with ``RPOISEL_BENCHMARK=1``, as it depends on the load of the machine.
+"""
+
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from rpoisel.cli import COMMANDS
+
+DRIVER = Path(__file__).with_name("startup_driver.py")
+BASELINE = Path(__file__).with_name("startup_baseline.json")
+RUNS = 3
+# regressions are measured against the baseline with some headroom for noise
+WALL_FACTOR = 2.0
+WALL_SLACK = 1.0
+MODULES_SLACK = 20
+BENCHMARK_ENV_VAR = "RPOISEL_BENCHMARK"
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Case:
+    args: list[str]
+    stubs: list[str] = field(default_factory=list)
+    exit_code: int = 0
+
+
+CASES: dict[str, Case] = {
+    "screen": Case(["screen", "2"]),
+    "power": Case(["power", "mic", "on"], stubs=["httpx"]),
+    "sleep": Case(["sleep"]),
+    "browser": Case(["browser", "chrome"]),
+    "vm": Case(["vm", "list"], stubs=["qmp"]),
+    "print": Case(["print", "{pdf}"]),
+    # no modules match outside of a real kernel tree
+    "modules": Case(["modules", "sign", "does-not-exist*.ko.xz"], exit_code=1),
+    "elisp": Case(["elisp"]),
+    "completion": Case(["completion", "bash"]),
+    "daemon": Case(["daemon", "--help"]),
+}
+
+
+@pytest.fixture(scope="module")
+def results() -> Iterator[dict[str, dict[str, float]]]:
+    measured: dict[str, dict[str, float]] = {}
+    yield measured
+    if os.environ.get("RPOISEL_UPDATE_BASELINE") and measured:
+        baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+        baseline.update(measured)
+        BASELINE.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+
+
+@pytest.fixture(scope="module")
+def reference_ms() -> float:
+    """Return the wall time of a bare interpreter start, the unit of wall_ratio."""
+    runs = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        runs.append((time.perf_counter() - start) * 1000)
+    return statistics.median(runs)
+
+
+def _run(case: Case, tmp_path: Path) -> tuple[float, int, dict]:
+    pdf = tmp_path / "doc.pdf"
+    pdf.write_bytes(b"%PDF-1.4\nbenchmark\n")
+    profile_path = tmp_path / "profile.json"
+    args = [x.format(pdf=pdf) for x in case.args]
+    stubs = [arg for stub in case.stubs for arg in ("--stub", stub)]
+
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, str(DRIVER), *stubs, "--", *args],
+        capture_output=True,
+        text=True,
+        env={**os.environ, "RPOISEL_PROFILE_STARTUP": str(profile_path)},
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+    assert completed.returncode == 0, completed.stderr
+    summary = json.loads(completed.stdout.splitlines()[-1])
+    assert summary["exit_code"] == case.exit_code, completed.stdout
+    return wall_ms, summary["modules"], json.loads(profile_path.read_text())
+
+
+def test_all_commands_are_benchmarked() -> None:
+    assert set(CASES) == set(COMMANDS)
+
+
+@pytest.mark.parametrize("name", CASES)
+def test_cold_start(name: str, tmp_path: Path, results, reference_ms: float) -> None:
+    runs = [_run(CASES[name], tmp_path) for _ in range(RUNS)]
+    wall_ms = statistics.median(x[0] for x in runs)
+    wall_ratio = wall_ms / reference_ms
+    modules = max(x[1] for x in runs)
+    slowest = ", ".join(
+        f"{x['module']} {x['cumulative'] * 1000:.1f} ms"
+        for x in runs[-1][2]["imports"][:3]
+    )
+    logger.info(
+        f"{name}: {wall_ms:.1f} ms ({wall_ratio:.1f}x python -c pass), "
+        f"{modules} modules (slowest: {slowest})"
+    )
+    results[name] = {"wall_ratio": round(wall_ratio, 1), "modules": modules}
+
+    if os.environ.get("RPOISEL_UPDATE_BASELINE"):
+        return
+    baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+    if name not in baseline:
+        pytest.skip(f"no baseline recorded for {name}")
+    expected = baseline[name]
+    assert modules <= expected["modules"] + MODULES_SLACK
+    if os.environ.get(BENCHMARK_ENV_VAR):
+        assert wall_ratio <= expected["wall_ratio"] * WALL_FACTOR + WALL_SLACK
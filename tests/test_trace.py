@@ -0,0 +1,110 @@
+import json
+import logging
+import subprocess
+from pathlib import Path
+from types import SimpleNamespace
+
+from qmp_server import FakeQMPServer
+from relay_server import FakeRelay
+from typer.testing import CliRunner
+
+from rpoisel import app, trace
+from rpoisel.commands.power import PowerEndpoint, _http_client
+from rpoisel.util.process import run, run_pipeline
+
+
+def _read_jsonl(path: Path) -> list[dict]:
+    return [json.loads(x) for x in path.read_text().splitlines()]
+
+
+def test_child_processes_are_traced(tmp_path: Path) -> None:
+    original_run = subprocess.run
+    trace.install(str(tmp_path / "trace.jsonl"))
+    try:
+        run(["true"])
+        run_pipeline([["echo", "a"], ["cat"]])
+        subprocess.run(["sh", "-c", "exit 3"])
+        subprocess.run("exit 4", shell=True)
+    finally:
+        trace.uninstall()
+
+    assert subprocess.run is original_run
+    spans = _read_jsonl(tmp_path / "trace.jsonl")
+    assert [(x["name"], x["status"]) for x in spans] == [
+        ("true", 0),
+        ("echo", 0),
+        ("cat", 0),
+        ("sh", 3),
+        ("exit", 4),
+    ]
+    assert spans[1]["argv"] == ["echo", "a"]
+    assert spans[4]["argv"] == "exit 4"
+    assert all(x["start"] >= 0 and x["duration"] > 0 for x in spans)
+
+
+def test_trace_option_records_relay_requests(
+    monkeypatch, caplog, tmp_path: Path
+) -> None:
+    caplog.set_level(logging.WARNING, logger="httpx")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    _http_client.cache_clear()
+    output = tmp_path / "trace.jsonl"
+    with FakeRelay(latency=0.05) as mic, FakeRelay() as other:
+        monkeypatch.setattr(
+            "rpoisel.commands.power.IP_MAPPING",
+            {PowerEndpoint.mic: mic.address, PowerEndpoint.other: other.address},
+        )
+        try:
+            result = CliRunner().invoke(
+                app, ["--trace", str(output), "power", "all", "on"]
+            )
+        finally:
+            _http_client().close()
+            _http_client.cache_clear()
+
+    assert result.exit_code == 0, result.output
+    spans = {x["name"]: x for x in _read_jsonl(output)}
+    assert set(spans) == {"rpoisel power", "GET mic", "GET other"}
+    assert spans["GET mic"]["status"] == 200
+    assert spans["GET mic"]["params"] == {"turn": "on"}
+    assert spans["GET mic"]["duration"] >= 0.05
+    assert spans["rpoisel power"]["duration"] >= spans["GET mic"]["duration"]
+    assert not trace.active()
+
+
+def test_qmp_commands_in_chrome_format(monkeypatch, tmp_path: Path) -> None:
+    output = tmp_path / "trace.json"
+    with FakeQMPServer(tmp_path / "qmp-test") as server:
+        monkeypatch.setattr(
+            "rpoisel.commands.vm.QEMU_QMP_SOCKETS_BASE", server.path.parent
+        )
+        args = ["--trace", str(output), "--trace-format", "chrome", "vm", "state"]
+        result = CliRunner().invoke(app, [*args, "test"])
+
+    assert result.exit_code == 0, result.output
+    events = json.loads(output.read_text())["traceEvents"]
+    assert [x["name"] for x in events] == [
+        "rpoisel vm",
+        "qmp connect",
+        "qmp qmp_capabilities",
+        "qmp query-status",
+    ]
+    assert all(x["ph"] == "X" and x["dur"] > 0 for x in events)
+    assert events[3]["args"] == {"socket": str(server.path)}
+
+
+def test_disabled_tracing_does_no_work(monkeypatch) -> None:
+    def fail(*args, **kwargs) -> None:
+        raise AssertionError("traced while tracing is off")
+
+    # neither span objects nor clock reads while tracing is off
+    monkeypatch.setattr(trace, "Span", fail)
+    monkeypatch.setattr(trace, "time", SimpleNamespace(perf_counter=fail))
+
+    with trace.span("span", attribute=1) as span:
+        span.set(status=0)
+    trace.add("measured", 0.0, 1.0)
+    run(["true"])
+
+    assert trace.span("other") is span
+    assert subprocess.run is not trace._traced_run
@@ -0,0 +1,588 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+import pytest
+from qmp_server import FakeQMPServer
+from typer.testing import CliRunner
+
+from rpoisel import app
+from rpoisel.commands import vm
+from rpoisel.commands.vm import _watch_vms
+from rpoisel.util.process import ProcessResult, run
+
+VMS = 20
+LATENCY = 0.05
+SLOWEST = 0.2
+# qmp_capabilities and query-status
+ROUND_TRIPS = 2
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def vm_dirs(monkeypatch, tmp_path: Path) -> tuple[Path, Path]:
+    sockets = tmp_path / "sockets"
+    pid_files = tmp_path / "run"
+    sockets.mkdir()
+    pid_files.mkdir()
+    monkeypatch.setattr("rpoisel.commands.vm.QEMU_QMP_SOCKETS_BASE", sockets)
+    monkeypatch.setattr("rpoisel.commands.vm.QEMU_PID_FILES_BASE", pid_files)
+    monkeypatch.setattr("rpoisel.commands.vm.QEMU_STATUS_TIMEOUT", 0.5)
+    return sockets, pid_files
+
+
+def _dead_pid() -> int:
+    process = subprocess.Popen(["true"])
+    process.wait()
+    return process.pid
+
+
+def _start_vm(
+    stack: ExitStack,
+    vm_dirs: tuple[Path, Path],
+    name: str,
+    latency: float = 0.0,
+    pid: int | None = None,
+) -> FakeQMPServer:
+    sockets, pid_files = vm_dirs
+    (pid_files / f"qemu-{name}.pid").write_text(f"{pid or os.getpid()}\n")
+    return stack.enter_context(FakeQMPServer(sockets / f"qmp-{name}", latency))
+
+
+def test_list_vms_with_status(vm_dirs, processes: list[list[str]]) -> None:
+    sockets, pid_files = vm_dirs
+    with ExitStack() as stack:
+        _start_vm(stack, vm_dirs, "running")
+        _start_vm(stack, vm_dirs, "paused").status = "paused"
+        _start_vm(stack, vm_dirs, "wedged", latency=10)
+        _start_vm(stack, vm_dirs, "dead", pid=_dead_pid())
+        # a socket without PID file is left over from an unclean shutdown
+        stack.enter_context(FakeQMPServer(sockets / "qmp-orphan"))
+        (sockets / "unrelated").touch()
+
+        result = CliRunner().invoke(app, ["vm", "list", "--json"])
+
+    assert result.exit_code == 0, result.output
+    vms = json.loads(result.stdout)
+    assert {x["name"]: x["status"] for x in vms} == {
+        "dead": "dead",
+        "paused": "paused",
+        "running": "running",
+        "wedged": "unresponsive",
+    }
+    assert not (sockets / "qmp-dead").exists()
+    assert not (sockets / "qmp-orphan").exists()
+    assert (sockets / "unrelated").exists()
+    assert not processes
+
+
+def test_list_removes_root_owned_sockets_at_once(
+    monkeypatch, vm_dirs, processes: list[list[str]]
+) -> None:
+    sockets, _ = vm_dirs
+    with ExitStack() as stack:
+        for name in ["a", "b"]:
+            stack.enter_context(FakeQMPServer(sockets / f"qmp-{name}"))
+
+        def unlink(self, missing_ok: bool = False) -> None:
+            raise PermissionError(13, "Permission denied", str(self))
+
+        with monkeypatch.context() as patch:
+            patch.setattr(Path, "unlink", unlink)
+            result = CliRunner().invoke(app, ["vm", "list"])
+
+    assert result.exit_code == 0, result.output
+    assert processes == [
+        ["sudo", "rm", "-f", str(sockets / "qmp-a"), str(sockets / "qmp-b")]
+    ]
+
+
+def test_list_takes_as_long_as_the_slowest_vm(vm_dirs) -> None:
+    with ExitStack() as stack:
+        for i in range(VMS):
+            _start_vm(stack, vm_dirs, f"vm{i:02}", latency=LATENCY)
+        _start_vm(stack, vm_dirs, "slowest", latency=SLOWEST)
+
+        start = time.perf_counter()
+        result = CliRunner().invoke(app, ["vm", "list"])
+        duration = time.perf_counter() - start
+
+    assert result.exit_code == 0, result.output
+    assert len(result.stdout.splitlines()) == VMS + 1
+    assert all(": running " in x for x in result.stdout.splitlines())
+    slowest = SLOWEST * ROUND_TRIPS
+    total = (VMS * LATENCY + SLOWEST) * ROUND_TRIPS
+    logger.info(
+        "vm list with %d VMs: %.1f ms, slowest VM %.0f ms, sum of all VMs %.0f ms",
+        VMS + 1,
+        duration * 1000,
+        slowest * 1000,
+        total * 1000,
+    )
+    assert duration < slowest + (total - slowest) / 4
+
+
+def test_watch_streams_events_of_appearing_vms(monkeypatch, capsys, vm_dirs) -> None:
+    monkeypatch.setattr("rpoisel.commands.vm.QEMU_WATCH_RESCAN_INTERVAL", 0.02)
+
+    async def run(stack: ExitStack) -> None:
+        a = _start_vm(stack, vm_dirs, "a")
+        _start_vm(stack, vm_dirs, "ignored")
+        watch = asyncio.create_task(_watch_vms(["a", "b"], json_output=True))
+        await asyncio.sleep(0.2)
+        a.emit("STOP")
+        with FakeQMPServer(vm_dirs[0] / "qmp-b") as b:
+            await asyncio.sleep(0.2)
+            b.emit("SHUTDOWN", {"guest": True, "reason": "guest-shutdown"})
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(0.2)
+        a.emit("RESUME")
+        await asyncio.sleep(0.2)
+        watch.cancel()
+
+    with ExitStack() as stack:
+        asyncio.run(run(stack))
+
+    output = capsys.readouterr()
+    events = [json.loads(x) for x in output.out.splitlines()]
+    assert [(x["vm"], x["event"]) for x in events] == [
+        ("a", "STOP"),
+        ("b", "SHUTDOWN"),
+        ("a", "RESUME"),
+    ]
+    assert events[1]["data"] == {"guest": True, "reason": "guest-shutdown"}
+    assert output.err.splitlines() == [
+        "Watching a",
+        "Watching b",
+        "Stopped watching b",
+    ]
+
+
+def test_watch_retries_failed_connects(monkeypatch, capsys, vm_dirs) -> None:
+    monkeypatch.setattr("rpoisel.commands.vm.QEMU_WATCH_RESCAN_INTERVAL", 0.02)
+
+    async def run(stack: ExitStack) -> None:
+        a = _start_vm(stack, vm_dirs, "a")
+        # QEMU is still starting up, the socket stays the same
+        a.refuse = 3
+        watch = asyncio.create_task(_watch_vms(["a"], json_output=True))
+        await asyncio.sleep(0.5)
+        a.emit("STOP")
+        await asyncio.sleep(0.1)
+        watch.cancel()
+        assert a.connections == 4
+
+    with ExitStack() as stack:
+        asyncio.run(run(stack))
+
+    (line,) = capsys.readouterr().out.splitlines()
+    assert json.loads(line)["event"] == "STOP"
+
+
+def test_watch_prints_timestamped_lines(capsys, vm_dirs) -> None:
+    async def run(stack: ExitStack) -> None:
+        a = _start_vm(stack, vm_dirs, "a")
+        watch = asyncio.create_task(_watch_vms([], json_output=False))
+        await asyncio.sleep(0.2)
+        a.emit("POWERDOWN")
+        await asyncio.sleep(0.1)
+        watch.cancel()
+
+    with ExitStack() as stack:
+        asyncio.run(run(stack))
+
+    (line,) = capsys.readouterr().out.splitlines()
+    timestamp, vm_name, event = line.split()
+    assert (vm_name, event) == ("a", "POWERDOWN")
+    assert timestamp.startswith(time.strftime("%Y-%m-%dT"))
+
+
+def test_only_watch_accepts_several_names(vm_dirs) -> None:
+    result = CliRunner().invoke(app, ["vm", "state", "a", "b"])
+
+    assert result.exit_code == 1
+    assert "'state' accepts a single VM name" in result.output
+
+
+def _write_qcow2(path: Path, backing: str | None = None) -> None:
+    # just enough of a qcow2 header for the format and backing file
+    header = bytearray(512)
+    header[:8] = b"QFI\xfb\x00\x00\x00\x03"
+    if backing:
+        header[8:20] = struct.pack(">QI", 512, len(backing))
+    path.write_bytes(bytes(header) + (backing or "").encode())
+
+
+@pytest.fixture
+def images(monkeypatch, tmp_path: Path) -> Path:
+    images = tmp_path / "images"
+    images.mkdir()
+    monkeypatch.setattr("rpoisel.commands.vm.QEMU_IMAGES_FILES_BASE", images)
+    return images
+
+
+@pytest.fixture
+def processes(monkeypatch) -> list[list[str]]:
+    commands: list[list[str]] = []
+
+    def fake_run(args: list[str], **kwargs) -> ProcessResult:
+        commands.append(args)
+        if args[:2] == ["qemu-img", "create"] and "-b" in args:
+            _write_qcow2(Path(args[-1]), args[args.index("-b") + 1])
+        return ProcessResult(args, 0, 0.0, "", "")
+
+    monkeypatch.setattr("rpoisel.commands.vm.run", fake_run)
+    return commands
+
+
+def test_clone_creates_overlay(images: Path, processes: list[list[str]]) -> None:
+    (images / "debian.vmdk").write_bytes(b"KDMV" + bytes(508))
+
+    result = CliRunner().invoke(app, ["vm", "clone", "debian", "dev"])
+
+    assert result.exit_code == 0, result.output
+    template = images / "debian.vmdk"
+    assert processes == [
+        [
+            "qemu-img",
+            "create",
+            "-q",
+            "-f",
+            "qcow2",
+            "-b",
+            str(template),
+            "-F",
+            "vmdk",
+            str(images / "dev.qcow2"),
+        ]
+    ]
+    # the template must not change under its overlays
+    assert not template.stat().st_mode & 0o222
+
+
+@pytest.mark.parametrize(
+    "args, message",
+    [
+        (["clone", "debian"], "'clone' expects a template and a VM name"),
+        (["clone", "missing", "new"], "no image for template missing"),
+        (["clone", "debian", "dev"], "image already exists"),
+        (["clone", "debian", "debian"], "cannot be cloned from itself"),
+    ],
+)
+def test_clone_rejects(images: Path, processes, args: list[str], message: str) -> None:
+    _write_qcow2(images / "debian.qcow2")
+    _write_qcow2(images / "dev.qcow2")
+
+    result = CliRunner().invoke(app, ["vm", *args])
+
+    assert result.exit_code == 1
+    assert message in result.output
+    assert not processes
+
+
+def _drive(argv: list[str]) -> str:
+    return argv[argv.index("-drive") + 1]
+
+
+def test_start_detects_image_format(
+    images: Path, vm_dirs, processes: list[list[str]]
+) -> None:
+    _write_qcow2(images / "debian.qcow2")
+    _write_qcow2(images / "dev.qcow2", "debian.qcow2")
+    (images / "legacy.vmdk").write_text("# Disk DescriptorFile\n")
+
+    for name in ["dev", "legacy"]:
+        result = CliRunner().invoke(app, ["vm", "start", name])
+        assert result.exit_code == 0, result.output
+
+    qemu = [x for x in processes if "qemu-system-x86_64" in x]
+    assert _drive(qemu[0]).startswith(f"file={images / 'dev.qcow2'},format=qcow2,")
+    assert _drive(qemu[1]).startswith(f"file={images / 'legacy.vmdk'},format=vmdk,")
+
+
+def test_start_without_image_fails(images: Path, vm_dirs, processes) -> None:
+    result = CliRunner().invoke(app, ["vm", "start", "missing"])
+
+    assert result.exit_code == 1
+    assert "no image for VM missing" in result.output
+    assert not processes
+
+
+def test_create_from_template_boots_overlay(
+    images: Path, vm_dirs, processes: list[list[str]]
+) -> None:
+    _write_qcow2(images / "debian.qcow2")
+
+    result = CliRunner().invoke(app, ["vm", "create", "dev", "--from", "debian"])
+
+    assert result.exit_code == 0, result.output
+    assert (images / "dev.qcow2").exists()
+    _, qemu, chown = processes
+    assert qemu[:2] == ["sudo", "qemu-system-x86_64"]
+    assert "-cdrom" not in qemu
+    assert "-daemonize" in qemu
+    assert _drive(qemu).startswith(f"file={images / 'dev.qcow2'},format=qcow2,")
+    assert chown[:2] == ["sudo", "chown"]
+
+
+def test_create_from_iso_boots_installer(
+    images: Path, vm_dirs, processes: list[list[str]], tmp_path: Path
+) -> None:
+    iso = tmp_path / "debian.iso"
+    iso.touch()
+
+    result = CliRunner().invoke(
+        app, ["vm", "create", "dev", "--iso", str(iso), "--profile", "desktop"]
+    )
+
+    assert result.exit_code == 0, result.output
+    create, *setup, qemu = processes
+    assert create == [
+        "qemu-img",
+        "create",
+        "-q",
+        "-f",
+        "vmdk",
+        f"{images}/dev.vmdk",
+        "20G",
+    ]
+    # multiqueue attaches to a tap on the bridge
+    assert setup == [
+        ["sudo", "ip", "tuntap", "add", "dev", "tap-dev", "mode", "tap", "multi_queue"],
+        ["sudo", "ip", "link", "set", "tap-dev", "master", "bridge0", "up"],
+    ]
+    assert qemu[qemu.index("-cdrom") + 1] == str(iso)
+    # the installer runs in the foreground
+    assert "-daemonize" not in qemu
+    assert _drive(qemu).startswith(f"file={images / 'dev.vmdk'},format=vmdk,")
+    assert json.loads((images / "dev.json").read_text())["profile"] == "desktop"
+
+
+def test_start_reuses_tap(
+    monkeypatch, images: Path, vm_dirs, processes: list[list[str]], tmp_path: Path
+) -> None:
+    monkeypatch.setattr("rpoisel.commands.vm.NETWORK_INTERFACES_BASE", tmp_path)
+    (tmp_path / "tap-dev").mkdir()
+    _write_qcow2(images / "dev.qcow2")
+
+    result = CliRunner().invoke(app, ["vm", "start", "dev", "--profile", "desktop"])
+
+    assert result.exit_code == 0, result.output
+    assert processes[0] == [
+        "sudo",
+        "ip",
+        "link",
+        "set",
+        "tap-dev",
+        "master",
+        "bridge0",
+        "up",
+    ]
+    assert processes[1][:2] == ["sudo", "qemu-system-x86_64"]
+
+
+def test_start_keeps_spec(images: Path, vm_dirs, processes: list[list[str]]) -> None:
+    _write_qcow2(images / "dev.qcow2")
+
+    def start(*args: str) -> list[str]:
+        processes.clear()
+        result = CliRunner().invoke(app, ["vm", "start", "dev", *args])
+        assert result.exit_code == 0, result.output
+        return next(x for x in processes if "qemu-system-x86_64" in x)
+
+    assert start()[start().index("-smp") + 1].startswith("1,")
+    argv = start("--profile", "build", "--vnc-display", "3", "--printer")
+    assert argv[argv.index("-smp") + 1] == "16,sockets=1,cores=8,threads=2"
+    # settings given once stay with the VM
+    argv = start()
+    assert argv[argv.index("-smp") + 1] == "16,sockets=1,cores=8,threads=2"
+    assert "vnc=:3" in argv
+    assert "usb-ehci,id=ehci" in argv
+    argv = start("--no-printer")
+    assert "usb-ehci,id=ehci" not in argv
+    assert json.loads((images / "dev.json").read_text()) == {
+        "name": "dev",
+        "profile": "build",
+        "bridge": "bridge0",
+        "vnc_display": 3,
+        "printer": False,
+    }
+
+
+@pytest.mark.parametrize(
+    "spec, message",
+    [
+        ("{", "invalid VM spec"),
+        ('{"name": "dev", "profile": "turbo"}', "unknown profile turbo"),
+    ],
+)
+def test_start_rejects_invalid_spec(
+    images: Path, vm_dirs, processes, spec: str, message: str
+) -> None:
+    _write_qcow2(images / "dev.qcow2")
+    (images / "dev.json").write_text(spec)
+
+    result = CliRunner().invoke(app, ["vm", "start", "dev"])
+
+    assert result.exit_code == 1
+    assert message in result.output
+    assert not processes
+
+
+def test_templates_lists_overlays(images: Path, processes) -> None:
+    _write_qcow2(images / "debian.qcow2")
+    (images / "windows.vmdk").write_bytes(b"KDMV" + bytes(508))
+    (images / "scratch.img").write_bytes(bytes(512))
+    for template, name in [("debian", "a"), ("debian", "b"), ("windows", "c")]:
+        assert CliRunner().invoke(app, ["vm", "clone", template, name]).exit_code == 0
+    # relative backing files resolve against the overlay
+    _write_qcow2(images / "d.qcow2", "debian.qcow2")
+
+    result = CliRunner().invoke(app, ["vm", "templates", "--json"])
+    text = CliRunner().invoke(app, ["vm", "templates"])
+
+    assert result.exit_code == 0, result.output
+    assert [
+        (x["name"], x["format"], x["overlays"]) for x in json.loads(result.output)
+    ] == [
+        ("debian", "qcow2", ["a", "b", "d"]),
+        ("windows", "vmdk", ["c"]),
+    ]
+    assert text.output == "debian (qcow2)\n  a\n  b\n  d\nwindows (vmdk)\n  c\n"
+
+
+@pytest.mark.skipif(shutil.which("qemu-img") is None, reason="needs qemu-img")
+def test_clone_with_qemu_img(images: Path) -> None:
+    run(["qemu-img", "create", "-q", "-f", "qcow2", str(images / "base.qcow2"), "20G"])
+
+    start = time.perf_counter()
+    result = CliRunner().invoke(app, ["vm", "clone", "base", "dev"])
+    duration = time.perf_counter() - start
+
+    assert result.exit_code == 0, result.output
+    logger.info("clone of a 20G template: %.1f ms", duration * 1000)
+    overlay = images / "dev.qcow2"
+    assert overlay.stat().st_size < 1024 * 1024
+    assert vm._image_info(overlay).backing == (images / "base.qcow2").resolve()
+
+
+@pytest.mark.skipif(shutil.which("zstd") is None, reason="needs zstd")
+def test_save_and_restore(
+    monkeypatch, images: Path, vm_dirs, processes: list[list[str]]
+) -> None:
+    monkeypatch.setattr("rpoisel.commands.vm.QEMU_MIGRATION_PROGRESS_INTERVAL", 0.05)
+    _write_qcow2(images / "dev.qcow2")
+    memory = os.urandom(1 << 20) + bytes(15 << 20)
+    state = images / "dev.state.zst"
+
+    with ExitStack() as stack:
+        source = _start_vm(stack, vm_dirs, "dev")
+        source.memory = memory
+        source.migration_time = 0.3
+        saved = CliRunner().invoke(app, ["vm", "save", "dev"])
+
+    assert saved.exit_code == 0, saved.output
+    assert f"Saved VM dev to {state}" in saved.stdout
+    # progress is reported while the migration runs
+    assert "Saving dev: " in saved.stderr
+    assert [x["execute"] for x in source.received][-1] == "quit"
+    assert "stop" in [x["execute"] for x in source.received]
+    assert state.stat().st_size < len(memory) / 4
+    assert not (images / "dev.state.zst.tmp").exists()
+
+    # a cold boot would change the disk under the saved state
+    started = CliRunner().invoke(app, ["vm", "start", "dev"])
+    assert started.exit_code == 1
+    assert "has a saved state" in started.output
+
+    with ExitStack() as stack:
+        destination = _start_vm(stack, vm_dirs, "dev")
+        destination.status = "inmigrate"
+        # the fake stands in for the QEMU that restore launches
+        monkeypatch.setattr("rpoisel.commands.vm._get_qmp_client", lambda path: None)
+        restored = CliRunner().invoke(
+            app, ["vm", "restore", "dev", "--vnc-display", "2"]
+        )
+
+    assert restored.exit_code == 0, restored.output
+    assert "Restored VM dev in " in restored.stdout
+    qemu = processes[-2]
+    assert qemu[qemu.index("-incoming") + 1] == "defer"
+    assert "-daemonize" in qemu
+    assert "vnc=:2" in qemu
+    assert destination.memory == memory
+    assert destination.status == "running"
+    assert not state.exists()
+
+
+@pytest.mark.skipif(shutil.which("zstd") is None, reason="needs zstd")
+def test_failed_save_keeps_vm_running(images: Path, vm_dirs, processes) -> None:
+    _write_qcow2(images / "dev.qcow2")
+
+    with ExitStack() as stack:
+        server = _start_vm(stack, vm_dirs, "dev")
+        server.memory = bytes(1024)
+        server.migration_error = "No space left on device"
+        result = CliRunner().invoke(app, ["vm", "save", "dev"])
+
+    assert result.exit_code == 1
+    assert "saving VM dev failed: No space left on device" in result.output
+    assert server.status == "running"
+    assert [x["execute"] for x in server.received][-1] == "cont"
+    assert list(images.iterdir()) == [images / "dev.qcow2"]
+
+
+def test_rejected_save_keeps_vm_running(images: Path, vm_dirs, processes) -> None:
+    _write_qcow2(images / "dev.qcow2")
+
+    with ExitStack() as stack:
+        server = _start_vm(stack, vm_dirs, "dev")
+        server.failing["migrate"] = "There's a migration process in progress"
+        result = CliRunner().invoke(app, ["vm", "save", "dev"])
+
+    assert result.exit_code == 1
+    assert "There's a migration process in progress" in result.output
+    assert server.status == "running"
+    assert [x["execute"] for x in server.received][-1] == "cont"
+    assert list(images.iterdir()) == [images / "dev.qcow2"]
+
+
+def test_rejected_command_is_reported(vm_dirs) -> None:
+    with ExitStack() as stack:
+        server = _start_vm(stack, vm_dirs, "dev")
+        server.failing["stop"] = "Migration is in progress"
+        result = CliRunner().invoke(app, ["vm", "stop", "dev"])
+
+    assert result.exit_code == 1
+    assert "Error: stop of VM dev failed: " in result.output
+    assert "Migration is in progress" in result.output
+
+
+def test_stale_socket_is_reported(vm_dirs) -> None:
+    sockets, _ = vm_dirs
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+        stale.bind(str(sockets / "qmp-dev"))
+
+    result = CliRunner().invoke(app, ["vm", "state", "dev"])
+
+    assert result.exit_code == 1
+    assert "Error: state of VM dev failed: " in result.output
+
+
+def test_restore_without_state_fails(images: Path, vm_dirs, processes) -> None:
+    _write_qcow2(images / "dev.qcow2")
+
+    result = CliRunner().invoke(app, ["vm", "restore", "dev"])
+
+    assert result.exit_code == 1
+    assert "no saved state for VM dev" in result.output
+    assert not processes
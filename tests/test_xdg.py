@@ -0,0 +1,35 @@
+from pathlib import Path
+
+import pytest
+
+from rpoisel.util.xdg import xdg_path
+
+
+def test_base_directory_from_environment(monkeypatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("XDG_STATE_HOME", str(tmp_path))
+
+    assert (
+        xdg_path("state", "rpoisel", "screen.json") == tmp_path / "rpoisel/screen.json"
+    )
+
+
+@pytest.mark.parametrize(
+    "kind, default",
+    [("cache", ".cache"), ("config", ".config"), ("state", ".local/state")],
+)
+def test_default_below_home(monkeypatch, tmp_path: Path, kind, default: str) -> None:
+    monkeypatch.setenv("HOME", str(tmp_path))
+    for name in ["XDG_CACHE_HOME", "XDG_CONFIG_HOME", "XDG_STATE_HOME"]:
+        # empty counts as unset
+        monkeypatch.setenv(name, "")
+
+    assert xdg_path(kind, "rpoisel") == tmp_path / default / "rpoisel"
+
+
+def test_runtime_falls_back_to_tmpdir(monkeypatch, tmp_path: Path) -> None:
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    monkeypatch.setenv("TMPDIR", str(tmp_path))
+    assert xdg_path("runtime", "x") == tmp_path / "x"
+
+    monkeypatch.delenv("TMPDIR")
+    assert xdg_path("runtime", "x") == Path("/tmp/x")